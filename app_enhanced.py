@@ -4,34 +4,18 @@ import folium
 from folium.plugins import Draw
 from streamlit_folium import st_folium
 import json
-import os
+import copy
 from datetime import datetime
-from data_processor import load_data, preparer_telechargement_excel
-from shapely.geometry import shape, Point, mapping
-from shapely.ops import unary_union
-import zipfile
-import io
+from data_processor import load_data
+from map_layers import PointLayer
+from dispatch_engine import create_zip_with_excels, get_excel_bytes
+from patterns_store import DEFAULT_SITE, PatternsConflict, get_site_store, list_sites
 
 # Configuration
 st.set_page_config(layout="wide", page_title="Dispatch Auto - JNR Transport")
 
-PATTERNS_FILE = "driver_patterns.json"
-
 # === FONCTIONS UTILITAIRES ===
 
-def load_patterns():
-    """Charge les patterns sauvegardés depuis le fichier JSON."""
-    if os.path.exists(PATTERNS_FILE):
-        with open(PATTERNS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"drivers": {}, "updated_at": None}
-
-def save_patterns(patterns):
-    """Sauvegarde les patterns dans le fichier JSON."""
-    patterns["updated_at"] = datetime.now().isoformat()
-    with open(PATTERNS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(patterns, f, ensure_ascii=False, indent=2)
-
 def get_driver_color(index):
     """Retourne une couleur unique pour chaque chauffeur."""
     colors = [
@@ -41,80 +25,47 @@ def get_driver_color(index):
     ]
     return colors[index % len(colors)]
 
-def point_in_zones(lat, lon, zones):
-    """Vérifie si un point est dans une des zones."""
-    point = Point(lon, lat)
-    for zone in zones:
-        polygon = shape(zone)
-        if polygon.contains(point):
-            return True
-    return False
+# === INTERFACE ===
 
-def filter_by_driver_zones(df, zones):
-    """Filtre les colis qui sont dans les zones d'un chauffeur."""
-    if not zones:
-        return pd.DataFrame()
-    
-    def is_in_zones(row):
-        if pd.isna(row['lat']) or pd.isna(row['lon']):
-            return False
-        return point_in_zones(row['lat'], row['lon'], zones)
-    
-    mask = df.apply(is_in_zones, axis=1)
-    return df[mask]
+st.title("🚚 Dispatch Automatique - JNR Transport")
 
-def auto_dispatch(df, patterns):
-    """Dispatch automatique basé sur les patterns sauvegardés."""
-    results = {}
-    assigned_indices = set()
-    
-    for driver_name, driver_data in patterns.get("drivers", {}).items():
-        zones = driver_data.get("zones", [])
-        if not zones:
-            continue
-        
-        driver_df = filter_by_driver_zones(df, zones)
-        # Exclure les colis déjà assignés
-        driver_df = driver_df[~driver_df.index.isin(assigned_indices)]
-        
-        if not driver_df.empty:
-            results[driver_name] = driver_df
-            assigned_indices.update(driver_df.index.tolist())
-    
-    # Colis non assignés
-    unassigned = df[~df.index.isin(assigned_indices)]
-    if not unassigned.empty:
-        results["_NON_ASSIGNES"] = unassigned
-    
-    return results
+# Site (dépôt, client) : chaque site a sa propre configuration
+if "new_site" in st.session_state:
+    st.session_state["site"] = st.session_state.pop("new_site")
+site = st.sidebar.selectbox(
+    "🏢 Site",
+    options=list_sites(),
+    format_func=lambda s: "Site principal" if s == DEFAULT_SITE else s,
+    key="site"
+)
 
-def create_zip_with_excels(dispatch_results):
-    """Crée un ZIP contenant tous les fichiers Excel."""
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for driver_name, driver_df in dispatch_results.items():
-            if driver_df.empty:
-                continue
-            
-            # Préparer l'Excel
-            excel_data = preparer_telechargement_excel(driver_df)
-            
-            # Nom du fichier
-            safe_name = driver_name.replace(" ", "_").replace("/", "-")
-            filename = f"Tournee_{safe_name}.xlsx"
-            
-            zip_file.writestr(filename, excel_data)
-    
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+# Charger les patterns existants (version compilée partagée, relue seulement si le fichier change)
+patterns_store = get_site_store(site)
+compiled_patterns = patterns_store.get()
+patterns = compiled_patterns.patterns
 
-# === INTERFACE ===
+# Révision affichée à l'exécution précédente : celle que l'utilisateur a vue avant de
+# cliquer (la version relue ci-dessus contient déjà les modifications des autres)
+rendered_revisions = st.session_state.setdefault("rendered_revision", {})
+seen_revision = rendered_revisions.get(site, compiled_patterns.revision)
+rendered_revisions[site] = compiled_patterns.revision
 
-st.title("🚚 Dispatch Automatique - JNR Transport")
 
-# Charger les patterns existants
-patterns = load_patterns()
+def edit_driver(driver_name):
+    """Copie modifiable d'un chauffeur (la configuration compilée est partagée)."""
+    return copy.deepcopy(patterns.get("drivers", {}).get(driver_name, {}))
+
+
+def save_drivers(changes):
+    """Enregistre les chauffeurs modifiés ({nom: données}, None pour supprimer).
+    Refusé si un autre utilisateur les a modifiés depuis l'affichage de la page."""
+    try:
+        patterns_store.update_drivers(changes, expected_revision=seen_revision)
+    except PatternsConflict as e:
+        st.error(f"⚠️ Modification non enregistrée ({e}). Rechargez la page et recommencez.")
+        return False
+    return True
+
 
 # Tabs pour les différents modes
 tab1, tab2 = st.tabs(["📍 Configuration des Zones", "⚡ Dispatch Automatique"])
@@ -141,12 +92,10 @@ with tab1:
             if new_driver and new_driver.strip():
                 driver_name = new_driver.strip()
                 if driver_name not in patterns.get("drivers", {}):
-                    if "drivers" not in patterns:
-                        patterns["drivers"] = {}
-                    patterns["drivers"][driver_name] = {"zones": [], "color": get_driver_color(len(patterns["drivers"]))}
-                    save_patterns(patterns)
-                    st.success(f"✅ {driver_name} ajouté!")
-                    st.rerun()
+                    new_data = {"zones": [], "color": get_driver_color(len(patterns["drivers"]))}
+                    if save_drivers({driver_name: new_data}):
+                        st.success(f"✅ {driver_name} ajouté!")
+                        st.rerun()
                 else:
                     st.warning("Ce chauffeur existe déjà")
         
@@ -171,6 +120,14 @@ with tab1:
                 </div>
             """, unsafe_allow_html=True)
         
+        # Zones communes à deux chauffeurs (calculées une fois par version des patterns)
+        overlaps = compiled_patterns.overlaps()
+        if overlaps:
+            with st.expander(f"⚠️ {len(overlaps)} chevauchement(s)"):
+                for o in overlaps:
+                    st.markdown(f"- **{o['prioritaire']}** / {o['chauffeur']} : {o['surface_m2'] / 10000:.2f} ha")
+                st.caption("Le premier chauffeur (prioritaire) reçoit les colis de la zone commune.")
+        
         st.markdown("---")
         
         # Actions sur le chauffeur sélectionné
@@ -178,16 +135,16 @@ with tab1:
             st.markdown(f"**Actions pour {selected_driver}:**")
             
             if st.button("🗑️ Supprimer ses zones", use_container_width=True):
-                patterns["drivers"][selected_driver]["zones"] = []
-                save_patterns(patterns)
-                st.success("Zones supprimées!")
-                st.rerun()
+                driver_data = edit_driver(selected_driver)
+                driver_data["zones"] = []
+                if save_drivers({selected_driver: driver_data}):
+                    st.success("Zones supprimées!")
+                    st.rerun()
             
             if st.button("❌ Supprimer le chauffeur", use_container_width=True):
-                del patterns["drivers"][selected_driver]
-                save_patterns(patterns)
-                st.success("Chauffeur supprimé!")
-                st.rerun()
+                if save_drivers({selected_driver: None}):
+                    st.success("Chauffeur supprimé!")
+                    st.rerun()
     
     with col_left:
         # Carte avec les zones existantes et les points
@@ -233,16 +190,11 @@ with tab1:
         
         # Afficher les points du fichier de référence
         if not df_map.empty:
-            for _, row in df_map.iterrows():
-                cp = str(row.get('Sort Code', ''))
-                folium.CircleMarker(
-                    location=[row['lat'], row['lon']],
-                    radius=3,
-                    color="#333",
-                    fill=True,
-                    fillOpacity=0.6,
-                    popup=f"{row.get('Receiver City', row.get('Receivers City', 'N/A'))} - {cp}"
-                ).add_to(m)
+            city_col = next((c for c in ['Receiver City', 'Receivers City'] if c in df_map.columns), None)
+            cities = df_map[city_col].astype(str) if city_col else pd.Series('N/A', index=df_map.index)
+            cps = df_map['Sort Code'].astype(str) if 'Sort Code' in df_map.columns else ''
+            # Un seul calque canvas pour tous les points (coordonnées en un tableau compact)
+            PointLayer(df_map['lat'], df_map['lon'], labels=cities + " - " + cps).add_to(m)
         
         output = st_folium(m, width="100%", height=550, key="config_map")
         
@@ -255,10 +207,11 @@ with tab1:
                 if st.button(f"✅ Assigner cette zone à {selected_driver}", type="primary"):
                     if selected_driver and selected_driver != "Aucun chauffeur":
                         geometry = last_draw['geometry']
-                        patterns["drivers"][selected_driver]["zones"].append(geometry)
-                        save_patterns(patterns)
-                        st.success(f"Zone ajoutée pour {selected_driver}!")
-                        st.rerun()
+                        driver_data = edit_driver(selected_driver)
+                        driver_data.setdefault("zones", []).append(geometry)
+                        if save_drivers({selected_driver: driver_data}):
+                            st.success(f"Zone ajoutée pour {selected_driver}!")
+                            st.rerun()
 
 # === TAB 2: DISPATCH AUTOMATIQUE ===
 with tab2:
@@ -299,7 +252,7 @@ with tab2:
             
             if st.button("🚀 Lancer le dispatch automatique", type="primary", use_container_width=True):
                 with st.spinner("Dispatch en cours..."):
-                    results = auto_dispatch(df_with_coords, patterns)
+                    results = compiled_patterns.dispatch_zones(df_with_coords)
                 
                 st.markdown("### 📊 Résultats du dispatch")
                 
@@ -337,7 +290,7 @@ with tab2:
                 st.markdown("### 📥 Télécharger les fichiers")
                 
                 # Option 1: ZIP avec tous les fichiers
-                zip_data = create_zip_with_excels(results)
+                zip_data = create_zip_with_excels(results, prefix="Tournee_")
                 st.download_button(
                     label="📦 Télécharger TOUS les fichiers (ZIP)",
                     data=zip_data,
@@ -355,7 +308,7 @@ with tab2:
                         continue
                     
                     display_name = "Non assignés" if driver_name == "_NON_ASSIGNES" else driver_name
-                    excel_data = preparer_telechargement_excel(driver_df)
+                    excel_data = get_excel_bytes(driver_df)
                     
                     st.download_button(
                         label=f"📄 {display_name} ({len(driver_df)} colis)",
@@ -374,7 +327,7 @@ with st.sidebar:
         st.download_button(
             label="💾 Exporter la config",
             data=json.dumps(patterns, ensure_ascii=False, indent=2),
-            file_name="driver_patterns_backup.json",
+            file_name="driver_patterns_backup.json" if site == DEFAULT_SITE else f"driver_patterns_{site}_backup.json",
             mime="application/json",
             use_container_width=True
         )
@@ -386,12 +339,27 @@ with st.sidebar:
         try:
             imported = json.load(uploaded_patterns)
             if st.button("✅ Appliquer cette configuration"):
-                save_patterns(imported)
+                patterns_store.save(imported)
                 st.success("Configuration importée!")
                 st.rerun()
         except:
             st.error("Fichier JSON invalide")
     
+    # Création d'un site (configuration vide, sélectionnée à la réexécution)
+    st.markdown("---")
+    new_site = st.text_input("Nouveau site", placeholder="Ex: Epernay", key="new_site_name")
+    if st.button("🏢 Créer le site", use_container_width=True):
+        if new_site and new_site.strip():
+            try:
+                site_store = get_site_store(new_site.strip())
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                if new_site.strip() not in list_sites():
+                    site_store.save({"drivers": {}})
+                st.session_state["new_site"] = new_site.strip()
+                st.rerun()
+    
     # Infos
     st.markdown("---")
     st.markdown("### 📖 Guide")
@@ -1,330 +1,58 @@
 import streamlit as st
 import pandas as pd
 import folium
-from folium.plugins import Draw, FastMarkerCluster
+from folium.plugins import Draw
 from streamlit_folium import st_folium
 import json
-import os
-from datetime import datetime
-from data_processor import load_data, preparer_telechargement_excel
-from shapely.geometry import shape, Point
-import zipfile
 import io
-import unicodedata
-import re
+import hashlib
+import copy
+from datetime import datetime
+from data_processor import load_data
+from map_layers import PointLayer
+import dispatch_engine
+from dispatch_engine import create_zip_with_excels
+from patterns_store import DEFAULT_SITE, PatternsConflict, get_site_store, list_sites
 
 # Configuration
 st.set_page_config(layout="wide", page_title="Dispatch Auto - JNR Transport")
 
-PATTERNS_FILE = "driver_patterns.json"
-
 # === CACHE ET OPTIMISATIONS ===
 
 @st.cache_data
+def parse_file(file_content, file_name):
+    """Cache la lecture des fichiers (sans géocodage)."""
+    return dispatch_engine.parse_file(file_content, file_name)
+
 def load_and_process_file(file_content, file_name):
-    """Cache le chargement des fichiers."""
-    import io as io_module
-    
-    # Forcer la détection par extension
-    file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
-    
-    if file_ext in ['xlsx', 'xls']:
-        # Essayer plusieurs méthodes de lecture pour les fichiers Excel problématiques
-        df = None
-        
-        # Méthode 1: openpyxl avec data_only=True (ignore les formules, lit les valeurs)
-        try:
-            from openpyxl import load_workbook
-            wb = load_workbook(io_module.BytesIO(file_content), data_only=True, read_only=True)
-            ws = wb.active
-            
-            # Lire les données manuellement
-            data = []
-            headers = None
-            for i, row in enumerate(ws.iter_rows(values_only=True)):
-                if i == 0:
-                    # Vérifier si c'est une ligne d'en-tête valide ou une ligne vide
-                    if row[0] is None or str(row[0]).startswith('Unnamed'):
-                        continue
-                    headers = [str(c) if c else f'Col_{j}' for j, c in enumerate(row)]
-                else:
-                    if headers is None:
-                        headers = [str(c) if c else f'Col_{j}' for j, c in enumerate(row)]
-                    else:
-                        # Ignorer les lignes complètement vides
-                        if any(c is not None for c in row):
-                            data.append(row)
-            
-            wb.close()
-            
-            if headers and data:
-                df = pd.DataFrame(data, columns=headers)
-                # Convertir tout en string
-                df = df.astype(str)
-                df = df.replace('None', pd.NA)
-        except Exception as e:
-            df = None
-        
-        # Méthode 2: pandas standard si la méthode 1 échoue
-        if df is None or len(df) == 0:
-            try:
-                df_test = pd.read_excel(io_module.BytesIO(file_content), dtype=str, nrows=2, engine='openpyxl')
-                if df_test.columns[0].startswith('Unnamed'):
-                    df = pd.read_excel(io_module.BytesIO(file_content), dtype=str, skiprows=1, engine='openpyxl')
-                else:
-                    df = pd.read_excel(io_module.BytesIO(file_content), dtype=str, engine='openpyxl')
-            except:
-                df = pd.read_excel(io_module.BytesIO(file_content), dtype=str)
-    else:
-        # CSV
-        text = file_content.decode('utf-8', errors='ignore')
-        try:
-            df = pd.read_csv(io_module.StringIO(text), sep=None, engine='python', dtype=str, on_bad_lines='skip')
-        except:
-            df = pd.read_csv(io_module.StringIO(text), sep=',', dtype=str, on_bad_lines='skip')
-    
-    # === NORMALISER LES COLONNES ===
-    # Supprimer les colonnes vides (Col_XX)
-    df = df.loc[:, ~df.columns.str.match(r'^Col_\d+$')]
-    
-    # Normaliser "Receiver's Zip Code" -> "Sort Code" si absent
-    if 'Sort Code' not in df.columns and "Receiver's Zip Code" in df.columns:
-        df['Sort Code'] = df["Receiver's Zip Code"]
-    
-    # Nettoyer les codes postaux (enlever apostrophes et ajouter 0 manquant)
-    if 'Sort Code' in df.columns:
-        df['Sort Code'] = df['Sort Code'].astype(str).str.strip().str.lstrip("'").str.strip()
-        # Ajouter le 0 devant les codes postaux à 4 chiffres (ex: 2160 -> 02160)
-        df['Sort Code'] = df['Sort Code'].apply(lambda x: '0' + x if x.isdigit() and len(x) == 4 else x)
-    
-    # Parser GPS
-    def split_gps(val):
-        try:
-            if pd.isna(val) or ',' not in str(val): return None, None
-            lat, lon = str(val).replace('"', '').split(',')
-            return float(lat), float(lon)
-        except: return None, None
-    
-    gps_columns = ["Receiver to (Latitude,Longitude)", "GPS", "Coordinates", "LatLng"]
-    has_gps_column = False
-    for col in gps_columns:
-        if col in df.columns:
-            df[['lat', 'lon']] = df[col].apply(lambda x: pd.Series(split_gps(x)))
-            has_gps_column = True
-            break
-    
-    if 'lat' in df.columns:
-        df['lat'] = pd.to_numeric(df['lat'], errors='coerce')
-    if 'lon' in df.columns:
-        df['lon'] = pd.to_numeric(df['lon'], errors='coerce')
-    
-    # === GÉOCODAGE PAR CODE POSTAL si pas de GPS ===
-    if not has_gps_column or ('lat' in df.columns and df['lat'].isna().all()):
-        df = geocode_by_postal_code(df)
-    elif 'lat' in df.columns and df['lat'].isna().any():
-        # Géocoder seulement les colis sans GPS
-        mask_no_gps = df['lat'].isna()
-        if mask_no_gps.any():
-            df_no_gps = geocode_by_postal_code(df[mask_no_gps].copy())
-            df.loc[mask_no_gps, 'lat'] = df_no_gps['lat']
-            df.loc[mask_no_gps, 'lon'] = df_no_gps['lon']
-    
-    # === GÉOCODAGE INVERSE pour adresses censurées (******) ===
-    addr_col = None
-    for col in ["Receiver's Detail Address", "Receivers Detail Address", "Address"]:
-        if col in df.columns:
-            addr_col = col
-            break
-    
-    if addr_col and 'lat' in df.columns and 'lon' in df.columns:
-        # Détecter les adresses censurées (contiennent * ou sont vides)
-        mask_censored = df[addr_col].apply(lambda x: '*' in str(x) if pd.notna(x) else True)
-        mask_has_gps = df['lat'].notna() & df['lon'].notna()
-        mask_to_reverse = mask_censored & mask_has_gps
-        
-        if mask_to_reverse.any():
-            df = reverse_geocode_addresses(df, addr_col, mask_to_reverse)
-    
+    """Géocode le fichier lu ; le résultat n'est conservé en session que s'il est complet,
+    les colis en attente (API lente ou coupée) sont re-géocodés au prochain affichage."""
+    key = hashlib.sha1(file_content).hexdigest()
+    geocoded = st.session_state.setdefault("geocoded_files", {})
+    if key in geocoded:
+        return geocoded[key]
+    with st.spinner("Géocodage des colis..."):
+        df = dispatch_engine.geocode_dataframe(parse_file(file_content, file_name).copy())
+    if not df['geocode_pending'].any():
+        # Fichier de référence et fichier à dispatcher : deux entrées suffisent
+        while len(geocoded) >= 2:
+            geocoded.pop(next(iter(geocoded)))
+        geocoded[key] = df
     return df
 
-
-def reverse_geocode_addresses(df, addr_col, mask):
-    """Récupère les adresses réelles à partir des coordonnées GPS."""
-    import urllib.request
-    import urllib.parse
-    
-    # Cache pour éviter les appels dupliqués (même coordonnées)
-    reverse_cache = {}
-    
-    # Collecter les coordonnées uniques
-    coords_to_lookup = []
-    for idx in df[mask].index:
-        lat = df.at[idx, 'lat']
-        lon = df.at[idx, 'lon']
-        if pd.notna(lat) and pd.notna(lon):
-            coords_to_lookup.append((idx, round(float(lat), 6), round(float(lon), 6)))
-    
-    # Géocoder par batch (limiter les appels API)
-    for idx, lat, lon in coords_to_lookup:
-        cache_key = f"{lat}_{lon}"
-        
-        if cache_key not in reverse_cache:
-            try:
-                params = urllib.parse.urlencode({
-                    'lat': lat,
-                    'lon': lon
-                })
-                url = f"https://api-adresse.data.gouv.fr/reverse/?{params}"
-                
-                req = urllib.request.Request(url, headers={'User-Agent': 'JNR-Dispatch/1.0'})
-                with urllib.request.urlopen(req, timeout=5) as response:
-                    result = json.loads(response.read().decode())
-                    
-                    if result.get('features'):
-                        props = result['features'][0]['properties']
-                        reverse_cache[cache_key] = {
-                            'address': props.get('name', ''),
-                            'city': props.get('city', ''),
-                            'postcode': props.get('postcode', ''),
-                            'label': props.get('label', '')
-                        }
-                    else:
-                        reverse_cache[cache_key] = None
-            except:
-                reverse_cache[cache_key] = None
-        
-        # Appliquer l'adresse trouvée
-        if reverse_cache.get(cache_key):
-            addr_info = reverse_cache[cache_key]
-            df.at[idx, addr_col] = addr_info['address']
-            
-            # Mettre à jour la ville si elle est aussi censurée
-            for city_col in ["Receiver's City", "Receivers City"]:
-                if city_col in df.columns:
-                    current_city = str(df.at[idx, city_col])
-                    if '*' in current_city or pd.isna(df.at[idx, city_col]):
-                        df.at[idx, city_col] = addr_info['city']
-                    break
-    
-    return df
+def get_background_geocoding(file_content, file_name):
+    """Géocodage en tâche de fond du fichier à dispatcher (un par fichier et par session)."""
+    key = hashlib.sha1(file_content).hexdigest()
+    jobs = st.session_state.setdefault("geocoding_jobs", {})
+    if key not in jobs:
+        while len(jobs) >= 2:
+            jobs.pop(next(iter(jobs)))
+        jobs[key] = dispatch_engine.BackgroundGeocoding(parse_file(file_content, file_name))
+    return key, jobs[key]
 
 
-def geocode_by_postal_code(df):
-    """Géocode les colis par code postal + ville."""
-    if 'Sort Code' not in df.columns:
-        return df
-    
-    if 'lat' not in df.columns:
-        df['lat'] = pd.NA
-    if 'lon' not in df.columns:
-        df['lon'] = pd.NA
-    
-    # Trouver la colonne ville
-    city_col = None
-    for col in ["Receiver's City", "Receivers City", "City", "Receiver's Region/Province"]:
-        if col in df.columns:
-            city_col = col
-            break
-    
-    # Construire les requêtes uniques (CP + Ville)
-    geocode_cache = {}
-    
-    unique_locations = set()
-    for _, row in df.iterrows():
-        cp = str(row.get('Sort Code', '')).strip()
-        city = str(row.get(city_col, '')).strip() if city_col else ''
-        if cp and cp != 'nan':
-            unique_locations.add((cp, city))
-    
-    # Géocoder via l'API BAN (Base Adresse Nationale)
-    import urllib.request
-    import urllib.parse
-    
-    for cp, city in unique_locations:
-        cache_key = f"{cp}_{city}"
-        if cache_key in geocode_cache:
-            continue
-        
-        try:
-            query = f"{city}" if city and city != 'nan' else cp
-            params = urllib.parse.urlencode({
-                'q': query,
-                'postcode': cp,
-                'limit': 1
-            })
-            url = f"https://api-adresse.data.gouv.fr/search/?{params}"
-            
-            req = urllib.request.Request(url, headers={'User-Agent': 'JNR-Dispatch/1.0'})
-            with urllib.request.urlopen(req, timeout=5) as response:
-                result = json.loads(response.read().decode())
-                
-                if result.get('features'):
-                    coords = result['features'][0]['geometry']['coordinates']
-                    geocode_cache[cache_key] = (coords[1], coords[0])
-                else:
-                    geocode_cache[cache_key] = (None, None)
-        except:
-            geocode_cache[cache_key] = (None, None)
-    
-    # Appliquer les coordonnées
-    for idx, row in df.iterrows():
-        if pd.notna(row.get('lat')) and pd.notna(row.get('lon')):
-            continue
-        
-        cp = str(row.get('Sort Code', '')).strip()
-        city = str(row.get(city_col, '')).strip() if city_col else ''
-        cache_key = f"{cp}_{city}"
-        
-        if cache_key in geocode_cache:
-            lat, lon = geocode_cache[cache_key]
-            if lat is not None:
-                df.at[idx, 'lat'] = lat
-                df.at[idx, 'lon'] = lon
-    
-    # Vérifier combien ont été géocodés
-    geocoded = df['lat'].notna().sum()
-    total = len(df)
-    if geocoded < total:
-        # Fallback: utiliser les coordonnées du centre du code postal
-        cp_centers = {}
-        for idx, row in df.iterrows():
-            if pd.notna(row.get('lat')):
-                cp = str(row.get('Sort Code', '')).strip()
-                if cp not in cp_centers:
-                    cp_centers[cp] = []
-                cp_centers[cp].append((float(row['lat']), float(row['lon'])))
-        
-        # Calculer les centres
-        for cp, coords in cp_centers.items():
-            avg_lat = sum(c[0] for c in coords) / len(coords)
-            avg_lon = sum(c[1] for c in coords) / len(coords)
-            cp_centers[cp] = (avg_lat, avg_lon)
-        
-        # Appliquer aux colis restants
-        for idx, row in df.iterrows():
-            if pd.isna(row.get('lat')):
-                cp = str(row.get('Sort Code', '')).strip()
-                if cp in cp_centers:
-                    df.at[idx, 'lat'] = cp_centers[cp][0]
-                    df.at[idx, 'lon'] = cp_centers[cp][1]
-    
-    return df
-
 # === FONCTIONS UTILITAIRES ===
 
-def load_patterns():
-    """Charge les patterns sauvegardés depuis le fichier JSON."""
-    if os.path.exists(PATTERNS_FILE):
-        with open(PATTERNS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"drivers": {}, "updated_at": None}
-
-def save_patterns(patterns):
-    """Sauvegarde les patterns dans le fichier JSON."""
-    patterns["updated_at"] = datetime.now().isoformat()
-    with open(PATTERNS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(patterns, f, ensure_ascii=False, indent=2)
-
 def get_driver_color(index):
     """Retourne une couleur unique pour chaque chauffeur."""
     colors = [
@@ -334,174 +62,6 @@ def get_driver_color(index):
     ]
     return colors[index % len(colors)]
 
-def normalize_text(text):
-    """Normalise le texte pour comparaison (accents, casse, tirets, espaces)."""
-    if not text or pd.isna(text):
-        return ""
-    text = str(text).lower().strip()
-    text = unicodedata.normalize('NFD', text)
-    text = ''.join(c for c in text if unicodedata.category(c) != 'Mn')
-    text = re.sub(r'[-_\s]+', ' ', text)
-    text = re.sub(r'[^a-z0-9\s]', '', text)
-    return text.strip()
-
-def levenshtein_distance(s1, s2):
-    """Calcule la distance de Levenshtein entre deux chaînes."""
-    if len(s1) < len(s2):
-        return levenshtein_distance(s2, s1)
-    if len(s2) == 0:
-        return len(s1)
-    
-    previous_row = range(len(s2) + 1)
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
-    
-    return previous_row[-1]
-
-def fuzzy_match_city(city_input, city_list, max_distance=2):
-    """Vérifie si une ville correspond à la liste avec tolérance aux fautes."""
-    if not city_list:
-        return False
-    if city_input is None or pd.isna(city_input) or str(city_input).strip() == '':
-        return False
-    
-    normalized_input = normalize_text(city_input)
-    if not normalized_input:
-        return False
-    
-    for city in city_list:
-        normalized_city = normalize_text(city)
-        if not normalized_city:
-            continue
-        
-        if normalized_input == normalized_city:
-            return True
-        
-        if normalized_input in normalized_city or normalized_city in normalized_input:
-            return True
-        
-        tolerance = min(max_distance, max(1, len(normalized_city) // 4))
-        if levenshtein_distance(normalized_input, normalized_city) <= tolerance:
-            return True
-    
-    return False
-
-def match_postal_code(sort_code, postal_codes):
-    """Vérifie si un code postal correspond à la liste assignée."""
-    if not postal_codes:
-        return False
-    if sort_code is None or pd.isna(sort_code) or str(sort_code).strip() == '':
-        return False
-    
-    # Nettoyer le code postal (enlever apostrophes, espaces, leading zeros)
-    sort_code_str = str(sort_code).strip().lstrip("'").strip()
-    sort_code_clean = sort_code_str.lstrip('0') if sort_code_str.startswith('0') else sort_code_str
-    
-    for cp in postal_codes:
-        cp_str = str(cp).strip().lstrip("'").strip()
-        cp_clean = cp_str.lstrip('0') if cp_str.startswith('0') else cp_str
-        
-        # Match exact
-        if sort_code_str == cp_str or sort_code_clean == cp_clean:
-            return True
-        
-        # Match par préfixe (ex: "51" matche "51100", "51200", etc.)
-        if len(cp_str) < 5 and (sort_code_str.startswith(cp_str) or sort_code_clean.startswith(cp_clean)):
-            return True
-    
-    return False
-
-def point_in_zones(lat, lon, zones):
-    """Vérifie si un point est dans une des zones géographiques."""
-    if not zones:
-        return False
-    point = Point(lon, lat)
-    for zone in zones:
-        try:
-            polygon = shape(zone)
-            if polygon.contains(point):
-                return True
-        except:
-            continue
-    return False
-
-def match_driver(row, driver_data):
-    """Vérifie si un colis correspond aux critères d'un chauffeur."""
-    # 1. Vérifier les codes postaux
-    postal_codes = driver_data.get("postal_codes", [])
-    sort_code = row.get('Sort Code', '')
-    if match_postal_code(sort_code, postal_codes):
-        return True
-    
-    # 2. Vérifier les villes
-    cities = driver_data.get("cities", [])
-    city_columns = ["Receiver's City", "Receivers City", "City", "Ville", "Receiver's Region/Province"]
-    for col in city_columns:
-        if col in row.index:
-            city_value = row.get(col, '')
-            if fuzzy_match_city(city_value, cities):
-                return True
-    
-    # 3. Vérifier les zones géographiques (si coordonnées disponibles)
-    zones = driver_data.get("zones", [])
-    lat = row.get('lat')
-    lon = row.get('lon')
-    if pd.notna(lat) and pd.notna(lon) and zones:
-        if point_in_zones(float(lat), float(lon), zones):
-            return True
-    
-    return False
-
-def auto_dispatch(df, patterns):
-    """Dispatch automatique basé sur les patterns sauvegardés."""
-    results = {}
-    assigned_indices = set()
-    
-    for driver_name, driver_data in patterns.get("drivers", {}).items():
-        has_criteria = (
-            driver_data.get("zones", []) or 
-            driver_data.get("postal_codes", []) or 
-            driver_data.get("cities", [])
-        )
-        if not has_criteria:
-            continue
-        
-        mask = df.apply(lambda row: match_driver(row, driver_data), axis=1)
-        driver_df = df[mask]
-        driver_df = driver_df[~driver_df.index.isin(assigned_indices)]
-        
-        if not driver_df.empty:
-            results[driver_name] = driver_df
-            assigned_indices.update(driver_df.index.tolist())
-    
-    unassigned = df[~df.index.isin(assigned_indices)]
-    if not unassigned.empty:
-        results["_NON_ASSIGNES"] = unassigned
-    
-    return results
-
-def create_zip_with_excels(dispatch_results):
-    """Crée un ZIP contenant tous les fichiers Excel."""
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for driver_name, driver_df in dispatch_results.items():
-            if driver_df.empty:
-                continue
-            excel_data = preparer_telechargement_excel(driver_df)
-            safe_name = driver_name.replace(" ", "_").replace("/", "-")
-            filename = f"{safe_name}.xlsx"
-            zip_file.writestr(filename, excel_data)
-    
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
-
 def get_driver_summary(driver_data):
     """Génère un résumé des critères d'un chauffeur."""
     parts = []
@@ -520,11 +80,151 @@ def get_driver_summary(driver_data):
     
     return " | ".join(parts) if parts else "Aucun critère"
 
+def show_dispatch_results(job_key, job, compiled, polling):
+    """Résultats du dispatch, mis à jour au fil du géocodage en tâche de fond : seuls les
+    colis géocodés depuis le dernier affichage sont réassignés."""
+    if polling and job.done:
+        # Géocodage terminé : dernier affichage complet, sans rafraîchissement
+        st.rerun()
+    
+    patterns = compiled.patterns
+    df, revision = job.snapshot()
+    state = st.session_state.get("dispatch_state")
+    if not state or state["job"] != job_key or state["version"] != compiled.version:
+        with st.spinner("Dispatch en cours..."):
+            results = compiled.dispatch(df)
+        state = st.session_state["dispatch_state"] = {
+            "job": job_key, "version": compiled.version, "revision": revision, "results": results,
+        }
+    elif state["revision"] < revision:
+        state["results"] = compiled.redispatch(state["results"], df, job.changed_rows(state["revision"]))
+        state["revision"] = revision
+    results = state["results"]
+    
+    if not job.done:
+        st.info(f"⏳ Géocodage en cours : **{job.pending}** colis en attente, les résultats se mettent à jour automatiquement")
+    elif job.pending:
+        st.warning(
+            f"⏳ {job.pending} colis n'ont pas pu être géocodés (API Adresse lente ou indisponible) : "
+            "ils sont dispatchés par code postal/ville."
+        )
+    
+    st.markdown("### 📊 Résultats du dispatch")
+    
+    matched_by_counts = results.assignment['matched_by'].value_counts()
+    st.caption(
+        f"Critères utilisés : {matched_by_counts.get('code_postal', 0)} par code postal, "
+        f"{matched_by_counts.get('ville', 0)} par ville, {matched_by_counts.get('zone', 0)} par zone"
+    )
+    
+    cols = st.columns(3)
+    col_idx = 0
+    
+    total_assigned = 0
+    for driver_name, driver_df in results.items():
+        if driver_name == "_NON_ASSIGNES":
+            continue
+        
+        with cols[col_idx % 3]:
+            color = patterns["drivers"].get(driver_name, {}).get("color", "#666")
+            st.markdown(f"""
+                <div style="padding:15px; background:white; border-radius:8px; border-left:5px solid {color}; margin-bottom:10px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
+                    <h4 style="margin:0; color:{color};">{driver_name}</h4>
+                    <p style="font-size:24px; font-weight:bold; margin:5px 0;">{len(driver_df)} colis</p>
+                </div>
+            """, unsafe_allow_html=True)
+            total_assigned += len(driver_df)
+        col_idx += 1
+    
+    if "_NON_ASSIGNES" in results:
+        unassigned = results["_NON_ASSIGNES"]
+        st.warning(f"⚠️ **{len(unassigned)}** colis non assignés")
+        
+        with st.expander("Voir les colis non assignés"):
+            display_cols = [c for c in ["Tracking No.", "Sort Code", "Receiver's City", "Receiver's Detail Address"] if c in unassigned.columns]
+            if display_cols:
+                st.dataframe(unassigned[display_cols].head(100))
+            else:
+                st.dataframe(unassigned.head(100))
+    
+    st.markdown("---")
+    st.markdown("### 📥 Télécharger les fichiers")
+    
+    if state.get("zip_revision") != state["revision"]:
+        state["zip"] = create_zip_with_excels(results)
+        state["zip_revision"] = state["revision"]
+    st.download_button(
+        label="📦 Télécharger TOUS les fichiers (ZIP)",
+        data=state["zip"],
+        file_name=f"Dispatch_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+        mime="application/zip",
+        use_container_width=True
+    )
+    
+    st.markdown("---")
+    st.markdown("**Ou télécharger individuellement:**")
+    
+    dl_cols = st.columns(3)
+    dl_idx = 0
+    for driver_name, driver_df in results.items():
+        if driver_df.empty:
+            continue
+        
+        with dl_cols[dl_idx % 3]:
+            display_name = "Non assignés" if driver_name == "_NON_ASSIGNES" else driver_name
+            excel_data = dispatch_engine.get_excel_bytes(driver_df)
+            
+            st.download_button(
+                label=f"📄 {display_name} ({len(driver_df)})",
+                data=excel_data,
+                file_name=f"{driver_name.replace(' ', '_')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"dl_{driver_name}"
+            )
+        dl_idx += 1
+
+
 # === INTERFACE ===
 
 st.title("🚚 Dispatch Automatique - JNR Transport")
 
-patterns = load_patterns()
+# Site (dépôt, client) : chaque site a sa propre configuration, compilée à la première utilisation
+if "new_site" in st.session_state:
+    st.session_state["site"] = st.session_state.pop("new_site")
+site = st.sidebar.selectbox(
+    "🏢 Site",
+    options=list_sites(),
+    format_func=lambda s: "Site principal" if s == DEFAULT_SITE else s,
+    key="site"
+)
+
+# Configuration compilée partagée par toutes les sessions (relue seulement si le fichier change)
+patterns_store = get_site_store(site)
+compiled_patterns = patterns_store.get()
+patterns = compiled_patterns.patterns
+
+# Révision affichée à l'exécution précédente : celle que l'utilisateur a vue avant de
+# cliquer (la version relue ci-dessus contient déjà les modifications des autres)
+rendered_revisions = st.session_state.setdefault("rendered_revision", {})
+seen_revision = rendered_revisions.get(site, compiled_patterns.revision)
+rendered_revisions[site] = compiled_patterns.revision
+
+
+def edit_driver(driver_name):
+    """Copie modifiable d'un chauffeur (la configuration compilée est partagée)."""
+    return copy.deepcopy(patterns.get("drivers", {}).get(driver_name, {}))
+
+
+def save_drivers(changes):
+    """Enregistre les chauffeurs modifiés ({nom: données}, None pour supprimer).
+    Refusé si un autre utilisateur les a modifiés depuis l'affichage de la page."""
+    try:
+        patterns_store.update_drivers(changes, expected_revision=seen_revision)
+    except PatternsConflict as e:
+        st.error(f"⚠️ Modification non enregistrée ({e}). Rechargez la page et recommencez.")
+        return False
+    return True
+
 
 tab1, tab2, tab3 = st.tabs(["📍 Zones Géographiques", "🏘️ Codes Postaux & Villes", "⚡ Dispatch Automatique"])
 
@@ -598,17 +298,15 @@ with tab1:
                 if new_driver and new_driver.strip():
                     driver_name = new_driver.strip()
                     if driver_name not in patterns.get("drivers", {}):
-                        if "drivers" not in patterns:
-                            patterns["drivers"] = {}
-                        patterns["drivers"][driver_name] = {
+                        new_data = {
                             "zones": [], 
                             "postal_codes": [],
                             "cities": [],
                             "color": get_driver_color(len(patterns["drivers"]))
                         }
-                        save_patterns(patterns)
-                        st.success(f"✅ {driver_name} ajouté!")
-                        st.rerun()
+                        if save_drivers({driver_name: new_data}):
+                            st.success(f"✅ {driver_name} ajouté!")
+                            st.rerun()
                     else:
                         st.warning("Ce chauffeur existe déjà")
             
@@ -639,16 +337,16 @@ with tab1:
                 zones_count = len(patterns["drivers"].get(selected_driver, {}).get("zones", []))
                 if zones_count > 0:
                     if st.button(f"🗑️ Supprimer les {zones_count} zone(s)", use_container_width=True):
-                        patterns["drivers"][selected_driver]["zones"] = []
-                        save_patterns(patterns)
-                        st.success("Zones supprimées!")
-                        st.rerun()
+                        driver_data = edit_driver(selected_driver)
+                        driver_data["zones"] = []
+                        if save_drivers({selected_driver: driver_data}):
+                            st.success("Zones supprimées!")
+                            st.rerun()
                 
                 if st.button("❌ Supprimer le chauffeur", use_container_width=True, key="del_driver_tab1"):
-                    del patterns["drivers"][selected_driver]
-                    save_patterns(patterns)
-                    st.success("Chauffeur supprimé!")
-                    st.rerun()
+                    if save_drivers({selected_driver: None}):
+                        st.success("Chauffeur supprimé!")
+                        st.rerun()
         
         with col_left:
             center_lat, center_lon = 49.25, 4.03
@@ -690,34 +388,11 @@ with tab1:
             if show_points and not df_map.empty:
                 df_sampled = df_map.iloc[::sample_rate]
                 
+                # Un seul calque canvas pour tous les points (coordonnées en un tableau compact)
+                PointLayer(df_sampled['lat'], df_sampled['lon'], radius=4, fill_opacity=0.7).add_to(m)
                 if sample_rate == 1:
-                    # Mode 1/1 : afficher tous les points individuellement (sans clustering)
-                    for _, row in df_sampled.iterrows():
-                        folium.CircleMarker(
-                            location=[row['lat'], row['lon']],
-                            radius=5,
-                            color='#333',
-                            fill=True,
-                            fillColor='#333',
-                            fillOpacity=0.7,
-                            weight=1
-                        ).add_to(m)
                     st.caption(f"📍 {len(df_map)} points affichés")
                 else:
-                    # Mode échantillonné : utiliser le clustering pour la performance
-                    callback = """
-                    function (row) {
-                        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
-                            radius: 4,
-                            color: '#333',
-                            fillColor: '#333',
-                            fillOpacity: 0.6
-                        });
-                        return marker;
-                    }
-                    """
-                    points_data = df_sampled[['lat', 'lon']].values.tolist()
-                    FastMarkerCluster(data=points_data, callback=callback).add_to(m)
                     st.caption(f"📍 {len(df_sampled)}/{len(df_map)} points affichés (1 sur {sample_rate})")
             
             output = st_folium(m, width="100%", height=500, key="config_map", returned_objects=["all_drawings"])
@@ -730,12 +405,11 @@ with tab1:
                     if st.button(f"✅ Assigner cette zone à {selected_driver}", type="primary"):
                         if selected_driver and selected_driver != "Aucun chauffeur":
                             geometry = last_draw['geometry']
-                            if "zones" not in patterns["drivers"][selected_driver]:
-                                patterns["drivers"][selected_driver]["zones"] = []
-                            patterns["drivers"][selected_driver]["zones"].append(geometry)
-                            save_patterns(patterns)
-                            st.success(f"Zone ajoutée pour {selected_driver}!")
-                            st.rerun()
+                            driver_data = edit_driver(selected_driver)
+                            driver_data.setdefault("zones", []).append(geometry)
+                            if save_drivers({selected_driver: driver_data}):
+                                st.success(f"Zone ajoutée pour {selected_driver}!")
+                                st.rerun()
     
     # === SOUS-TAB 2: GÉRER LES ZONES ===
     with subtab2:
@@ -746,6 +420,7 @@ with tab1:
         if total_zones == 0:
             st.info("Aucune zone définie. Allez dans l'onglet 'Dessiner des zones' pour en créer.")
         else:
+            overlaps = compiled_patterns.overlaps()
             col_manage_left, col_manage_right = st.columns([3, 1])
             
             with col_manage_right:
@@ -783,22 +458,39 @@ with tab1:
                             )
                             
                             if st.button(f"↔️ Réassigner à {reassign_to}", use_container_width=True):
-                                zone_to_move = patterns["drivers"][selected_manage_driver]["zones"][selected_zone_idx]
-                                patterns["drivers"][selected_manage_driver]["zones"].pop(selected_zone_idx)
-                                if "zones" not in patterns["drivers"][reassign_to]:
-                                    patterns["drivers"][reassign_to]["zones"] = []
-                                patterns["drivers"][reassign_to]["zones"].append(zone_to_move)
-                                save_patterns(patterns)
-                                st.success(f"Zone réassignée à {reassign_to}!")
-                                st.rerun()
+                                source_data = edit_driver(selected_manage_driver)
+                                target_data = edit_driver(reassign_to)
+                                zone_to_move = source_data["zones"].pop(selected_zone_idx)
+                                target_data.setdefault("zones", []).append(zone_to_move)
+                                # Les deux chauffeurs sont enregistrés ensemble (jamais de zone perdue ou en double)
+                                if save_drivers({selected_manage_driver: source_data, reassign_to: target_data}):
+                                    st.success(f"Zone réassignée à {reassign_to}!")
+                                    st.rerun()
                         
                         st.markdown("---")
                         
                         if st.button("🗑️ Supprimer cette zone", use_container_width=True, type="secondary"):
-                            patterns["drivers"][selected_manage_driver]["zones"].pop(selected_zone_idx)
-                            save_patterns(patterns)
-                            st.success("Zone supprimée!")
-                            st.rerun()
+                            driver_data = edit_driver(selected_manage_driver)
+                            driver_data["zones"].pop(selected_zone_idx)
+                            if save_drivers({selected_manage_driver: driver_data}):
+                                st.success("Zone supprimée!")
+                                st.rerun()
+                
+                st.markdown("---")
+                st.markdown("#### ⚠️ Chevauchements")
+                if overlaps:
+                    st.caption("Zones communes à deux chauffeurs (en rouge sur la carte) : le prioritaire reçoit les colis.")
+                    st.dataframe(
+                        pd.DataFrame([{
+                            "Prioritaire": o["prioritaire"],
+                            "Chauffeur": o["chauffeur"],
+                            "Surface (ha)": round(o["surface_m2"] / 10000, 2)
+                        } for o in overlaps]),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                else:
+                    st.caption("Aucun chevauchement entre chauffeurs")
             
             with col_manage_left:
                 center_lat, center_lon = 49.25, 4.03
@@ -819,6 +511,19 @@ with tab1:
                             tooltip=f"{driver} - Zone {idx+1}"
                         ).add_to(m_manage)
                 
+                for overlap in overlaps:
+                    folium.GeoJson(
+                        overlap["geometry"],
+                        style_function=lambda x: {
+                            'fillColor': '#ff0000',
+                            'color': '#ff0000',
+                            'weight': 2,
+                            'dashArray': '5, 5',
+                            'fillOpacity': 0.5
+                        },
+                        tooltip=f"⚠️ {overlap['prioritaire']} / {overlap['chauffeur']} (prioritaire : {overlap['prioritaire']})"
+                    ).add_to(m_manage)
+                
                 st_folium(m_manage, width="100%", height=500, key="manage_map")
 
 # === TAB 2: CODES POSTAUX & VILLES ===
@@ -836,17 +541,15 @@ with tab2:
             if new_driver2 and new_driver2.strip():
                 driver_name = new_driver2.strip()
                 if driver_name not in patterns.get("drivers", {}):
-                    if "drivers" not in patterns:
-                        patterns["drivers"] = {}
-                    patterns["drivers"][driver_name] = {
+                    new_data = {
                         "zones": [], 
                         "postal_codes": [],
                         "cities": [],
                         "color": get_driver_color(len(patterns["drivers"]))
                     }
-                    save_patterns(patterns)
-                    st.success(f"✅ {driver_name} ajouté!")
-                    st.rerun()
+                    if save_drivers({driver_name: new_data}):
+                        st.success(f"✅ {driver_name} ajouté!")
+                        st.rerun()
         
         st.markdown("---")
         
@@ -884,20 +587,21 @@ with tab2:
                 if st.button("➕ Ajouter CP", key=f"add_cp_{selected_driver2}"):
                     if cp_input:
                         new_cps = [cp.strip().lstrip("'") for cp in cp_input.split(",") if cp.strip()]
-                        if "postal_codes" not in patterns["drivers"][selected_driver2]:
-                            patterns["drivers"][selected_driver2]["postal_codes"] = []
+                        driver_data = edit_driver(selected_driver2)
+                        values = driver_data.setdefault("postal_codes", [])
                         for cp in new_cps:
-                            if cp not in patterns["drivers"][selected_driver2]["postal_codes"]:
-                                patterns["drivers"][selected_driver2]["postal_codes"].append(cp)
-                        save_patterns(patterns)
-                        st.success(f"Codes postaux ajoutés!")
-                        st.rerun()
+                            if cp not in values:
+                                values.append(cp)
+                        if save_drivers({selected_driver2: driver_data}):
+                            st.success(f"Codes postaux ajoutés!")
+                            st.rerun()
             
             if current_cp:
                 if st.button("🗑️ Effacer tous les CP", key=f"clear_cp_{selected_driver2}"):
-                    patterns["drivers"][selected_driver2]["postal_codes"] = []
-                    save_patterns(patterns)
-                    st.rerun()
+                    driver_data = edit_driver(selected_driver2)
+                    driver_data["postal_codes"] = []
+                    if save_drivers({selected_driver2: driver_data}):
+                        st.rerun()
             
             st.markdown("---")
             
@@ -924,20 +628,21 @@ with tab2:
                 if st.button("➕ Ajouter Villes", key=f"add_cities_{selected_driver2}"):
                     if cities_input:
                         new_cities = [c.strip() for c in cities_input.split(",") if c.strip()]
-                        if "cities" not in patterns["drivers"][selected_driver2]:
-                            patterns["drivers"][selected_driver2]["cities"] = []
+                        driver_data = edit_driver(selected_driver2)
+                        values = driver_data.setdefault("cities", [])
                         for city in new_cities:
-                            if city not in patterns["drivers"][selected_driver2]["cities"]:
-                                patterns["drivers"][selected_driver2]["cities"].append(city)
-                        save_patterns(patterns)
-                        st.success(f"Villes ajoutées!")
-                        st.rerun()
+                            if city not in values:
+                                values.append(city)
+                        if save_drivers({selected_driver2: driver_data}):
+                            st.success(f"Villes ajoutées!")
+                            st.rerun()
             
             if current_cities:
                 if st.button("🗑️ Effacer toutes les villes", key=f"clear_cities_{selected_driver2}"):
-                    patterns["drivers"][selected_driver2]["cities"] = []
-                    save_patterns(patterns)
-                    st.rerun()
+                    driver_data = edit_driver(selected_driver2)
+                    driver_data["cities"] = []
+                    if save_drivers({selected_driver2: driver_data}):
+                        st.rerun()
             
             st.markdown("---")
             
@@ -978,9 +683,38 @@ with tab3:
         key="dispatch_file"
     )
     
-    if uploaded_dispatch and total_criteria > 0:
+    low_memory = st.checkbox(
+        "💾 Mode économie mémoire (gros fichiers)",
+        value=False,
+        help="Traite le fichier par blocs de lignes : seul le ZIP est proposé au téléchargement",
+        key="low_memory_mode"
+    )
+    
+    if uploaded_dispatch and total_criteria > 0 and low_memory:
+        if st.button("🚀 Lancer le dispatch automatique", type="primary", use_container_width=True, key="run_streaming"):
+            zip_buffer = io.BytesIO()
+            with st.spinner("Dispatch par blocs en cours..."):
+                counts = dispatch_engine.dispatch_streaming(
+                    uploaded_dispatch.getvalue(), uploaded_dispatch.name, compiled_patterns, zip_buffer
+                )
+            
+            st.markdown("### 📊 Résultats du dispatch")
+            unassigned_count = counts.pop("_NON_ASSIGNES", 0)
+            st.info(f"📦 **{sum(counts.values()) + unassigned_count}** colis dispatchés, **{unassigned_count}** non assignés")
+            st.dataframe(pd.DataFrame({"Chauffeur": list(counts), "Colis": list(counts.values())}), hide_index=True)
+            
+            st.download_button(
+                label="📦 Télécharger TOUS les fichiers (ZIP)",
+                data=zip_buffer.getvalue(),
+                file_name=f"Dispatch_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
+                mime="application/zip",
+                use_container_width=True
+            )
+    
+    elif uploaded_dispatch and total_criteria > 0:
         file_content = uploaded_dispatch.getvalue()
-        df_dispatch = load_and_process_file(file_content, uploaded_dispatch.name)
+        job_key, job = get_background_geocoding(file_content, uploaded_dispatch.name)
+        df_dispatch = job.df
         
         has_gps = 'lat' in df_dispatch.columns and df_dispatch['lat'].notna().any()
         has_city = "Receiver's City" in df_dispatch.columns or "Receivers City" in df_dispatch.columns
@@ -994,74 +728,11 @@ with tab3:
         """)
         
         if st.button("🚀 Lancer le dispatch automatique", type="primary", use_container_width=True):
-            with st.spinner("Dispatch en cours..."):
-                results = auto_dispatch(df_dispatch, patterns)
-            
-            st.markdown("### 📊 Résultats du dispatch")
-            
-            cols = st.columns(3)
-            col_idx = 0
-            
-            total_assigned = 0
-            for driver_name, driver_df in results.items():
-                if driver_name == "_NON_ASSIGNES":
-                    continue
-                
-                with cols[col_idx % 3]:
-                    color = patterns["drivers"].get(driver_name, {}).get("color", "#666")
-                    st.markdown(f"""
-                        <div style="padding:15px; background:white; border-radius:8px; border-left:5px solid {color}; margin-bottom:10px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-                            <h4 style="margin:0; color:{color};">{driver_name}</h4>
-                            <p style="font-size:24px; font-weight:bold; margin:5px 0;">{len(driver_df)} colis</p>
-                        </div>
-                    """, unsafe_allow_html=True)
-                    total_assigned += len(driver_df)
-                col_idx += 1
-            
-            if "_NON_ASSIGNES" in results:
-                unassigned = results["_NON_ASSIGNES"]
-                st.warning(f"⚠️ **{len(unassigned)}** colis non assignés")
-                
-                with st.expander("Voir les colis non assignés"):
-                    display_cols = [c for c in ["Tracking No.", "Sort Code", "Receiver's City", "Receiver's Detail Address"] if c in unassigned.columns]
-                    if display_cols:
-                        st.dataframe(unassigned[display_cols].head(100))
-                    else:
-                        st.dataframe(unassigned.head(100))
-            
-            st.markdown("---")
-            st.markdown("### 📥 Télécharger les fichiers")
-            
-            zip_data = create_zip_with_excels(results)
-            st.download_button(
-                label="📦 Télécharger TOUS les fichiers (ZIP)",
-                data=zip_data,
-                file_name=f"Dispatch_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
-                mime="application/zip",
-                use_container_width=True
-            )
-            
-            st.markdown("---")
-            st.markdown("**Ou télécharger individuellement:**")
-            
-            dl_cols = st.columns(3)
-            dl_idx = 0
-            for driver_name, driver_df in results.items():
-                if driver_df.empty:
-                    continue
-                
-                with dl_cols[dl_idx % 3]:
-                    display_name = "Non assignés" if driver_name == "_NON_ASSIGNES" else driver_name
-                    excel_data = preparer_telechargement_excel(driver_df)
-                    
-                    st.download_button(
-                        label=f"📄 {display_name} ({len(driver_df)})",
-                        data=excel_data,
-                        file_name=f"{driver_name.replace(' ', '_')}.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key=f"dl_{driver_name}"
-                    )
-                dl_idx += 1
+            st.session_state["dispatch_job"] = job_key
+        
+        if st.session_state.get("dispatch_job") == job_key:
+            # Rafraîchi toutes les 2 s tant que le géocodage en tâche de fond continue
+            st.fragment(show_dispatch_results, run_every=None if job.done else 2)(job_key, job, compiled_patterns, not job.done)
 
 # === SIDEBAR ===
 with st.sidebar:
@@ -1071,7 +742,7 @@ with st.sidebar:
         st.download_button(
             label="💾 Exporter la config",
             data=json.dumps(patterns, ensure_ascii=False, indent=2),
-            file_name="driver_patterns_backup.json",
+            file_name="driver_patterns_backup.json" if site == DEFAULT_SITE else f"driver_patterns_{site}_backup.json",
             mime="application/json",
             use_container_width=True
         )
@@ -1082,12 +753,26 @@ with st.sidebar:
         try:
             imported = json.load(uploaded_patterns)
             if st.button("✅ Appliquer cette configuration"):
-                save_patterns(imported)
+                patterns_store.save(imported)
                 st.success("Configuration importée!")
                 st.rerun()
         except:
             st.error("Fichier JSON invalide")
     
+    st.markdown("---")
+    new_site = st.text_input("Nouveau site", placeholder="Ex: Epernay", key="new_site_name")
+    if st.button("🏢 Créer le site", use_container_width=True):
+        if new_site and new_site.strip():
+            try:
+                site_store = get_site_store(new_site.strip())
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                if new_site.strip() not in list_sites():
+                    site_store.save({"drivers": {}})
+                st.session_state["new_site"] = new_site.strip()
+                st.rerun()
+    
     st.markdown("---")
     st.markdown("### 📖 Guide")
     st.markdown("""
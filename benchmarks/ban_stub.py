@@ -0,0 +1,125 @@
+"""Serveur local imitant l'API Adresse (BAN) pour les benchmarks, sans accès réseau."""
+import csv
+import email
+import email.policy
+import hashlib
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def _pseudo_coords(key):
+    """Coordonnées déterministes autour de Reims pour une clé de recherche."""
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return 49.20 + digest[0] / 255 * 0.15, 3.90 + digest[1] / 255 * 0.25
+
+
+def _reverse_name(lat):
+    return f"{int(abs(lat * 1e4)) % 200 + 1} rue de la Stub"
+
+
+def _feature(lat, lon, name, city, postcode):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "properties": {"name": name, "city": city, "postcode": postcode, "label": f"{name} {postcode} {city}"},
+    }
+
+
+class BanStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if self.latency:
+            time.sleep(self.latency)
+
+        if url.path.rstrip('/') == "/search":
+            postcode = query.get("postcode", "")
+            lat, lon = _pseudo_coords(f"{postcode}_{query.get('q', '')}")
+            payload = {"features": [_feature(lat, lon, query.get("q", ""), query.get("q", ""), postcode)]}
+        elif url.path.rstrip('/') == "/reverse":
+            lat, lon = float(query.get("lat", 0)), float(query.get("lon", 0))
+            payload = {"features": [_feature(lat, lon, _reverse_name(lat), "Reims", "51100")]}
+        else:
+            self.send_error(404)
+            return
+        self._send_json(payload)
+
+    def do_POST(self):
+        """Endpoints groupés /search/csv/ et /reverse/csv/ (formulaire multipart)."""
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        message = email.message_from_bytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body, policy=email.policy.HTTP)
+        fields, columns = {}, []
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            value = part.get_payload(decode=True).decode('utf-8')
+            if name == "columns":
+                columns.append(value)
+            else:
+                fields[name] = value
+        if self.latency:
+            time.sleep(self.latency)
+
+        rows = list(csv.DictReader(io.StringIO(fields.get("data", ""))))
+        if url.path.rstrip('/') == "/search/csv":
+            for row in rows:
+                postcode = row.get(fields.get("postcode", ""), "")
+                query = " ".join(row.get(c, "") for c in columns)
+                lat, lon = _pseudo_coords(f"{postcode}_{query}")
+                row.update(latitude=lat, longitude=lon, result_label=f"{query} {postcode}",
+                           result_postcode=postcode, result_city=query, result_status="ok")
+        elif url.path.rstrip('/') == "/reverse/csv":
+            for row in rows:
+                lat = float(row["lat"])
+                name = _reverse_name(lat)
+                row.update(result_name=name, result_city="Reims", result_postcode="51100",
+                           result_label=f"{name} 51100 Reims", result_status="ok")
+        else:
+            self.send_error(404)
+            return
+
+        output = io.StringIO()
+        if rows:
+            writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        self._send(output.getvalue().encode('utf-8'), "text/csv; charset=utf-8")
+
+    def _send_json(self, payload):
+        self._send(json.dumps(payload).encode('utf-8'), "application/json")
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BanStubServer:
+    """Lance le serveur dans un thread ; utilisable comme gestionnaire de contexte."""
+
+    def __init__(self, latency_ms=0, port=0):
+        handler = type("Handler", (BanStubHandler,), {"latency": latency_ms / 1000})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
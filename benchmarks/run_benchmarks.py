@@ -0,0 +1,174 @@
+"""Benchmarks reproductibles du pipeline de dispatch sur des fichiers Cainiao synthétiques.
+
+Chaque étape (chargement, dispatch, préparation Excel, ZIP) est chronométrée puis
+rejouée sous tracemalloc pour mesurer le pic mémoire. Les résultats sont écrits en
+JSON (un fichier par commit) pour comparer les versions entre elles.
+
+Exemples :
+    python benchmarks/run_benchmarks.py --sizes 1000,10000,50000
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import pandas as pd
+
+import dispatch_engine
+import geocoding
+from ban_stub import BanStubServer
+from data_processor import preparer_telechargement_excel
+from synthetic import generate_cainiao, to_file_bytes
+
+DEFAULT_SIZES = [1000, 10000, 50000, 100000, 500000]
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def measure(func, memory=True, setup=None):
+    """Exécute `func` une fois pour le temps, puis une fois sous tracemalloc pour le pic mémoire.
+    `setup` est appelé avant chaque exécution (ex: vider les caches)."""
+    if setup:
+        setup()
+    gc.collect()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        if setup:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {"seconds": round(elapsed, 4), "peak_mb": round(peak / 1e6, 2) if peak is not None else None}
+
+
+def clear_geocoding_caches():
+    geocoding.get_geocode_cache().clear()
+    geocoding.get_centroid_table().clear()
+
+
+def run_size(n_rows, patterns, args):
+    df_source = generate_cainiao(n_rows, args.patterns, seed=args.seed)
+    content = to_file_bytes(df_source, args.format)
+    file_name = f"bench_{n_rows}.{args.format}"
+    stages = {}
+
+    # Caches de géocodage vidés : chaque mesure interroge le serveur local
+    df, stages["load_and_process_file"] = measure(
+        lambda: dispatch_engine.load_and_process_file(content, file_name), args.memory,
+        setup=clear_geocoding_caches)
+    results, stages["auto_dispatch"] = measure(
+        lambda: dispatch_engine.auto_dispatch(df, patterns), args.memory)
+
+    largest = max((name for name in results), key=lambda name: len(results[name]))
+    _, stages["preparer_telechargement_excel"] = measure(
+        lambda: preparer_telechargement_excel(results[largest]), args.memory)
+    _, stages["create_zip_with_excels"] = measure(
+        lambda: dispatch_engine.create_zip_with_excels(results), args.memory,
+        setup=dispatch_engine.export_cache.clear)
+
+    return {
+        "rows": n_rows,
+        "format": args.format,
+        "file_bytes": len(content),
+        "drivers": len(results),
+        "largest_driver_rows": len(results[largest]),
+        "stages": stages,
+    }
+
+
+def compare(old_file, new_file):
+    """Affiche le rapport nouveau/ancien de chaque étape (> 1 = plus lent)."""
+    with open(old_file, encoding='utf-8') as f:
+        old = {r["rows"]: r for r in json.load(f)["runs"]}
+    with open(new_file, encoding='utf-8') as f:
+        new = {r["rows"]: r for r in json.load(f)["runs"]}
+
+    print(f"{'lignes':>8}  {'étape':<30} {'avant (s)':>10} {'après (s)':>10} {'ratio':>7}")
+    for rows in sorted(set(old) & set(new)):
+        for stage_name, after in new[rows]["stages"].items():
+            before = old[rows]["stages"].get(stage_name)
+            if not before:
+                continue
+            ratio = after["seconds"] / before["seconds"] if before["seconds"] else float('nan')
+            print(f"{rows:>8}  {stage_name:<30} {before['seconds']:>10.3f} {after['seconds']:>10.3f} {ratio:>7.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks du dispatch sur fichiers synthétiques.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="Tailles de fichiers (nombre de lignes, séparées par virgules)")
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+    parser.add_argument("--patterns", default=os.path.join(REPO_DIR, "driver_patterns.json"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latence simulée du serveur BAN local")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Ne pas mesurer le pic mémoire")
+    parser.add_argument("--output", help="Fichier JSON de résultats (défaut: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("AVANT", "APRES"), help="Comparer deux fichiers de résultats")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    patterns = dispatch_engine.load_patterns(args.patterns)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    commit = git_commit()
+    runs = []
+
+    with BanStubServer(latency_ms=args.latency_ms) as server:
+        # Le géocodage interroge le serveur local au lieu de l'API publique
+        geocoding.BAN_API_URL = server.url
+        geocoding.set_geocode_cache(geocoding.GeocodeCache(":memory:"))
+        geocoding.set_centroid_table(geocoding.CentroidTable(":memory:"))
+        for n_rows in sizes:
+            print(f"{n_rows} lignes...", flush=True)
+            run = run_size(n_rows, patterns, args)
+            for stage_name, values in run["stages"].items():
+                peak = f"{values['peak_mb']:8.1f} Mo" if values["peak_mb"] is not None else ""
+                print(f"  {stage_name:<30} {values['seconds']:8.3f} s {peak}")
+            runs.append(run)
+
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "runs": runs,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Résultats : {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""Génération de fichiers Cainiao synthétiques pour les benchmarks."""
+import io
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+from patterns_store import load_patterns
+
+# Communes autour de Reims (ville, code postal)
+CITIES = [
+    ("Reims", "51100"), ("Tinqueux", "51430"), ("Bezannes", "51430"), ("Cormontreuil", "51350"),
+    ("Saint-Brice-Courcelles", "51370"), ("Witry-lès-Reims", "51420"), ("Épernay", "51200"),
+    ("Châlons-en-Champagne", "51000"), ("Sillery", "51500"), ("Muizon", "51140"),
+    ("Fismes", "51170"), ("Ay-Champagne", "51160"), ("Rethel", "08300"), ("Laon", "02000"),
+]
+
+STREETS = ["rue de Vesle", "avenue de Laon", "boulevard Lundy", "rue Gambetta", "place d'Erlon", "rue du Barbâtre"]
+
+
+def load_zone_bounds(patterns_file):
+    """Emprises (minx, miny, maxx, maxy) de toutes les zones configurées."""
+    patterns = load_patterns(patterns_file)
+    geometries = [shape(zone) for data in patterns.get("drivers", {}).values() for zone in data.get("zones", [])]
+    if not geometries:
+        return np.array([[3.95, 49.20, 4.10, 49.30]])
+    return shapely.bounds(np.array(geometries, dtype=object))
+
+
+def generate_cainiao(n_rows, patterns_file, seed=0, censored_ratio=0.1, missing_gps_ratio=0.02):
+    """Construit un DataFrame au format Cainiao, avec des points tirés autour des zones configurées."""
+    rng = np.random.default_rng(seed)
+    bounds = load_zone_bounds(patterns_file)
+
+    # Points tirés dans l'emprise élargie (10 %) d'une zone choisie au hasard
+    chosen = bounds[rng.integers(0, len(bounds), n_rows)]
+    margin_x = (chosen[:, 2] - chosen[:, 0]) * 0.1
+    margin_y = (chosen[:, 3] - chosen[:, 1]) * 0.1
+    lon = rng.uniform(chosen[:, 0] - margin_x, chosen[:, 2] + margin_x)
+    lat = rng.uniform(chosen[:, 1] - margin_y, chosen[:, 3] + margin_y)
+    gps = pd.Series([f"{a:.6f},{b:.6f}" for a, b in zip(lat, lon)])
+    gps[rng.random(n_rows) < missing_gps_ratio] = None
+
+    city_idx = rng.integers(0, len(CITIES), n_rows)
+    cities = np.array([c[0] for c in CITIES], dtype=object)[city_idx]
+    sort_codes = np.array([c[1] for c in CITIES], dtype=object)[city_idx]
+    # Certains fichiers perdent le 0 initial (02000 -> 2000) ou ajoutent une apostrophe
+    sort_codes = np.where(rng.random(n_rows) < 0.05, [str(int(c)) for c in sort_codes], sort_codes)
+    sort_codes = np.where(rng.random(n_rows) < 0.05, ["'" + c for c in sort_codes], sort_codes)
+
+    numbers = rng.integers(1, 200, n_rows)
+    streets = np.array(STREETS, dtype=object)[rng.integers(0, len(STREETS), n_rows)]
+    addresses = pd.Series([f"{n} {s}" for n, s in zip(numbers, streets)])
+    addresses[rng.random(n_rows) < censored_ratio] = "******"
+
+    return pd.DataFrame({
+        "Tracking No.": [f"CNFR{i:010d}" for i in range(n_rows)],
+        "Sort Code": sort_codes,
+        "Receiver's City": cities,
+        "Receiver's Detail Address": addresses,
+        "Receiver's Name": "******",
+        "Receiver to (Latitude,Longitude)": gps,
+        "Weight (kg)": np.round(rng.uniform(0.1, 5.0, n_rows), 2),
+    })
+
+
+def to_file_bytes(df, file_format="csv"):
+    """Sérialise le DataFrame comme un export Cainiao (CSV ou XLSX)."""
+    if file_format == "xlsx":
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False)
+        return output.getvalue()
+    return df.to_csv(index=False).encode('utf-8')
@@ -3,6 +3,57 @@ import io
 import datetime
 from shapely.geometry import shape, Point
 
+# Colonnes possibles pour le GPS ("lat,lon") et l'adresse
+GPS_COLUMNS = ["Receiver to (Latitude,Longitude)", "GPS", "Coordinates", "LatLng"]
+ADDRESS_COLUMNS = ["Receiver's Detail Address", "Receivers Detail Address", "Address"]
+COLONNES_INTERNES = ["geocode_pending"]
+
+def separer_gps(series):
+    """Sépare une colonne "lat,lon" en deux colonnes float (opérations vectorisées)."""
+    text = series.astype('string').str.replace('"', '', regex=False)
+    valid = text.str.count(',').eq(1).fillna(False).astype(bool)
+    parts = text.where(valid).str.split(',', n=1, expand=True)
+    if parts.shape[1] < 2:
+        nan = pd.Series(float('nan'), index=series.index)
+        return nan, nan.copy()
+    lat = pd.to_numeric(parts[0].str.strip(), errors='coerce').astype('float64')
+    lon = pd.to_numeric(parts[1].str.strip(), errors='coerce').astype('float64')
+    # Une coordonnée illisible invalide le couple entier
+    invalid = lat.isna() | lon.isna()
+    return lat.mask(invalid), lon.mask(invalid)
+
+def nettoyer_codes_postaux(series):
+    """Nettoie les codes postaux (apostrophes, espaces) et ajoute le 0 manquant (2160 -> 02160)."""
+    codes = series.astype(str).str.strip().str.lstrip("'").str.strip()
+    four_digits = (codes.str.isdigit() & codes.str.len().eq(4)).fillna(False).astype(bool)
+    return codes.mask(four_digits, '0' + codes)
+
+def masque_adresses_censurees(series):
+    """Adresses censurées : contiennent '*' ou sont vides."""
+    return (series.isna() | series.astype(str).str.contains('*', regex=False)).fillna(True).astype(bool)
+
+def normaliser_colonnes(df):
+    """Normalise un fichier Cainiao en une seule étape vectorisée.
+    
+    Code postal (nettoyage + 0 manquant), GPS -> lat/lon float. Retourne le DataFrame
+    et la colonne GPS utilisée (None si absente).
+    """
+    # Normaliser "Receiver's Zip Code" -> "Sort Code" si absent
+    if 'Sort Code' not in df.columns and "Receiver's Zip Code" in df.columns:
+        df['Sort Code'] = df["Receiver's Zip Code"]
+    if 'Sort Code' in df.columns:
+        df['Sort Code'] = nettoyer_codes_postaux(df['Sort Code'])
+    
+    gps_column = next((col for col in GPS_COLUMNS if col in df.columns), None)
+    if gps_column:
+        df['lat'], df['lon'] = separer_gps(df[gps_column])
+    
+    if 'lat' in df.columns:
+        df['lat'] = pd.to_numeric(df['lat'], errors='coerce')
+    if 'lon' in df.columns:
+        df['lon'] = pd.to_numeric(df['lon'], errors='coerce')
+    return df, gps_column
+
 def load_data(uploaded_file):
     """Charge le fichier avec une détection robuste (CSV/Excel)."""
     file_name = uploaded_file.name
@@ -16,24 +67,10 @@ def load_data(uploaded_file):
     except Exception as e:
         return None, f"Erreur de lecture : {e}"
 
-    def split_gps(val):
-        try:
-            if pd.isna(val) or ',' not in str(val): return None, None
-            lat, lon = str(val).replace('"', '').split(',')
-            return float(lat), float(lon)
-        except: return None, None
-
     # Support pour différents formats de colonnes GPS
-    gps_columns = [
-        "Receiver to (Latitude,Longitude)",
-        "GPS",
-        "Coordinates",
-        "LatLng"
-    ]
-    
-    for col in gps_columns:
+    for col in GPS_COLUMNS:
         if col in df.columns:
-            df[['lat', 'lon']] = df[col].apply(lambda x: pd.Series(split_gps(x)))
+            df['lat'], df['lon'] = separer_gps(df[col])
             break
     
     # Convertir lat/lon en float si présents
@@ -59,9 +96,8 @@ def filtrer_colis_par_zone(df, last_draw):
     mask = df.apply(est_dedans, axis=1)
     return df[mask]
 
-def preparer_telechargement_excel(df_selection):
-    """Génère un fichier Excel en mémoire pour le téléchargement Web."""
-    output = io.BytesIO()
+def preparer_colonnes_export(df_selection):
+    """Renomme et réordonne les colonnes pour l'export Excel des tournées."""
     df_export = df_selection.copy()
     
     # Renommer lat/lon en Latitude/Longitude pour plus de clarté
@@ -79,12 +115,44 @@ def preparer_telechargement_excel(df_selection):
                 df_export['Ville'] = df_export[col]
                 break
     
+    # Colonnes internes au traitement (suivi du géocodage)
+    df_export = df_export.drop(columns=[c for c in COLONNES_INTERNES if c in df_export.columns])
+    
     # Réorganiser les colonnes pour mettre les plus importantes en premier
     priority_cols = ['Tracking No.', 'Sort Code', 'Ville', "Receiver's Detail Address", 'Latitude', 'Longitude']
     existing_priority = [c for c in priority_cols if c in df_export.columns]
     other_cols = [c for c in df_export.columns if c not in existing_priority]
-    df_export = df_export[existing_priority + other_cols]
+    return df_export[existing_priority + other_cols]
+
+def lignes_excel(df_export):
+    """Lignes prêtes pour `Worksheet.append` (valeurs manquantes -> cellules vides)."""
+    values = df_export.astype(object).where(df_export.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+def nouveau_classeur_excel(columns):
+    """Crée un classeur openpyxl en mode write-only (écriture en flux) avec la ligne d'en-tête."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    header = []
+    for column in columns:
+        cell = WriteOnlyCell(ws, value=str(column))
+        cell.font = Font(bold=True)
+        header.append(cell)
+    ws.append(header)
+    return wb, ws
+
+def preparer_telechargement_excel(df_selection):
+    """Génère un fichier Excel en mémoire pour le téléchargement Web."""
+    output = io.BytesIO()
+    df_export = preparer_colonnes_export(df_selection)
     
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df_export.to_excel(writer, index=False)
+    # Mode write-only : les lignes sont écrites en flux, sans construire le classeur complet
+    wb, ws = nouveau_classeur_excel(df_export.columns)
+    for row in lignes_excel(df_export):
+        ws.append(row)
+    wb.save(output)
     return output.getvalue()
@@ -0,0 +1,93 @@
+"""Dispatch en ligne de commande (sans Streamlit), par exemple depuis cron.
+
+Exemples :
+    python dispatch_cli.py fichier_cainiao.xlsx --patterns driver_patterns.json --output Dispatch.zip
+    python dispatch_cli.py fichier_cainiao.xlsx --site Epernay
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from dispatch_engine import GEOCODE_BUDGET, create_zip_with_excels, dispatch_streaming, load_and_process_file
+from patterns_store import get_patterns_store, site_path
+
+
+@contextmanager
+def stage(name, timings):
+    """Chronomètre une étape du traitement et affiche sa durée."""
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+    print(f"  {name:<12} {timings[name]:8.2f} s")
+
+
+def print_summary(timings, counts, output):
+    print(f"  {'total':<12} {sum(timings.values()):8.2f} s")
+    print(f"\n{sum(counts.values())} colis -> {output}")
+    for driver_name, count in counts.items():
+        print(f"  {driver_name:<20} {count:6d}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Dispatch automatique d'un fichier Cainiao par chauffeur.")
+    parser.add_argument("input", help="Fichier Cainiao à dispatcher (CSV/XLSX)")
+    parser.add_argument("--patterns", help="Fichier de configuration des chauffeurs (défaut: celui du site)")
+    parser.add_argument("--site", help="Site (dépôt) dont la configuration est utilisée (défaut: site principal)")
+    parser.add_argument("--output", help="ZIP de sortie (défaut: Dispatch_AAAAMMJJ_HHMM.zip)")
+    parser.add_argument("--chunk-size", type=int, default=0,
+                        help="Traiter le fichier par blocs de N lignes (mémoire bornée pour les gros fichiers)")
+    parser.add_argument("--geocode-budget", type=float, default=GEOCODE_BUDGET,
+                        help="Durée max du géocodage en secondes (0 = sans limite)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = args.output or f"Dispatch_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
+
+    if not os.path.exists(args.input):
+        print(f"Fichier introuvable : {args.input}", file=sys.stderr)
+        return 1
+    try:
+        patterns_file = args.patterns or site_path(args.site)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not os.path.exists(patterns_file):
+        print(f"Configuration introuvable : {patterns_file}", file=sys.stderr)
+        return 1
+
+    timings = {}
+    print("Étapes :")
+    with stage("patterns", timings):
+        patterns = get_patterns_store(patterns_file).get()
+
+    if args.chunk_size > 0:
+        # Chargement, dispatch et export bloc par bloc
+        with stage("streaming", timings):
+            counts = dispatch_streaming(args.input, os.path.basename(args.input), patterns, output, args.chunk_size,
+                                        args.geocode_budget)
+        print_summary(timings, counts, output)
+        return 0
+
+    with stage("chargement", timings):
+        with open(args.input, 'rb') as f:
+            df = load_and_process_file(f.read(), os.path.basename(args.input), args.geocode_budget)
+    pending = int(df['geocode_pending'].sum())
+    if pending:
+        print(f"  {pending} colis non géocodés dans le budget (dispatch par code postal/ville)")
+    with stage("dispatch", timings):
+        results = patterns.dispatch(df)
+    with stage("export", timings):
+        zip_data = create_zip_with_excels(results)
+        with open(output, 'wb') as f:
+            f.write(zip_data)
+    print_summary(timings, results.counts(), output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,454 @@
+import atexit
+import csv
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from data_processor import (
+    ADDRESS_COLUMNS, lignes_excel, masque_adresses_censurees, normaliser_colonnes, nouveau_classeur_excel,
+    preparer_colonnes_export, preparer_telechargement_excel,
+)
+from geocoding import GEOCODE_BUDGET, geocode_by_postal_code, learn_centroids, remaining, reverse_geocode_addresses
+from matching import UNASSIGNED, auto_dispatch
+from patterns_store import PATTERNS_FILE, CompiledPatterns, load_patterns, save_patterns
+
+# Taille des blocs du mode streaming (lignes)
+CHUNK_SIZE = 10000
+
+# Géocodage en tâche de fond : nombre de colis par lot
+GEOCODE_BATCH_ROWS = 500
+
+# Export Excel parallèle : nombre de processus (None = nombre de cœurs) et seuil de déclenchement.
+# Processus lancés par un serveur dédié (forkserver) : pas de fork d'un processus Streamlit
+# multithread
+EXPORT_WORKERS = None
+PARALLEL_EXPORT_MIN_ROWS = 5000
+EXPORT_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+_export_pool = None
+
+# Cache des fichiers Excel générés (taille max en octets) ; changer EXPORT_FORMAT_VERSION
+# quand la mise en forme de l'export change, pour invalider les fichiers déjà en cache
+EXPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+EXPORT_FORMAT_VERSION = "write-only-v1"
+
+
+def _excel_rows_to_frame(rows, headers, start=0):
+    """Construit un DataFrame texte à partir de lignes lues par openpyxl."""
+    df = pd.DataFrame(rows, columns=headers, index=pd.RangeIndex(start, start + len(rows)))
+    # Convertir tout en string
+    df = df.astype(str)
+    return df.replace('None', pd.NA)
+
+
+def _iter_excel_chunks(stream, chunk_size=None):
+    """Lit la feuille active ligne à ligne (openpyxl read_only), par blocs de `chunk_size` lignes."""
+    from openpyxl import load_workbook
+    wb = load_workbook(stream, data_only=True, read_only=True)
+    try:
+        data = []
+        headers = None
+        start = 0
+        for i, row in enumerate(wb.active.iter_rows(values_only=True)):
+            if headers is None:
+                # Vérifier si c'est une ligne d'en-tête valide ou une ligne vide
+                if i == 0 and (row[0] is None or str(row[0]).startswith('Unnamed')):
+                    continue
+                headers = [str(c) if c else f'Col_{j}' for j, c in enumerate(row)]
+            elif any(c is not None for c in row):
+                # Ignorer les lignes complètement vides
+                data.append(row)
+                if chunk_size and len(data) >= chunk_size:
+                    yield _excel_rows_to_frame(data, headers, start)
+                    start += len(data)
+                    data = []
+        if headers and data:
+            yield _excel_rows_to_frame(data, headers, start)
+    finally:
+        wb.close()
+
+
+def _drop_empty_columns(df):
+    """Supprime les colonnes sans en-tête (Col_XX)."""
+    return df.loc[:, ~df.columns.str.match(r'^Col_\d+$')]
+
+
+def read_file(file_content, file_name):
+    """Lit un fichier Cainiao (CSV/Excel) en DataFrame texte, sans traitement."""
+    import io as io_module
+    
+    # Forcer la détection par extension
+    file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+    
+    if file_ext in ['xlsx', 'xls']:
+        # Essayer plusieurs méthodes de lecture pour les fichiers Excel problématiques
+        df = None
+        
+        # Méthode 1: openpyxl avec data_only=True (ignore les formules, lit les valeurs)
+        try:
+            df = next(_iter_excel_chunks(io_module.BytesIO(file_content)), None)
+        except Exception as e:
+            df = None
+        
+        # Méthode 2: pandas standard si la méthode 1 échoue
+        if df is None or len(df) == 0:
+            try:
+                df_test = pd.read_excel(io_module.BytesIO(file_content), dtype=str, nrows=2, engine='openpyxl')
+                if df_test.columns[0].startswith('Unnamed'):
+                    df = pd.read_excel(io_module.BytesIO(file_content), dtype=str, skiprows=1, engine='openpyxl')
+                else:
+                    df = pd.read_excel(io_module.BytesIO(file_content), dtype=str, engine='openpyxl')
+            except:
+                df = pd.read_excel(io_module.BytesIO(file_content), dtype=str)
+    else:
+        # CSV
+        text = file_content.decode('utf-8', errors='ignore')
+        try:
+            df = pd.read_csv(io_module.StringIO(text), sep=None, engine='python', dtype=str, on_bad_lines='skip')
+        except:
+            df = pd.read_csv(io_module.StringIO(text), sep=',', dtype=str, on_bad_lines='skip')
+    
+    # Supprimer les colonnes vides (Col_XX)
+    return _drop_empty_columns(df)
+
+
+def normalize_dataframe(df):
+    """Normalise les colonnes (code postal, GPS -> lat/lon) sans accès réseau ; les
+    coordonnées GPS du fichier enrichissent la table locale des centroïdes."""
+    df, gps_column = normaliser_colonnes(df)
+    if gps_column is not None:
+        learn_centroids(df)
+    return df
+
+
+def geocode_dataframe(df, budget=GEOCODE_BUDGET, offline=False):
+    """Géocode les colis sans GPS ou à l'adresse censurée en `budget` secondes au plus
+    (0/None : sans limite). Les colis non résolus à temps sont marqués dans la colonne
+    `geocode_pending`, sans coordonnées : ils restent dispatchables par code postal ou
+    ville (pas par zone) jusqu'à leur géocodage. En mode
+    `offline`, seuls les caches et la table des centroïdes sont utilisés."""
+    if offline:
+        deadline = time.monotonic()
+    else:
+        deadline = time.monotonic() + budget if budget else None
+    df['geocode_pending'] = False
+    
+    # === GÉOCODAGE PAR CODE POSTAL si pas de GPS ===
+    if 'lat' not in df.columns or df['lat'].isna().all():
+        df = geocode_by_postal_code(df, deadline)
+    elif df['lat'].isna().any():
+        # Géocoder seulement les colis sans GPS
+        mask_no_gps = df['lat'].isna()
+        df_no_gps = geocode_by_postal_code(df[mask_no_gps].copy(), deadline)
+        df.loc[mask_no_gps, 'lat'] = df_no_gps['lat']
+        df.loc[mask_no_gps, 'lon'] = df_no_gps['lon']
+        df.loc[mask_no_gps, 'geocode_pending'] = df_no_gps['geocode_pending']
+    
+    # === GÉOCODAGE INVERSE pour adresses censurées (******) ===
+    addr_col = next((col for col in ADDRESS_COLUMNS if col in df.columns), None)
+    
+    if addr_col and 'lat' in df.columns and 'lon' in df.columns:
+        # Détecter les adresses censurées (contiennent * ou sont vides)
+        mask_censored = masque_adresses_censurees(df[addr_col])
+        mask_has_gps = df['lat'].notna() & df['lon'].notna()
+        mask_to_reverse = mask_censored & mask_has_gps
+        
+        if mask_to_reverse.any():
+            df = reverse_geocode_addresses(df, addr_col, mask_to_reverse, deadline)
+    
+    return df
+
+
+class BackgroundGeocoding:
+    """Géocodage en tâche de fond d'un fichier déjà lu.
+
+    `df` est disponible immédiatement (GPS, caches, centroïdes) ; les colis en attente
+    sont ensuite géocodés par lots de `batch_rows` dans un thread. Chaque lot terminé
+    remplace `df` par une copie mise à jour (les lecteurs gardent un état cohérent) et
+    incrémente `revision` ; `changed_rows(revision)` donne les lignes modifiées depuis."""
+
+    def __init__(self, parsed, batch_rows=GEOCODE_BATCH_ROWS, budget=GEOCODE_BUDGET):
+        self._parsed = parsed
+        self.batch_rows = batch_rows
+        self.budget = budget
+        self.df = geocode_dataframe(parsed.copy(), offline=True)
+        self.revision = 0
+        self._changes = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="background-geocoding")
+        if self.df['geocode_pending'].any():
+            self._thread.start()
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+    @property
+    def pending(self):
+        return int(self.df['geocode_pending'].sum())
+
+    def snapshot(self):
+        """(df, revision) cohérents entre eux."""
+        with self._lock:
+            return self.df, self.revision
+
+    def changed_rows(self, since):
+        """Index des lignes modifiées après la révision `since`."""
+        with self._lock:
+            changed = [rows for revision, rows in self._changes if revision > since]
+        return changed[0].append(changed[1:]).unique() if changed else pd.Index([])
+
+    def _run(self):
+        pending = self.df.index[self.df['geocode_pending']]
+        for start in range(0, len(pending), self.batch_rows):
+            rows = pending[start:start + self.batch_rows]
+            batch = geocode_dataframe(self._parsed.loc[rows].copy(), self.budget)
+            with self._lock:
+                df = self.df.copy()
+                columns = [col for col in batch.columns if col in df.columns]
+                df.loc[rows, columns] = batch[columns]
+                self.df = df
+                self.revision += 1
+                self._changes.append((self.revision, rows))
+
+
+def prepare_dataframe(df, budget=GEOCODE_BUDGET):
+    """Normalise les colonnes et géocode les colis sans GPS ou à l'adresse censurée."""
+    return geocode_dataframe(normalize_dataframe(df), budget)
+
+
+def parse_file(file_content, file_name):
+    """Lecture et normalisation du fichier, sans géocodage (résultat stable, cachable)."""
+    return normalize_dataframe(read_file(file_content, file_name))
+
+
+def load_and_process_file(file_content, file_name, budget=GEOCODE_BUDGET):
+    """Charge un fichier Cainiao (CSV/Excel), normalise les colonnes et géocode si besoin."""
+    return geocode_dataframe(parse_file(file_content, file_name), budget)
+
+
+def excel_filename(driver_name, prefix=""):
+    """Nom du fichier Excel d'un chauffeur dans le ZIP."""
+    safe_name = driver_name.replace(" ", "_").replace("/", "-")
+    return f"{prefix}{safe_name}.xlsx"
+
+
+class ExportCache:
+    """Cache LRU des fichiers Excel déjà générés, indexé par l'empreinte du contenu exporté."""
+
+    def __init__(self, max_bytes=EXPORT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(df):
+        """Empreinte du DataFrame (valeurs, colonnes, types) et des paramètres d'export."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(EXPORT_FORMAT_VERSION.encode('utf-8'))
+        digest.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# Partagé par le ZIP et les téléchargements individuels
+export_cache = ExportCache()
+
+
+def get_excel_bytes(driver_df):
+    """Fichier Excel d'un chauffeur, généré une seule fois pour un contenu donné."""
+    key = ExportCache.key(driver_df)
+    data = export_cache.get(key)
+    if data is None:
+        data = preparer_telechargement_excel(driver_df)
+        export_cache.put(key, data)
+    return data
+
+
+def _get_export_pool():
+    """Pool de processus partagé pour l'export Excel (créé à la première utilisation)."""
+    global _export_pool
+    if _export_pool is None:
+        _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS,
+                                           mp_context=multiprocessing.get_context(EXPORT_START_METHOD))
+    return _export_pool
+
+
+@atexit.register
+def shutdown_export_pool():
+    """Arrête les processus d'export (à la sortie du programme)."""
+    global _export_pool
+    pool, _export_pool = _export_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_excels(dispatch_results, parallel=None):
+    """Génère le fichier Excel de chaque chauffeur, en parallèle dans un pool de processus.
+    
+    Les fichiers déjà présents dans `export_cache` ne sont pas régénérés.
+    `parallel=None` : parallèle seulement s'il y a plusieurs cœurs et assez de lignes.
+    """
+    frames = {name: df for name, df in dispatch_results.items() if not df.empty}
+    keys = {name: ExportCache.key(df) for name, df in frames.items()}
+    rendered = {name: export_cache.get(keys[name]) for name in frames}
+    missing = {name: frames[name] for name, data in rendered.items() if data is None}
+    
+    if parallel is None:
+        parallel = (
+            (os.cpu_count() or 1) > 1
+            and len(missing) > 1
+            and sum(len(df) for df in missing.values()) >= PARALLEL_EXPORT_MIN_ROWS
+        )
+    
+    if missing and parallel:
+        try:
+            pool = _get_export_pool()
+            # Les plus gros fichiers d'abord pour équilibrer la charge entre processus
+            largest_first = sorted(missing, key=lambda name: len(missing[name]), reverse=True)
+            futures = {name: pool.submit(preparer_telechargement_excel, missing[name]) for name in largest_first}
+            for name in missing:
+                rendered[name] = futures[name].result()
+        except (BrokenProcessPool, OSError):
+            # Pool inutilisable (processus tué, environnement restreint) : export séquentiel
+            shutdown_export_pool()
+    
+    for name in missing:
+        if rendered[name] is None:
+            rendered[name] = preparer_telechargement_excel(missing[name])
+        export_cache.put(keys[name], rendered[name])
+    return rendered
+
+
+def create_zip_with_excels(dispatch_results, parallel=None, prefix=""):
+    """Crée un ZIP contenant tous les fichiers Excel (`prefix` : début des noms de fichiers)."""
+    zip_buffer = io.BytesIO()
+    
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for driver_name, excel_data in render_excels(dispatch_results, parallel).items():
+            zip_file.writestr(excel_filename(driver_name, prefix), excel_data)
+    
+    zip_buffer.seek(0)
+    return zip_buffer.getvalue()
+
+
+# === MODE STREAMING (mémoire bornée) ===
+
+def _iter_csv_chunks(stream, chunk_size):
+    """Lit un CSV par blocs, après détection du séparateur sur le début du fichier."""
+    sample = stream.read(64 * 1024).decode('utf-8', errors='ignore')
+    stream.seek(0)
+    try:
+        sep = csv.Sniffer().sniff(sample.rsplit('\n', 1)[0], delimiters=',;\t|').delimiter
+    except csv.Error:
+        sep = ','
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='ignore')
+    yield from pd.read_csv(text, sep=sep, dtype=str, on_bad_lines='skip', chunksize=chunk_size)
+
+
+def iter_file_chunks(source, file_name, chunk_size=CHUNK_SIZE):
+    """Lit un fichier Cainiao par blocs de `chunk_size` lignes (`source` : contenu bytes ou chemin)."""
+    stream = io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+    file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+    try:
+        if file_ext == 'xlsx':
+            chunks = _iter_excel_chunks(stream, chunk_size)
+        elif file_ext == 'xls':
+            # Pas de lecture ligne à ligne possible : lecture complète puis découpage
+            df = read_file(stream.read(), file_name)
+            chunks = (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size))
+        else:
+            chunks = _iter_csv_chunks(stream, chunk_size)
+        for chunk in chunks:
+            yield _drop_empty_columns(chunk)
+    finally:
+        stream.close()
+
+
+class StreamingExcelExport:
+    """Classeurs Excel par chauffeur, complétés bloc par bloc (openpyxl write-only)."""
+
+    def __init__(self):
+        self._sheets = {}
+        self.counts = {}
+
+    def append(self, driver_name, driver_df):
+        df_export = preparer_colonnes_export(driver_df)
+        if driver_name not in self._sheets:
+            columns = list(df_export.columns)
+            wb, ws = nouveau_classeur_excel(columns)
+            self._sheets[driver_name] = (wb, ws, columns)
+            self.counts[driver_name] = 0
+        
+        wb, ws, columns = self._sheets[driver_name]
+        for row in lignes_excel(df_export.reindex(columns=columns)):
+            ws.append(row)
+        self.counts[driver_name] += len(driver_df)
+
+    def write_zip(self, output, order=None):
+        """Écrit le ZIP final (`output` : chemin ou fichier binaire)."""
+        names = [name for name in (order or []) if name in self._sheets]
+        names += [name for name in self._sheets if name not in names]
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for driver_name in names:
+                wb = self._sheets[driver_name][0]
+                buffer = io.BytesIO()
+                wb.save(buffer)
+                zip_file.writestr(excel_filename(driver_name), buffer.getvalue())
+        return {name: self.counts[name] for name in names}
+
+
+def dispatch_streaming(source, file_name, patterns, output, chunk_size=CHUNK_SIZE, budget=GEOCODE_BUDGET):
+    """Charge, dispatche et exporte un fichier bloc par bloc : le pic mémoire ne dépend
+    que de `chunk_size`, pas de la taille du fichier. Retourne le nombre de colis par chauffeur.
+    `budget` borne le géocodage du fichier entier : chaque bloc dispose du temps restant
+    (une fois épuisé, caches et centroïdes seulement). `patterns` : dict ou CompiledPatterns."""
+    compiled = patterns if isinstance(patterns, CompiledPatterns) else CompiledPatterns(patterns)
+    deadline = time.monotonic() + budget if budget else None
+    
+    export = StreamingExcelExport()
+    for chunk in iter_file_chunks(source, file_name, chunk_size):
+        left = remaining(deadline)
+        chunk = geocode_dataframe(normalize_dataframe(chunk), left, offline=left is not None and left <= 0)
+        results = compiled.dispatch(chunk)
+        for driver_name, driver_df in results.items():
+            export.append(driver_name, driver_df)
+    
+    return export.write_zip(output, list(compiled.drivers) + [UNASSIGNED])
@@ -0,0 +1,861 @@
+import csv
+import http.client
+import io
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from matching import normalize_text
+
+# API Base Adresse Nationale (surchargeable, ex: serveur local pour les benchmarks)
+BAN_API_URL = os.environ.get("DISPATCH_BAN_URL", "https://api-adresse.data.gouv.fr")
+
+# Cache persistant des réponses (":memory:" pour un cache non persistant)
+GEOCODE_CACHE_FILE = os.environ.get("DISPATCH_GEOCODE_CACHE", "geocode_cache.sqlite")
+GEOCODE_CACHE_TTL = 90 * 24 * 3600        # réponse trouvée
+GEOCODE_CACHE_EMPTY_TTL = 7 * 24 * 3600   # aucune adresse trouvée
+GEOCODE_CACHE_ERROR_TTL = 15 * 60         # erreur réseau / API (ré-essayée rapidement)
+GEOCODE_CACHE_MAX_ENTRIES = 200000
+
+# Table locale des centroïdes (code postal, commune) apprise des fichiers traités
+CENTROID_FILE = os.environ.get("DISPATCH_CENTROIDS", "postal_centroids.sqlite")
+
+# Client HTTP : requêtes simultanées, débit max (l'API limite à 50 requêtes/s par IP) et
+# rafale permise au démarrage (débit + rafale < 50 sur la première seconde), délai
+# d'attente et nouvelles tentatives avec attente exponentielle
+GEOCODE_WORKERS = 8
+GEOCODE_RATE_LIMIT = 40
+GEOCODE_RATE_BURST = 5
+GEOCODE_TIMEOUT = 5
+GEOCODE_RETRIES = 3
+GEOCODE_BACKOFF = 0.5
+
+# Budget de temps de l'étape de géocodage (secondes, 0 = sans limite) : les colis non
+# résolus à temps sont marqués `geocode_pending`. Après GEOCODE_BREAKER_THRESHOLD échecs
+# consécutifs, l'API n'est plus appelée pendant GEOCODE_BREAKER_COOLDOWN secondes.
+GEOCODE_BUDGET = float(os.environ.get("DISPATCH_GEOCODE_BUDGET", 30))
+GEOCODE_BREAKER_THRESHOLD = 5
+GEOCODE_BREAKER_COOLDOWN = 60
+
+# Mode groupé : au-delà de GEOCODE_BULK_MIN_KEYS clés inconnues, envoi aux endpoints
+# /search/csv/ et /reverse/csv/ par lots de GEOCODE_BULK_BATCH_SIZE lignes
+GEOCODE_BULK = os.environ.get("DISPATCH_GEOCODE_BULK", "1") != "0"
+GEOCODE_BULK_MIN_KEYS = 20
+GEOCODE_BULK_BATCH_SIZE = 5000
+GEOCODE_BULK_TIMEOUT = 120
+
+# Géocodage inverse : les points sont regroupés sur une grille d'environ
+# REVERSE_GRID_METERS mètres (un appel par cellule) ; un point dont un voisin déjà
+# résolu est à moins de REVERSE_SNAP_METERS mètres réutilise son adresse
+REVERSE_GRID_METERS = float(os.environ.get("DISPATCH_REVERSE_GRID_METERS", 15))
+REVERSE_SNAP_METERS = REVERSE_GRID_METERS
+METERS_PER_DEGREE = 111320
+
+# Statuts d'une réponse en cache
+STATUS_OK = "ok"
+STATUS_EMPTY = "empty"
+STATUS_ERROR = "error"
+STATUS_PENDING = "pending"  # non résolu (budget dépassé, API coupée) : jamais mis en cache
+
+# Espaces de clés du cache
+SEARCH = "search"
+REVERSE = "reverse"
+
+
+class GeocodeCache:
+    """Cache persistant (SQLite) des réponses de géocodage, avec expiration, cache négatif
+    (adresse introuvable, erreur) et éviction des entrées les moins récemment utilisées."""
+
+    _TTL = {STATUS_OK: GEOCODE_CACHE_TTL, STATUS_EMPTY: GEOCODE_CACHE_EMPTY_TTL, STATUS_ERROR: GEOCODE_CACHE_ERROR_TTL}
+
+    def __init__(self, path=GEOCODE_CACHE_FILE, max_entries=GEOCODE_CACHE_MAX_ENTRIES, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = {**self._TTL, **(ttl or {})}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        if path != ":memory:":
+            # Lectures concurrentes possibles pendant une écriture (plusieurs sessions)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocode ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, status TEXT NOT NULL, value TEXT,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS geocode_accessed ON geocode (accessed_at)")
+
+    def get_many(self, namespace, keys):
+        """Retourne {clé: valeur} pour les entrées encore valides (valeur None = cache négatif)."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock, self._conn:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, status, value, created_at FROM geocode WHERE namespace = ? "
+                    f"AND key IN ({','.join('?' * len(batch))})",
+                    [namespace, *batch],
+                ).fetchall()
+                for key, status, value, created_at in rows:
+                    if now - created_at <= self.ttl.get(status, 0):
+                        found[key] = json.loads(value) if value is not None else None
+            if found:
+                self._conn.executemany(
+                    "UPDATE geocode SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    [(now, namespace, key) for key in found],
+                )
+        return found
+
+    def set_many(self, namespace, entries):
+        """Enregistre des réponses : itérable de (clé, statut, valeur)."""
+        now = time.time()
+        rows = [
+            (namespace, key, status, json.dumps(value) if value is not None else None, now, now)
+            for key, status, value in entries if status != STATUS_PENDING
+        ]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._evict()
+
+    def _evict(self):
+        """Supprime les entrées les moins récemment utilisées au-delà de `max_entries`."""
+        count = self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM geocode WHERE rowid IN (SELECT rowid FROM geocode ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM geocode")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+
+_geocode_cache = None
+
+
+def get_geocode_cache():
+    """Cache de géocodage partagé par le processus (ouvert à la première utilisation)."""
+    global _geocode_cache
+    if _geocode_cache is None:
+        try:
+            _geocode_cache = GeocodeCache(GEOCODE_CACHE_FILE)
+        except sqlite3.Error:
+            # Fichier inaccessible (disque en lecture seule...) : cache en mémoire
+            _geocode_cache = GeocodeCache(":memory:")
+    return _geocode_cache
+
+
+def set_geocode_cache(cache):
+    """Remplace le cache partagé (ex: cache en mémoire pour les benchmarks)."""
+    global _geocode_cache
+    _geocode_cache = cache
+
+
+class CentroidTable:
+    """Table locale (SQLite) des centroïdes par code postal et par (code postal, commune).
+
+    Les centroïdes sont appris des coordonnées GPS des fichiers déjà traités : la table
+    cumule effectifs et sommes des coordonnées, la moyenne se calcule à la lecture.
+    La ligne de commune vide ('') porte le centroïde du code postal entier."""
+
+    def __init__(self, path=CENTROID_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS centroid ("
+                " postcode TEXT NOT NULL, city TEXT NOT NULL, n INTEGER NOT NULL,"
+                " sum_lat REAL NOT NULL, sum_lon REAL NOT NULL, PRIMARY KEY (postcode, city)) WITHOUT ROWID"
+            )
+
+    def learn(self, postcodes, cities, lat, lon):
+        """Ajoute des points observés (Series alignées) aux centroïdes."""
+        frame = pd.DataFrame({
+            'postcode': postcodes.to_numpy(), 'city': cities.to_numpy(),
+            'lat': pd.to_numeric(lat, errors='coerce').to_numpy(),
+            'lon': pd.to_numeric(lon, errors='coerce').to_numpy(),
+        }).dropna()
+        if frame.empty:
+            return
+        by_city = frame.groupby(['postcode', 'city'], sort=False).agg(
+            n=('lat', 'size'), sum_lat=('lat', 'sum'), sum_lon=('lon', 'sum')).reset_index()
+        by_postcode = frame.groupby('postcode', sort=False).agg(
+            n=('lat', 'size'), sum_lat=('lat', 'sum'), sum_lon=('lon', 'sum')).reset_index()
+        by_postcode.insert(1, 'city', '')
+        rows = pd.concat([by_city[by_city['city'] != ''], by_postcode])
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO centroid VALUES (?, ?, ?, ?, ?) ON CONFLICT (postcode, city) DO UPDATE SET"
+                " n = n + excluded.n, sum_lat = sum_lat + excluded.sum_lat, sum_lon = sum_lon + excluded.sum_lon",
+                rows[['postcode', 'city', 'n', 'sum_lat', 'sum_lon']].itertuples(index=False, name=None),
+            )
+
+    def lookup(self, postcodes, cities=None):
+        """Centroïdes (colonnes lat, lon ; NaN si inconnus) alignés sur les clés, par
+        jointure. Sans `cities`, centroïdes des codes postaux."""
+        keys = pd.DataFrame({
+            'postcode': postcodes.to_numpy(),
+            'city': cities.to_numpy() if cities is not None else '',
+        })
+        unique_postcodes = list(keys['postcode'].unique())
+        rows = []
+        with self._lock:
+            for start in range(0, len(unique_postcodes), 500):
+                batch = unique_postcodes[start:start + 500]
+                rows += self._conn.execute(
+                    f"SELECT postcode, city, sum_lat / n, sum_lon / n FROM centroid "
+                    f"WHERE postcode IN ({','.join('?' * len(batch))})", batch,
+                ).fetchall()
+        table = pd.DataFrame(rows, columns=['postcode', 'city', 'lat', 'lon']).astype({'lat': float, 'lon': float})
+        merged = keys.merge(table, on=['postcode', 'city'], how='left')
+        return merged[['lat', 'lon']].set_axis(postcodes.index)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM centroid")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM centroid").fetchone()[0]
+
+
+_centroid_table = None
+
+
+def get_centroid_table():
+    """Table des centroïdes partagée par le processus (ouverte à la première utilisation)."""
+    global _centroid_table
+    if _centroid_table is None:
+        try:
+            _centroid_table = CentroidTable(CENTROID_FILE)
+        except sqlite3.Error:
+            _centroid_table = CentroidTable(":memory:")
+    return _centroid_table
+
+
+def set_centroid_table(table):
+    """Remplace la table partagée (ex: table en mémoire pour les benchmarks)."""
+    global _centroid_table
+    _centroid_table = table
+
+
+def normalized_cities(series):
+    """normalize_text appliqué une seule fois par valeur distincte."""
+    codes, uniques = pd.factorize(series.fillna('').astype(str))
+    normalized = np.array([normalize_text(city) for city in uniques] + [''], dtype=object)
+    return pd.Series(normalized[codes], index=series.index)
+
+
+class GeocodingError(Exception):
+    """Échec d'une requête à l'API Adresse après toutes les tentatives."""
+
+
+class GeocodingPending(GeocodingError):
+    """Requête non envoyée : budget de temps dépassé ou disjoncteur ouvert."""
+
+
+def remaining(deadline):
+    """Secondes restantes avant l'échéance (None : sans limite)."""
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class CircuitBreaker:
+    """Disjoncteur : ouvert après `threshold` échecs consécutifs, il refuse les appels
+    pendant `cooldown` secondes puis laisse passer un essai."""
+
+    def __init__(self, threshold=GEOCODE_BREAKER_THRESHOLD, cooldown=GEOCODE_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.cooldown
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                # Essai après la pause : un nouvel échec rouvre le disjoncteur
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """Limiteur de débit (seau à jetons) partagé entre threads."""
+
+    def __init__(self, rate, burst=GEOCODE_RATE_BURST):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """Attend un jeton ; GeocodingPending si l'échéance arrive avant."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise GeocodingPending("budget de temps dépassé")
+            time.sleep(delay)
+
+
+class GeocodingClient:
+    """Client de l'API Adresse : requêtes concurrentes (pool de threads), débit limité,
+    connexions HTTP réutilisées, nouvelles tentatives avec attente exponentielle,
+    déduplication des requêtes en cours (une même clé n'est jamais demandée deux fois à la fois),
+    mode groupé via les endpoints CSV pour les gros volumes, échéance et disjoncteur."""
+
+    def __init__(self, base_url=None, workers=GEOCODE_WORKERS, rate=GEOCODE_RATE_LIMIT,
+                 timeout=GEOCODE_TIMEOUT, retries=GEOCODE_RETRIES, backoff=GEOCODE_BACKOFF):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate)
+        self.breaker = CircuitBreaker()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="geocode")
+        self._local = threading.local()
+        self._thread_connections = []   # connexions de chaque thread (fermées par `close`)
+        self._inflight = {}       # clé -> [future, nombre d'appels qui l'attendent]
+        self._inflight_lock = threading.Lock()
+
+    # --- HTTP ---
+
+    def _connection(self, url, timeout):
+        """Connexion HTTP persistante du thread courant pour cet hôte."""
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+            with self._inflight_lock:
+                self._thread_connections.append(connections)
+        key = (url.scheme, url.netloc, timeout)
+        if key not in connections:
+            cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+            connections[key] = cls(url.netloc, timeout=timeout)
+        return connections[key]
+
+    def _drop_connection(self, url, timeout):
+        connection = getattr(self._local, "connections", {}).pop((url.scheme, url.netloc, timeout), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        """Attend les requêtes en cours puis ferme le pool de threads et les connexions."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._inflight_lock:
+            connections = [c for thread in self._thread_connections for c in thread.values()]
+            self._thread_connections = []
+        for connection in connections:
+            connection.close()
+
+    def _send(self, method, path, params=None, body=None, headers=None, timeout=None, deadline=None):
+        """Requête HTTP avec nouvelles tentatives sur erreur réseau, 429 et 5xx ; retourne le corps.
+        GeocodingPending si l'échéance est dépassée ou le disjoncteur ouvert."""
+        timeout = timeout or self.timeout
+        url = urllib.parse.urlsplit(f"{self.base_url or BAN_API_URL}{path}")
+        target = f"{url.path}?{urllib.parse.urlencode(params)}" if params else url.path
+        headers = {'User-Agent': 'JNR-Dispatch/1.0', **(headers or {})}
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    break
+                time.sleep(delay)
+            if not self.breaker.allow():
+                raise GeocodingPending("API indisponible (disjoncteur ouvert)")
+            self.limiter.acquire(deadline)
+            left = remaining(deadline)
+            if left is not None and left <= 0:
+                raise GeocodingPending("budget de temps dépassé")
+            try:
+                # Délai réseau borné par l'échéance (connexion dédiée pour ce délai)
+                connection = self._connection(url, timeout if left is None else min(timeout, max(1, int(left))))
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # Connexion fermée par le serveur, délai dépassé... : nouvelle connexion
+                self._drop_connection(url, connection.timeout)
+                self.breaker.failure()
+                last_error = e
+                continue
+            if response.status == 429 or response.status >= 500:
+                self.breaker.failure()
+                last_error = GeocodingError(f"HTTP {response.status}")
+                continue
+            self.breaker.success()
+            if response.status != 200:
+                raise GeocodingError(f"HTTP {response.status}")
+            return content
+        if deadline is not None and time.monotonic() >= deadline:
+            raise GeocodingPending(f"budget de temps dépassé ({last_error})")
+        raise GeocodingError(str(last_error))
+
+    def request(self, path, params, deadline=None):
+        """GET JSON sur l'API."""
+        return json.loads(self._send("GET", path, params=params, deadline=deadline).decode())
+
+    def post_csv(self, path, rows, fields, data=None, deadline=None):
+        """Envoie `rows` (liste de dicts) en CSV multipart à un endpoint /csv/ et
+        retourne les lignes du CSV résultat."""
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+        boundary = f"----jnr-dispatch-{time.monotonic_ns()}"
+        parts = []
+        for name, value in data or []:
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="data"; filename="data.csv"\r\n'
+            f'Content-Type: text/csv\r\n\r\n'.encode() + buffer.getvalue().encode('utf-8') + b'\r\n'
+        )
+        parts.append(f'--{boundary}--\r\n'.encode())
+        content = self._send("POST", path, body=b''.join(parts),
+                             headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                             timeout=GEOCODE_BULK_TIMEOUT, deadline=deadline)
+        return list(csv.DictReader(io.StringIO(content.decode('utf-8-sig'))))
+
+    # --- Requêtes dédupliquées ---
+
+    def _submit(self, key, func, *args):
+        """Soumet une requête, ou retourne celle déjà en cours pour la même clé."""
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            if entry is not None:
+                entry[1] += 1
+                return entry[0]
+            future = self._executor.submit(func, *args)
+            self._inflight[key] = [future, 1]
+        future.add_done_callback(lambda done, key=key: self._release(key, done))
+        return future
+
+    def _release(self, key, future):
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            if entry is not None and entry[0] is future:
+                del self._inflight[key]
+
+    def _abandon(self, key, future):
+        """Un appel cesse d'attendre `future` : la requête n'est annulée que si plus
+        aucun autre appel ne l'attend (requêtes partagées par la déduplication)."""
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            if entry is None or entry[0] is not future:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+        future.cancel()
+
+    def _search(self, cp, city, deadline=None):
+        query = city or cp
+        try:
+            result = self.request("/search/", {'q': query, 'postcode': cp, 'limit': 1}, deadline)
+        except GeocodingPending:
+            return STATUS_PENDING, None
+        except Exception:
+            return STATUS_ERROR, None
+        if result.get('features'):
+            coords = result['features'][0]['geometry']['coordinates']
+            return STATUS_OK, (coords[1], coords[0])
+        return STATUS_EMPTY, None
+
+    def _reverse(self, lat, lon, deadline=None):
+        try:
+            result = self.request("/reverse/", {'lat': lat, 'lon': lon}, deadline)
+        except GeocodingPending:
+            return STATUS_PENDING, None
+        except Exception:
+            return STATUS_ERROR, None
+        if result.get('features'):
+            props = result['features'][0]['properties']
+            return STATUS_OK, {
+                'address': props.get('name', ''),
+                'city': props.get('city', ''),
+                'postcode': props.get('postcode', ''),
+                'label': props.get('label', '')
+            }
+        return STATUS_EMPTY, None
+
+    def search_async(self, key, cp, city, deadline=None):
+        return self._submit((SEARCH, key), self._search, cp, city, deadline)
+
+    def reverse_async(self, key, lat, lon, deadline=None):
+        return self._submit((REVERSE, key), self._reverse, lat, lon, deadline)
+
+    def _many(self, namespace, queries, submit, bulk, bulk_batch, deadline):
+        """Résout {clé: arguments} : par lots CSV si le mode groupé s'applique, requête
+        par requête (en parallèle) pour le reste et pour les lots en échec. Les clés non
+        résolues à l'échéance sont retournées avec le statut STATUS_PENDING."""
+        left = remaining(deadline)
+        if left is not None and left <= 0:
+            return {key: (STATUS_PENDING, None) for key in queries}
+        results = {}
+        if bulk and len(queries) >= GEOCODE_BULK_MIN_KEYS:
+            keys = list(queries)
+            for start in range(0, len(keys), GEOCODE_BULK_BATCH_SIZE):
+                batch = {key: queries[key] for key in keys[start:start + GEOCODE_BULK_BATCH_SIZE]}
+                try:
+                    results.update(bulk_batch(batch, deadline))
+                except Exception:
+                    pass
+        futures = {key: submit(key, *args, deadline) for key, args in queries.items() if key not in results}
+        wait(futures.values(), timeout=None if deadline is None else max(0, remaining(deadline)))
+        for key, future in futures.items():
+            if future.done() and not future.cancelled():
+                results[key] = future.result()
+            else:
+                # Pas de réponse à temps : on cesse d'attendre (la requête n'est annulée
+                # que si aucun autre appel ne l'attend)
+                self._abandon((namespace, key), future)
+                results[key] = (STATUS_PENDING, None)
+        return results
+
+    def _search_csv(self, queries, deadline=None):
+        keys = list(queries)
+        rows = [{'id': i, 'q': city or cp, 'postcode': cp}
+                for i, (cp, city) in enumerate(queries.values())]
+        results = {}
+        for row in self.post_csv("/search/csv/", rows, ['id', 'q', 'postcode'],
+                                 data=[('columns', 'q'), ('postcode', 'postcode')], deadline=deadline):
+            key = keys[int(row['id'])]
+            if row.get('result_status') == 'ok' and row.get('latitude') and row.get('longitude'):
+                results[key] = (STATUS_OK, (float(row['latitude']), float(row['longitude'])))
+            elif row.get('result_status') == 'not-found':
+                results[key] = (STATUS_EMPTY, None)
+        return results
+
+    def _reverse_csv(self, queries, deadline=None):
+        keys = list(queries)
+        rows = [{'id': i, 'lat': lat, 'lon': lon} for i, (lat, lon) in enumerate(queries.values())]
+        results = {}
+        for row in self.post_csv("/reverse/csv/", rows, ['id', 'lat', 'lon'], deadline=deadline):
+            key = keys[int(row['id'])]
+            if row.get('result_status') == 'ok':
+                results[key] = (STATUS_OK, {
+                    'address': row.get('result_name', ''),
+                    'city': row.get('result_city', ''),
+                    'postcode': row.get('result_postcode', ''),
+                    'label': row.get('result_label', '')
+                })
+            elif row.get('result_status') == 'not-found':
+                results[key] = (STATUS_EMPTY, None)
+        return results
+
+    def search_many(self, queries, bulk=GEOCODE_BULK, deadline=None):
+        """{clé: (cp, ville)} -> {clé: (statut, (lat, lon) ou None)}."""
+        return self._many(SEARCH, queries, self.search_async, bulk, self._search_csv, deadline)
+
+    def reverse_many(self, queries, bulk=GEOCODE_BULK, deadline=None):
+        """{clé: (lat, lon)} -> {clé: (statut, adresse ou None)}."""
+        return self._many(REVERSE, queries, self.reverse_async, bulk, self._reverse_csv, deadline)
+
+_geocoding_client = None
+
+
+def get_geocoding_client():
+    """Client de géocodage partagé par le processus."""
+    global _geocoding_client
+    if _geocoding_client is None:
+        _geocoding_client = GeocodingClient()
+    return _geocoding_client
+
+
+def set_geocoding_client(client):
+    """Remplace le client partagé (ex: serveur local pour les tests et benchmarks)."""
+    global _geocoding_client
+    _geocoding_client = client
+
+
+def search_cache_key(cp, city):
+    """Clé normalisée d'une recherche (code postal, ville)."""
+    return f"{str(cp).strip()}|{normalize_text(city)}"
+
+
+def grid_cells(lat, lon, meters=None):
+    """Cellules (i, j) de la grille de géocodage inverse contenant les points (tableaux)."""
+    step = (meters or REVERSE_GRID_METERS) / METERS_PER_DEGREE
+    i = np.floor(np.asarray(lat, dtype=float) / step)
+    # Largeur des cellules en longitude corrigée par la latitude de la rangée
+    lon_step = step / np.maximum(np.cos(np.radians((i + 0.5) * step)), 0.01)
+    return i.astype(np.int64), np.floor(np.asarray(lon, dtype=float) / lon_step).astype(np.int64)
+
+
+def reverse_cell(lat, lon, meters=None):
+    """Cellule (i, j) de la grille de géocodage inverse contenant le point."""
+    i, j = grid_cells([lat], [lon], meters)
+    return int(i[0]), int(j[0])
+
+
+def reverse_cache_key(cell, meters=None):
+    """Clé normalisée d'un géocodage inverse : la cellule de la grille."""
+    return f"{meters or REVERSE_GRID_METERS:g}m:{cell[0]}:{cell[1]}"
+
+
+def neighbour_cells(cell):
+    """La cellule et ses 8 voisines."""
+    return [(cell[0] + di, cell[1] + dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)]
+
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    """Distance approchée (projection équirectangulaire), suffisante à l'échelle de la rue."""
+    dx = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(lat2 - lat1, dx) * METERS_PER_DEGREE
+
+
+def nearest_resolved(lat, lon, cell, resolved, max_meters=None):
+    """Adresse résolue la plus proche du point parmi la cellule et ses voisines."""
+    max_meters = REVERSE_SNAP_METERS if max_meters is None else max_meters
+    best, best_distance = None, max_meters
+    for neighbour in neighbour_cells(cell):
+        value = resolved.get(reverse_cache_key(neighbour))
+        if not value or 'lat' not in value:
+            continue
+        distance = distance_meters(lat, lon, value['lat'], value['lon'])
+        if distance <= best_distance:
+            best, best_distance = value, distance
+    return best
+
+
+def mark_pending(df, pending):
+    """Ajoute les colis de `pending` (masque booléen) à la colonne `geocode_pending`."""
+    pending = pending.reindex(df.index, fill_value=False)
+    df['geocode_pending'] = df['geocode_pending'] | pending if 'geocode_pending' in df.columns else pending
+
+
+def reverse_geocode_addresses(df, addr_col, mask, deadline=None):
+    """Récupère les adresses réelles à partir des coordonnées GPS (avant l'échéance
+    `deadline` en temps monotone, les colis non résolus à temps sont marqués en attente)."""
+    # Points à résoudre et leur cellule de la grille
+    points = pd.DataFrame({
+        'lat': pd.to_numeric(df.loc[mask, 'lat'], errors='coerce'),
+        'lon': pd.to_numeric(df.loc[mask, 'lon'], errors='coerce'),
+    }).dropna().round(6)
+    if points.empty:
+        return df
+    points['cell_i'], points['cell_j'] = grid_cells(points['lat'], points['lon'])
+    points['key'] = (f"{REVERSE_GRID_METERS:g}m:" + points['cell_i'].astype(str)
+                     + ':' + points['cell_j'].astype(str))
+    cells = points.groupby('key', sort=False).agg(
+        cell_i=('cell_i', 'first'), cell_j=('cell_j', 'first'), lat=('lat', 'mean'), lon=('lon', 'mean'))
+    
+    # Réponses déjà connues pour ces cellules et leurs voisines (cache persistant)
+    persistent_cache = get_geocode_cache()
+    neighbour_keys = {reverse_cache_key(n) for cell in zip(cells['cell_i'], cells['cell_j'])
+                      for n in neighbour_cells(cell)}
+    reverse_cache = persistent_cache.get_many(REVERSE, list(neighbour_keys))
+    
+    # Une requête par cellule inconnue, au barycentre de ses points, sauf si tous ses
+    # points ont une adresse voisine déjà résolue assez proche
+    unknown = points[~points['key'].isin(list(reverse_cache))]
+    uncovered = {
+        row.key for row in unknown.itertuples()
+        if nearest_resolved(row.lat, row.lon, (row.cell_i, row.cell_j), reverse_cache) is None
+    }
+    queries = {key: (round(cells.at[key, 'lat'], 6), round(cells.at[key, 'lon'], 6)) for key in uncovered}
+    new_entries = []
+    pending = set()
+    for cache_key, (status, value) in get_geocoding_client().reverse_many(queries, deadline=deadline).items():
+        if status == STATUS_PENDING:
+            pending.add(cache_key)
+            continue
+        if value:
+            value = {**value, 'lat': queries[cache_key][0], 'lon': queries[cache_key][1]}
+        reverse_cache[cache_key] = value
+        new_entries.append((cache_key, status, value))
+    persistent_cache.set_many(REVERSE, new_entries)
+    
+    # Adresse de chaque point : celle de sa cellule, sinon la plus proche déjà résolue
+    addresses = points['key'].map(reverse_cache)
+    for row in points[addresses.isna()].itertuples():
+        addresses.at[row.Index] = nearest_resolved(row.lat, row.lon, (row.cell_i, row.cell_j), reverse_cache)
+    mark_pending(df, points['key'].isin(list(pending)) & addresses.isna())
+    addresses = addresses.dropna()
+    if addresses.empty:
+        return df
+    found = pd.DataFrame(addresses.tolist(), index=addresses.index)
+    
+    # Appliquer les adresses trouvées (affectation masquée)
+    df.loc[found.index, addr_col] = found['address']
+    
+    # Mettre à jour la ville si elle est aussi censurée
+    city_col = next((col for col in ["Receiver's City", "Receivers City"] if col in df.columns), None)
+    if city_col:
+        current_city = df.loc[found.index, city_col]
+        censored = current_city.isna() | current_city.astype(str).str.contains('*', regex=False)
+        df.loc[censored[censored].index, city_col] = found.loc[censored, 'city']
+    
+    return df
+
+
+def find_city_column(df):
+    """Colonne ville du fichier (None si absente)."""
+    for col in ["Receiver's City", "Receivers City", "City", "Receiver's Region/Province"]:
+        if col in df.columns:
+            return col
+    return None
+
+
+def text_keys(series):
+    """Valeurs en texte sans espaces autour ; '' pour les valeurs manquantes (jamais 'nan')."""
+    return series.astype(str).str.strip().where(series.notna(), '')
+
+
+def postal_keys(df, city_col):
+    """Codes postaux, villes et villes normalisées (clés de la table des centroïdes) ;
+    '' pour les valeurs manquantes."""
+    postcodes = text_keys(df['Sort Code'])
+    cities = text_keys(df[city_col]) if city_col else pd.Series('', index=df.index)
+    return postcodes, cities, normalized_cities(cities)
+
+
+def learn_centroids(df):
+    """Alimente la table des centroïdes avec les colis qui ont des coordonnées GPS."""
+    if 'Sort Code' not in df.columns or 'lat' not in df.columns or 'lon' not in df.columns:
+        return
+    has_coords = df['lat'].notna() & df['lon'].notna()
+    if not has_coords.any():
+        return
+    postcodes, _, city_keys = postal_keys(df[has_coords], find_city_column(df))
+    valid_cp = postcodes != ''
+    get_centroid_table().learn(postcodes[valid_cp], city_keys[valid_cp],
+                               df.loc[has_coords, 'lat'][valid_cp], df.loc[has_coords, 'lon'][valid_cp])
+
+
+def geocode_by_postal_code(df, deadline=None):
+    """Géocode les colis par code postal + ville (avant l'échéance `deadline` en temps
+    monotone, les colis non résolus à temps sont marqués en attente)."""
+    if 'Sort Code' not in df.columns:
+        return df
+    
+    if 'lat' not in df.columns:
+        df['lat'] = pd.NA
+    if 'lon' not in df.columns:
+        df['lon'] = pd.NA
+    
+    city_col = find_city_column(df)
+    postcodes, cities, city_keys = postal_keys(df, city_col)
+    valid_cp = postcodes != ''
+    coords = pd.DataFrame({
+        'lat': pd.to_numeric(df['lat'], errors='coerce'),
+        'lon': pd.to_numeric(df['lon'], errors='coerce'),
+    })
+    
+    def fill(found):
+        """Complète les coordonnées manquantes avec celles trouvées (même index)."""
+        found = found.reindex(coords.index)
+        take = coords['lat'].isna() & found['lat'].notna()
+        coords.loc[take, ['lat', 'lon']] = found.loc[take, ['lat', 'lon']].to_numpy(dtype=float)
+    
+    # Colis sans coordonnées : centroïde de la commune s'il est déjà connu
+    centroids = get_centroid_table()
+    missing = valid_cp & coords['lat'].isna()
+    if missing.any():
+        fill(centroids.lookup(postcodes[missing], city_keys[missing]))
+    
+    # Requêtes uniques (CP + Ville) pour les couples encore inconnus
+    missing = valid_cp & coords['lat'].isna()
+    unique_locations = set(zip(postcodes[missing], cities[missing]))
+    geocode_cache = {}
+    
+    # Réponses déjà connues (cache persistant)
+    persistent_cache = get_geocode_cache()
+    known = persistent_cache.get_many(SEARCH, [search_cache_key(cp, city) for cp, city in unique_locations])
+    queries = {}
+    for cp, city in unique_locations:
+        persistent_key = search_cache_key(cp, city)
+        if persistent_key in known:
+            geocode_cache[cp, city] = tuple(known[persistent_key]) if known[persistent_key] else (None, None)
+        else:
+            queries[cp, city] = (cp, city)
+    
+    # Géocoder via l'API BAN (Base Adresse Nationale), requêtes en parallèle
+    new_entries = []
+    pending = set()
+    for key, (status, result) in get_geocoding_client().search_many(queries, deadline=deadline).items():
+        if status == STATUS_PENDING:
+            pending.add(key)
+        geocode_cache[key] = result or (None, None)
+        new_entries.append((search_cache_key(*key), status, result))
+    persistent_cache.set_many(SEARCH, new_entries)
+    
+    # Appliquer les coordonnées : jointure des résultats sur (CP, ville)
+    if geocode_cache:
+        results = pd.DataFrame(
+            [(cp, city, lat, lon) for (cp, city), (lat, lon) in geocode_cache.items()],
+            columns=['postcode', 'city', 'lat', 'lon'],
+        )
+        keys = pd.DataFrame({'postcode': postcodes.to_numpy(), 'city': cities.to_numpy()})
+        fill(keys.merge(results, on=['postcode', 'city'], how='left').set_axis(df.index))
+    
+    # Couples non résolus à temps : en attente, sans coordonnées approchées (ils restent
+    # dispatchables par code postal ou ville jusqu'à leur géocodage)
+    waiting = pd.Series(pd.MultiIndex.from_arrays([postcodes, cities]).isin(list(pending)), index=df.index)
+    if pending:
+        mark_pending(df, waiting)
+    
+    # Codes postaux sans réponse : centroïde connu du code postal
+    missing = valid_cp & ~waiting & coords['lat'].isna()
+    if missing.any():
+        fill(centroids.lookup(postcodes[missing]))
+    
+    # Fallback: moyenne des colis du même code postal dans le fichier
+    missing = valid_cp & ~waiting & coords['lat'].isna()
+    if missing.any():
+        means = coords[valid_cp].groupby(postcodes[valid_cp]).transform('mean')
+        fill(means[missing[valid_cp]])
+    
+    # Une seule affectation masquée
+    resolved = df['lat'].isna() & coords['lat'].notna()
+    df.loc[resolved, ['lat', 'lon']] = coords.loc[resolved, ['lat', 'lon']].to_numpy()
+    
+    return df
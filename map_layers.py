@@ -0,0 +1,64 @@
+"""Calques folium légers pour afficher beaucoup de colis sur la carte."""
+import html
+
+import numpy as np
+import pandas as pd
+from branca.element import MacroElement
+from jinja2 import Template
+
+from matching import as_float_array
+
+
+class PointLayer(MacroElement):
+    """Tous les points dans un seul calque dessiné sur un canvas.
+
+    Les coordonnées sont envoyées en un seul tableau plat [lat, lon, lat, lon, ...]
+    arrondi à `precision` décimales (5 : ~1 m), et les popups éventuels sous forme de
+    codes vers la liste de leurs valeurs distinctes : la page ne contient plus un objet
+    Leaflet sérialisé par colis. Les popups sont du texte (échappé avant bindPopup, qui
+    interprète le HTML)."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(map) {
+                var coords = {{ this.coords|tojson }};
+                var labels = {{ this.labels|tojson }};
+                var codes = {{ this.codes|tojson }};
+                var options = {{ this.options|tojson }};
+                options.renderer = L.canvas({padding: 0.5});
+                var group = L.featureGroup();
+                for (var i = 0; i < coords.length; i += 2) {
+                    var marker = L.circleMarker([coords[i], coords[i + 1]], options);
+                    if (codes) {
+                        marker.bindPopup(labels[codes[i / 2]]);
+                    }
+                    group.addLayer(marker);
+                }
+                return group.addTo(map);
+            })({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, lat, lon, labels=None, radius=3, color="#333", fill_opacity=0.6, precision=5):
+        super().__init__()
+        self._name = "PointLayer"
+        lat = as_float_array(lat)
+        lon = as_float_array(lon)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        self.coords = np.round(np.column_stack([lat[valid], lon[valid]]), precision).ravel().tolist()
+        self.count = int(valid.sum())
+
+        self.labels = self.codes = None
+        if labels is not None:
+            codes, uniques = pd.factorize(pd.Series(labels).astype(str).to_numpy()[valid])
+            self.codes = codes.tolist()
+            self.labels = [html.escape(label) for label in uniques]
+
+        self.options = {
+            "radius": radius,
+            "color": color,
+            "weight": 1,
+            "fill": True,
+            "fillColor": color,
+            "fillOpacity": fill_opacity,
+        }
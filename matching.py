@@ -0,0 +1,468 @@
+import hashlib
+import json
+import re
+import unicodedata
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+
+UNASSIGNED = "_NON_ASSIGNES"
+
+CITY_COLUMNS = ["Receiver's City", "Receivers City", "City", "Ville", "Receiver's Region/Province"]
+
+# Valeurs de la colonne `matched_by`, dans l'ordre d'évaluation des critères
+MATCHED_BY_POSTAL_CODE = "code_postal"
+MATCHED_BY_CITY = "ville"
+MATCHED_BY_ZONE = "zone"
+
+
+def patterns_version(patterns):
+    """Calcule une empreinte stable des critères des chauffeurs (clé de cache)."""
+    payload = json.dumps(patterns.get("drivers", {}), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def as_float_array(values):
+    """Convertit une colonne lat/lon en tableau numpy float (NaN si absent)."""
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+
+
+def normalize_text(text):
+    """Normalise le texte pour comparaison (accents, casse, tirets, espaces)."""
+    if not text or pd.isna(text):
+        return ""
+    text = str(text).lower().strip()
+    text = unicodedata.normalize('NFD', text)
+    text = ''.join(c for c in text if unicodedata.category(c) != 'Mn')
+    text = re.sub(r'[-_\s]+', ' ', text)
+    text = re.sub(r'[^a-z0-9\s]', '', text)
+    return text.strip()
+
+
+def bounded_levenshtein(s1, s2, max_distance):
+    """Distance de Levenshtein bornée : calcule seulement la bande utile et s'arrête dès que
+    la distance dépasse `max_distance` (retourne alors `max_distance + 1`)."""
+    over = max_distance + 1
+    if abs(len(s1) - len(s2)) > max_distance:
+        return over
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    
+    previous = [j if j <= max_distance else over for j in range(len(s2) + 1)]
+    for i, c1 in enumerate(s1, 1):
+        lo = max(1, i - max_distance)
+        hi = min(len(s2), i + max_distance)
+        current = [over] * (len(s2) + 1)
+        current[0] = i if i <= max_distance else over
+        for j in range(lo, hi + 1):
+            current[j] = min(
+                previous[j - 1] + (c1 != s2[j - 1]),
+                previous[j] + 1,
+                current[j - 1] + 1,
+                over,
+            )
+        if min(current[lo - 1:hi + 1]) >= over:
+            return over
+        previous = current
+    
+    return previous[-1]
+
+
+def _clean_postal_code(value):
+    """Forme brute (sans apostrophe ni espaces) et forme sans zéros de tête d'un code postal."""
+    raw = str(value).strip().lstrip("'").strip()
+    clean = raw.lstrip('0') if raw.startswith('0') else raw
+    return raw, clean
+
+
+class PostalCodeIndex:
+    """Index compilé des codes postaux de tous les chauffeurs (correspondance exacte et par préfixe).
+    
+    Un Sort Code correspond à un code configuré s'ils sont égaux sous forme brute ou sans
+    zéros de tête, ou si le code configuré (moins de 5 caractères) en est un préfixe :
+    chaque forme est rangée dans une table de hachage et un Sort Code est résolu en
+    parcourant ses propres préfixes.
+    """
+
+    def __init__(self, drivers):
+        self.drivers = list(drivers.keys())
+        self._exact = ({}, {})
+        self._prefix = ({}, {})
+        for rank, driver_data in enumerate(drivers.values()):
+            for cp in driver_data.get("postal_codes", []) or []:
+                forms = _clean_postal_code(cp)
+                for table, key in zip(self._exact, forms):
+                    table.setdefault(key, set()).add(rank)
+                if len(forms[0]) < 5:
+                    for table, key in zip(self._prefix, forms):
+                        table.setdefault(key, set()).add(rank)
+        self._cache = {}
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        return cls(patterns.get("drivers", {}))
+
+    def to_state(self):
+        """Tables sous forme JSON (listes de rangs), relues par `from_state`."""
+        def dump(tables):
+            return [{key: sorted(ranks) for key, ranks in table.items()} for table in tables]
+        return {"drivers": self.drivers, "exact": dump(self._exact), "prefix": dump(self._prefix)}
+
+    @classmethod
+    def from_state(cls, state):
+        def load(tables):
+            return tuple({key: set(ranks) for key, ranks in table.items()} for table in tables)
+        index = cls({})
+        index.drivers = list(state["drivers"])
+        index._exact = load(state["exact"])
+        index._prefix = load(state["prefix"])
+        return index
+
+    def lookup(self, sort_code):
+        """Retourne les rangs des chauffeurs possédant ce Sort Code."""
+        if sort_code is None or pd.isna(sort_code) or str(sort_code).strip() == '':
+            return frozenset()
+        forms = _clean_postal_code(sort_code)
+        if forms in self._cache:
+            return self._cache[forms]
+        
+        ranks = set()
+        for exact, prefix, key in zip(self._exact, self._prefix, forms):
+            ranks.update(exact.get(key, ()))
+            for length in range(len(key) + 1):
+                ranks.update(prefix.get(key[:length], ()))
+        self._cache[forms] = frozenset(ranks)
+        return self._cache[forms]
+
+    def match_matrix(self, sort_codes):
+        """Matrice booléenne (colis × chauffeurs), calculée une fois par Sort Code distinct."""
+        codes, uniques = pd.factorize(pd.Series(sort_codes), use_na_sentinel=False)
+        unique_matrix = np.zeros((len(uniques), len(self.drivers)), dtype=bool)
+        for i, sort_code in enumerate(uniques):
+            unique_matrix[i, list(self.lookup(sort_code))] = True
+        return unique_matrix[codes]
+
+
+class CityIndex:
+    """Index compilé des villes de tous les chauffeurs, tolérant aux fautes de frappe.
+    
+    Une ville correspond si, une fois normalisées, l'une contient l'autre ou si leur
+    distance de Levenshtein est d'au plus min(max_distance, max(1, longueur // 4)).
+    Les villes configurées sont normalisées une seule fois : table exacte, table de toutes
+    leurs sous-chaînes (entrée contenue dans une ville) et regroupement par longueur pour
+    la distance de Levenshtein bornée. Le résultat est mémorisé par valeur brute.
+    """
+
+    def __init__(self, drivers, max_distance=2):
+        self.drivers = list(drivers.keys())
+        self.max_distance = max_distance
+        owners = {}
+        for rank, driver_data in enumerate(drivers.values()):
+            for city in driver_data.get("cities", []) or []:
+                normalized_city = normalize_text(city)
+                if normalized_city:
+                    owners.setdefault(normalized_city, set()).add(rank)
+        self._build(owners)
+
+    def _build(self, owners):
+        self._owners = owners
+        self._substrings = {}
+        self._by_length = {}
+        for normalized_city, ranks in self._owners.items():
+            length = len(normalized_city)
+            for start in range(length):
+                for end in range(start + 1, length + 1):
+                    self._substrings.setdefault(normalized_city[start:end], set()).update(ranks)
+            self._by_length.setdefault(length, []).append(normalized_city)
+        self._cache = {}
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        return cls(patterns.get("drivers", {}))
+
+    def to_state(self):
+        """Villes normalisées et rangs de leurs chauffeurs : les tables de sous-chaînes et
+        par longueur sont reconstruites par `from_state`."""
+        return {"drivers": self.drivers, "max_distance": self.max_distance,
+                "owners": {city: sorted(ranks) for city, ranks in self._owners.items()}}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls({}, state["max_distance"])
+        index.drivers = list(state["drivers"])
+        index._build({city: set(ranks) for city, ranks in state["owners"].items()})
+        return index
+
+    def _resolve(self, normalized_input):
+        ranks = set()
+        # Exact ou entrée contenue dans une ville configurée
+        ranks.update(self._substrings.get(normalized_input, ()))
+        # Ville configurée contenue dans l'entrée
+        length = len(normalized_input)
+        for start in range(length):
+            for end in range(start + 1, length + 1):
+                ranks.update(self._owners.get(normalized_input[start:end], ()))
+        # Fautes de frappe : seules les villes de longueur compatible sont comparées
+        for city_length in range(length - self.max_distance, length + self.max_distance + 1):
+            for normalized_city in self._by_length.get(city_length, ()):
+                owners = self._owners[normalized_city]
+                if owners <= ranks:
+                    continue
+                tolerance = min(self.max_distance, max(1, city_length // 4))
+                if bounded_levenshtein(normalized_input, normalized_city, tolerance) <= tolerance:
+                    ranks.update(owners)
+        return frozenset(ranks)
+
+    def lookup(self, city_input):
+        """Retourne les rangs des chauffeurs dont une ville correspond (mémorisé par valeur brute)."""
+        if city_input is None or pd.isna(city_input) or str(city_input).strip() == '':
+            return frozenset()
+        if city_input not in self._cache:
+            normalized_input = normalize_text(city_input)
+            self._cache[city_input] = self._resolve(normalized_input) if normalized_input else frozenset()
+        return self._cache[city_input]
+
+    def match_matrix(self, cities):
+        """Matrice booléenne (colis × chauffeurs), calculée une fois par ville distincte."""
+        codes, uniques = pd.factorize(pd.Series(cities), use_na_sentinel=False)
+        unique_matrix = np.zeros((len(uniques), len(self.drivers)), dtype=bool)
+        for i, city_input in enumerate(uniques):
+            unique_matrix[i, list(self.lookup(city_input))] = True
+        return unique_matrix[codes]
+
+
+def polygonal(geometry):
+    """Géométrie valide réduite à ses parties surfaciques (un tracé qui se recoupe est
+    découpé par make_valid ; les segments ou points isolés qu'il produit sont ignorés)."""
+    if not geometry.is_valid:
+        geometry = shapely.make_valid(geometry)
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    parts = [part for part in shapely.get_parts(geometry) if part.geom_type in ("Polygon", "MultiPolygon")]
+    return shapely.union_all(parts) if parts else shapely.Polygon()
+
+
+def zone_overlaps(geometries, owners):
+    """Zones disputées [(rang_a, rang_b, géométrie)] pour chaque paire de chauffeurs dont
+    les zones se recoupent."""
+    ranks = np.unique(owners)
+    unions = np.array([shapely.union_all(geometries[owners == rank]) for rank in ranks], dtype=object)
+    tree = shapely.STRtree(unions)
+
+    contested = []
+    for i, j in zip(*tree.query(unions, predicate="intersects")):
+        if i < j:
+            overlap = polygonal(unions[i].intersection(unions[j]))
+            if not overlap.is_empty:
+                contested.append((int(ranks[i]), int(ranks[j]), overlap))
+    contested.sort(key=lambda item: item[:2])
+    return contested
+
+
+class ZoneIndex:
+    """Index spatial compilé (STRtree + géométries préparées) des zones de tous les chauffeurs.
+
+    Le dispatch n'interroge que l'arbre : les zones disputées (`contested`, voir
+    `zone_overlaps`) ne sont calculées qu'à la première demande du rapport de conflits."""
+
+    def __init__(self, drivers):
+        self.drivers = list(drivers.keys())
+        geometries = []
+        owners = []
+        for rank, driver_data in enumerate(drivers.values()):
+            for zone in driver_data.get("zones", []) or []:
+                try:
+                    geometry = polygonal(shape(zone))
+                except Exception:
+                    continue
+                if geometry.is_empty:
+                    continue
+                geometries.append(geometry)
+                owners.append(rank)
+        geometries = np.array(geometries, dtype=object)
+        owners = np.array(owners, dtype=np.intp)
+        self._build(geometries, owners)
+
+    def _build(self, geometries, owners):
+        self.geometries = geometries
+        self.owners = owners
+        self._contested = None
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries) if len(geometries) else None
+
+    @property
+    def contested(self):
+        if self._contested is None:
+            self._contested = zone_overlaps(self.geometries, self.owners) if len(self.geometries) else []
+        return self._contested
+
+    def to_state(self):
+        """Zones en WKB (hexadécimal) et rangs des chauffeurs : l'arbre et les géométries
+        préparées sont reconstruits par `from_state`."""
+        return {
+            "drivers": self.drivers,
+            "wkb": shapely.to_wkb(self.geometries, hex=True).tolist(),
+            "owners": self.owners.tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.drivers = list(state["drivers"])
+        index._build(shapely.from_wkb(np.array(state["wkb"], dtype=object)),
+                     np.array(state["owners"], dtype=np.intp))
+        return index
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        return cls(patterns.get("drivers", {}))
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def contains_matrix(self, lat, lon):
+        """Matrice booléenne (colis × chauffeurs) : True si une zone du chauffeur contient le colis."""
+        lat = as_float_array(lat)
+        lon = as_float_array(lon)
+        matrix = np.zeros((len(lat), len(self.drivers)), dtype=bool)
+        if self.tree is None or len(lat) == 0:
+            return matrix
+
+        # Une seule requête groupée sur tous les points valides
+        rows = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        if len(rows) == 0:
+            return matrix
+        points = shapely.points(lon[rows], lat[rows])
+        point_idx, zone_idx = self.tree.query(points, predicate="within")
+        matrix[rows[point_idx], self.owners[zone_idx]] = True
+        return matrix
+
+
+def resolve_dispatch(df, patterns, zone_index=None, postal_index=None, city_index=None):
+    """Assigne chaque colis à un chauffeur en une seule passe.
+    
+    Tous les critères sont évalués en bloc (codes postaux, villes, zones), puis le
+    premier chauffeur (ordre des patterns) qui correspond l'emporte. Retourne un
+    DataFrame aligné sur `df` avec les colonnes `driver` (catégorielle) et `matched_by`.
+    """
+    drivers = patterns.get("drivers", {})
+    names = list(drivers.keys())
+    n = len(df)
+    if not names:
+        driver = pd.Categorical.from_codes(np.zeros(n, dtype=int), categories=[UNASSIGNED])
+        return pd.DataFrame({'driver': driver, 'matched_by': None}, index=df.index)
+    
+    # 1. Codes postaux
+    if postal_index is None:
+        postal_index = PostalCodeIndex(drivers)
+    if 'Sort Code' in df.columns:
+        postal = postal_index.match_matrix(df['Sort Code'])
+    else:
+        postal = np.zeros((n, len(names)), dtype=bool)
+    
+    # 2. Villes (toutes les colonnes ville présentes)
+    if city_index is None:
+        city_index = CityIndex(drivers)
+    city = np.zeros((n, len(names)), dtype=bool)
+    for col in CITY_COLUMNS:
+        if col in df.columns:
+            city |= city_index.match_matrix(df[col])
+    
+    # 3. Zones géographiques
+    if zone_index is None:
+        zone_index = ZoneIndex(drivers)
+    if 'lat' in df.columns and 'lon' in df.columns:
+        zone = zone_index.contains_matrix(df['lat'], df['lon'])
+    else:
+        zone = np.zeros((n, len(names)), dtype=bool)
+    
+    # Priorité : le premier chauffeur qui correspond l'emporte
+    matched = postal | city | zone
+    has_match = matched.any(axis=1)
+    winner = matched.argmax(axis=1)
+    rows = np.arange(n)
+    
+    driver_codes = np.where(has_match, winner, len(names))
+    driver = pd.Categorical.from_codes(driver_codes, categories=names + [UNASSIGNED])
+    matched_by = np.full(n, MATCHED_BY_ZONE, dtype=object)
+    matched_by[city[rows, winner]] = MATCHED_BY_CITY
+    matched_by[postal[rows, winner]] = MATCHED_BY_POSTAL_CODE
+    matched_by[~has_match] = None
+    return pd.DataFrame({'driver': driver, 'matched_by': matched_by}, index=df.index)
+
+
+def resolve_zone_dispatch(df, patterns, zone_index=None):
+    """Variante de `resolve_dispatch` sur les seules zones géographiques (codes postaux et
+    villes ignorés) : le premier chauffeur dont une zone contient le colis l'emporte."""
+    drivers = patterns.get("drivers", {})
+    names = list(drivers.keys())
+    n = len(df)
+    if not names:
+        driver = pd.Categorical.from_codes(np.zeros(n, dtype=int), categories=[UNASSIGNED])
+        return pd.DataFrame({'driver': driver, 'matched_by': None}, index=df.index)
+    
+    if zone_index is None:
+        zone_index = ZoneIndex(drivers)
+    if 'lat' in df.columns and 'lon' in df.columns:
+        zone = zone_index.contains_matrix(df['lat'], df['lon'])
+    else:
+        zone = np.zeros((n, len(names)), dtype=bool)
+
+    has_match = zone.any(axis=1)
+    driver_codes = np.where(has_match, zone.argmax(axis=1), len(names))
+    driver = pd.Categorical.from_codes(driver_codes, categories=names + [UNASSIGNED])
+    matched_by = np.where(has_match, MATCHED_BY_ZONE, None)
+    return pd.DataFrame({'driver': driver, 'matched_by': matched_by}, index=df.index)
+
+
+class DispatchResult(Mapping):
+    """Résultat du dispatch : {chauffeur: DataFrame}, les DataFrames étant construits à la demande."""
+
+    def __init__(self, df, assignment):
+        self.df = df
+        self.assignment = assignment
+        self._positions = assignment.groupby('driver', observed=True, sort=False).indices
+        categories = assignment['driver'].cat.categories
+        self._order = [name for name in categories if name in self._positions]
+        self._frames = {}
+
+    def __getitem__(self, driver_name):
+        if driver_name not in self._positions:
+            raise KeyError(driver_name)
+        if driver_name not in self._frames:
+            self._frames[driver_name] = self.df.iloc[self._positions[driver_name]]
+        return self._frames[driver_name]
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def counts(self):
+        """Nombre de colis par chauffeur, sans construire les DataFrames."""
+        return {name: len(self._positions[name]) for name in self._order}
+
+
+def auto_dispatch(df, patterns, zone_index=None, postal_index=None, city_index=None):
+    """Dispatch automatique basé sur les patterns sauvegardés."""
+    assignment = resolve_dispatch(df, patterns, zone_index, postal_index, city_index)
+    return DispatchResult(df, assignment)
+
+
+def auto_dispatch_zones(df, patterns, zone_index=None):
+    """Dispatch sur les seules zones géographiques."""
+    return DispatchResult(df, resolve_zone_dispatch(df, patterns, zone_index))
+
+
+def redispatch(result, df, rows, patterns, zone_index=None, postal_index=None, city_index=None):
+    """Met à jour un dispatch après modification de quelques lignes (ex: colis géocodés
+    entre-temps) : seules les lignes `rows` de `df` sont réévaluées."""
+    assignment = result.assignment.copy()
+    if len(rows):
+        assignment.loc[rows] = resolve_dispatch(df.loc[rows], patterns, zone_index, postal_index, city_index)
+    return DispatchResult(df, assignment)
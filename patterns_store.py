@@ -0,0 +1,515 @@
+"""Configuration des chauffeurs : lecture, sauvegarde et version compilée partagée.
+
+Le fichier JSON n'est relu et recompilé (géométries shapely, index des codes postaux
+et des villes) que lorsqu'il change : toutes les sessions Streamlit et toutes les
+réexécutions du script partagent la même version compilée.
+
+Stockage : le fichier JSON est un instantané (numéro de révision dans la clé
+"revision", révision du dernier remplacement complet dans "replaced_revision" et de la
+dernière modification de chaque chauffeur dans "driver_revisions"), chaque modification est ajoutée à un journal (`<fichier>.log`, une ligne
+JSON par modification) et le journal est fusionné dans l'instantané toutes les
+COMPACT_EVERY modifications. Les écritures de l'instantané sont atomiques (fichier
+temporaire puis renommage) et toutes les écritures se font sous verrou de fichier.
+
+Les index compilés sont aussi écrits dans `<fichier>.cache` (JSON : zones en WKB, tables
+à plat ; l'arbre spatial et les tables dérivées sont reconstruits à la lecture), valide
+tant que l'empreinte (sha1) de l'instantané, du journal et du code qui compile les index
+n'a pas changé : un démarrage ou un rechargement ne reconstruit alors aucune géométrie
+depuis le GeoJSON.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows : verrou inter-processus indisponible
+    fcntl = None
+
+import shapely
+from shapely.geometry import shape
+
+from matching import (CityIndex, PostalCodeIndex, ZoneIndex, auto_dispatch, auto_dispatch_zones, patterns_version,
+                      polygonal, redispatch)
+
+PATTERNS_FILE = "driver_patterns.json"
+
+# Sites (dépôts, clients) : une configuration par fichier `<SITES_DIR>/<site>.json` ;
+# le site par défaut reste PATTERNS_FILE
+SITES_DIR = os.environ.get("DISPATCH_SITES_DIR", "sites")
+DEFAULT_SITE = "default"
+# Nombre de sites gardés compilés en mémoire (les moins récemment utilisés sont libérés)
+MAX_COMPILED_SITES = int(os.environ.get("DISPATCH_MAX_SITES", 4))
+
+# Nombre de modifications du journal avant fusion dans l'instantané
+COMPACT_EVERY = 50
+
+# Tolérance de simplification des zones (mètres, 0 = pas de simplification)
+ZONE_TOLERANCE_METERS = float(os.environ.get("DISPATCH_ZONE_TOLERANCE", 2))
+METERS_PER_DEGREE = 111320
+
+# Chevauchements plus petits ignorés dans le rapport (m², bords dessinés côte à côte)
+OVERLAP_MIN_M2 = float(os.environ.get("DISPATCH_OVERLAP_MIN_M2", 100))
+
+# Incrémenté quand le contenu du cache des index change de forme
+CACHE_FORMAT = 4
+
+# Clés tenues par le store (ignorées à l'import d'une configuration)
+REVISION_KEYS = ("revision", "replaced_revision", "driver_revisions")
+
+
+class PatternsConflict(Exception):
+    """Modification refusée : les chauffeurs concernés ont changé depuis la révision lue."""
+
+
+def log_path(path):
+    return f"{path}.log"
+
+
+def cache_path(path):
+    return f"{path}.cache"
+
+
+@contextmanager
+def file_lock(path):
+    """Verrou exclusif inter-processus sur `<fichier>.lock` (sans effet sous Windows)."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_atomic(path, patterns):
+    """Écrit le JSON dans un fichier temporaire puis le renomme : le fichier n'est
+    jamais lu à moitié écrit, même en cas d'arrêt brutal."""
+    replace_file(path, json.dumps(patterns, ensure_ascii=False, indent=2).encode('utf-8'))
+
+
+def replace_file(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".patterns-", suffix=".tmp", dir=directory)
+    try:
+        # mkstemp crée le fichier en 0600 : on garde les droits du fichier remplacé
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def apply_change(patterns, change):
+    """Applique une modification du journal ; retourne de nouveaux patterns (sans
+    modifier `patterns`)."""
+    if change["op"] == "replace":
+        return dict(change["patterns"])
+    drivers = dict(patterns.get("drivers", {}))
+    for name, data in change["drivers"].items():
+        if data is None:
+            drivers.pop(name, None)
+        else:
+            drivers[name] = data
+    return {**patterns, "drivers": drivers}
+
+
+def record_change(patterns, change):
+    """Note la révision de `change` dans `patterns` (déjà modifiés par `apply_change`) :
+    révision courante, du dernier remplacement et de chaque chauffeur modifié ou supprimé.
+    Ces révisions sont dans l'instantané et survivent donc à la fusion du journal."""
+    patterns["revision"] = change["revision"]
+    patterns["updated_at"] = change["at"]
+    if change["op"] == "replace":
+        patterns["replaced_revision"] = change["revision"]
+        patterns["driver_revisions"] = {}
+    else:
+        patterns["driver_revisions"] = {
+            **patterns.get("driver_revisions", {}), **dict.fromkeys(change["drivers"], change["revision"])}
+    return patterns
+
+
+def area_m2(geometry):
+    """Surface approximative (m²) d'une géométrie en degrés lon/lat."""
+    if geometry.is_empty:
+        return 0.0
+    return geometry.area * METERS_PER_DEGREE ** 2 * math.cos(math.radians(geometry.centroid.y))
+
+
+def clean_zone(zone, tolerance_meters=ZONE_TOLERANCE_METERS):
+    """Zone validée (make_valid) et simplifiée sans changer sa topologie ; None pour un
+    tracé sans surface (points alignés, anneau vide...).
+
+    Le tracé d'origine est conservé dans la clé "original" (audit) et sert de base si la
+    zone est nettoyée à nouveau ; une zone déjà propre est retournée telle quelle."""
+    try:
+        original = zone.get("original") or {key: value for key, value in zone.items() if key != "original"}
+        geometry = polygonal(shape(original))
+    except Exception:
+        return zone  # illisible : conservée, ignorée par ZoneIndex
+    if tolerance_meters > 0:
+        geometry = geometry.simplify(tolerance_meters / METERS_PER_DEGREE, preserve_topology=True)
+    if geometry.is_empty:
+        return None
+    cleaned = json.loads(shapely.to_geojson(geometry))
+    if cleaned == json.loads(json.dumps(original)):
+        return original
+    cleaned["original"] = original
+    return cleaned
+
+
+def clean_drivers(drivers, tolerance_meters=ZONE_TOLERANCE_METERS):
+    """Nettoie les zones des chauffeurs ({nom: données}, None conservé pour les suppressions) ;
+    les tracés sans surface sont retirés."""
+    cleaned = {}
+    for name, data in drivers.items():
+        if data is not None:
+            zones = (clean_zone(zone, tolerance_meters) for zone in data.get("zones", []) or [])
+            data = {**data, "zones": [zone for zone in zones if zone is not None]}
+        cleaned[name] = data
+    return cleaned
+
+
+def read_files(path):
+    """Contenu brut de l'instantané et du journal (b"" si absent)."""
+    contents = []
+    for file_path in (path, log_path(path)):
+        try:
+            with open(file_path, 'rb') as f:
+                contents.append(f.read())
+        except FileNotFoundError:
+            contents.append(b"")
+    return contents
+
+
+def content_digest(snapshot, log):
+    digest = hashlib.sha1(snapshot)
+    digest.update(b"\0")
+    digest.update(log)
+    return digest.hexdigest()
+
+
+def parse_log(log, after_revision):
+    """Modifications du journal postérieures à `after_revision` (une ligne tronquée par
+    un arrêt brutal termine la lecture)."""
+    changes = []
+    for line in log.splitlines(keepends=True):
+        try:
+            change = json.loads(line)
+        except json.JSONDecodeError:
+            break
+        if not line.endswith(b"\n"):
+            break
+        if change["revision"] > after_revision:
+            changes.append(change)
+    return changes
+
+
+def replay(snapshot, log):
+    """Patterns de l'instantané avec les modifications du journal ; retourne aussi ces
+    modifications."""
+    patterns = json.loads(snapshot) if snapshot else {"drivers": {}, "updated_at": None}
+    changes = parse_log(log, patterns.get("revision", 0))
+    for change in changes:
+        patterns = record_change(apply_change(patterns, change), change)
+    return patterns, changes
+
+
+def append_log(path, change):
+    """Ajoute une modification au journal, après avoir retiré une éventuelle dernière
+    ligne tronquée (sinon la nouvelle ligne lui serait accolée et illisible)."""
+    with open(log_path(path), 'a+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size:
+            f.seek(max(0, size - 65536))
+            tail = f.read()
+            if not tail.endswith(b"\n"):
+                f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+        f.write((json.dumps(change, ensure_ascii=False) + "\n").encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_patterns(path=PATTERNS_FILE):
+    """Charge les patterns sauvegardés (instantané JSON + journal des modifications)."""
+    patterns, _ = replay(*read_files(path))
+    return patterns
+
+
+class CompiledPatterns:
+    """Patterns et index compilés d'une version de la configuration.
+
+    `patterns` est partagé entre les sessions et ne doit pas être modifié sur place :
+    les modifications passent par `PatternsStore.update_drivers` ou `PatternsStore.save`."""
+
+    def __init__(self, patterns, indexes=None, version=None):
+        self.patterns = patterns
+        self.version = version or patterns_version(patterns)
+        self.revision = patterns.get("revision", 0)
+        if indexes is None:
+            drivers = patterns.get("drivers", {})
+            indexes = ZoneIndex(drivers), PostalCodeIndex(drivers), CityIndex(drivers)
+        self.zone_index, self.postal_index, self.city_index = indexes
+
+    @property
+    def drivers(self):
+        return self.patterns.get("drivers", {})
+
+    @property
+    def indexes(self):
+        return self.zone_index, self.postal_index, self.city_index
+
+    def overlaps(self, min_m2=OVERLAP_MIN_M2):
+        """Zones disputées entre deux chauffeurs, de la plus grande à la plus petite.
+
+        Le chauffeur "prioritaire" (premier dans la configuration) reçoit les colis de la
+        zone ; "geometry" est la zone disputée en GeoJSON."""
+        drivers = self.zone_index.drivers
+        overlaps = [
+            {"prioritaire": drivers[rank_a], "chauffeur": drivers[rank_b], "surface_m2": area_m2(geometry),
+             "geometry": geometry}
+            for rank_a, rank_b, geometry in self.zone_index.contested
+        ]
+        overlaps = sorted((o for o in overlaps if o["surface_m2"] >= min_m2), key=lambda o: -o["surface_m2"])
+        for overlap in overlaps:
+            overlap["geometry"] = json.loads(shapely.to_geojson(overlap["geometry"]))
+        return overlaps
+
+    def dispatch(self, df):
+        """Dispatch de `df` avec les index compilés."""
+        return auto_dispatch(df, self.patterns, *self.indexes)
+
+    def dispatch_zones(self, df):
+        """Dispatch de `df` sur les seules zones géographiques."""
+        return auto_dispatch_zones(df, self.patterns, self.zone_index)
+
+    def redispatch(self, result, df, rows):
+        """Réassigne les lignes `rows` d'un dispatch déjà calculé."""
+        return redispatch(result, df, rows, self.patterns, *self.indexes)
+
+
+def code_version():
+    """Empreinte du format du cache et des sources qui compilent les index."""
+    digest = hashlib.sha1(str(CACHE_FORMAT).encode())
+    for source in (sys.modules[ZoneIndex.__module__].__file__, __file__):
+        try:
+            with open(source, 'rb') as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+CODE_VERSION = code_version()
+
+
+def cache_digest(digest):
+    """Empreinte du cache : contenu des fichiers (`digest`) et version du code."""
+    return hashlib.sha1(f"{CODE_VERSION}:{digest}".encode()).hexdigest()
+
+
+def read_compiled_cache(path, digest):
+    """Index compilés relus du cache s'il correspond à `digest` et au code courant :
+    (version des patterns, index), sinon None."""
+    try:
+        with open(cache_path(path), 'rb') as f:
+            cached = json.load(f)
+        if cached.get("digest") != cache_digest(digest):
+            return None
+        indexes = (ZoneIndex.from_state(cached["zones"]), PostalCodeIndex.from_state(cached["postal_codes"]),
+                   CityIndex.from_state(cached["cities"]))
+        return cached["version"], indexes
+    except Exception:
+        return None  # absent ou illisible (format ancien, fichier tronqué) : recompilé
+
+
+def write_compiled_cache(path, digest, compiled):
+    payload = {
+        "digest": cache_digest(digest),
+        "version": compiled.version,
+        "zones": compiled.zone_index.to_state(),
+        "postal_codes": compiled.postal_index.to_state(),
+        "cities": compiled.city_index.to_state(),
+    }
+    replace_file(cache_path(path), json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+
+
+def compile_patterns(patterns, path, digest):
+    """Version compilée de `patterns` (contenu `digest` des fichiers de `path`), depuis le
+    cache des index s'il est à jour, sinon compilée puis mise en cache."""
+    cached = read_compiled_cache(path, digest)
+    if cached is not None:
+        version, indexes = cached
+        return CompiledPatterns(patterns, indexes, version)
+    compiled = CompiledPatterns(patterns)
+    try:
+        write_compiled_cache(path, digest, compiled)
+    except OSError:
+        pass  # répertoire en lecture seule : on recompilera au prochain démarrage
+    return compiled
+
+
+class PatternsStore:
+    """Accès concurrent au fichier de patterns, recompilé seulement quand il change.
+
+    Les modifications (`update_drivers`) coûtent une ligne de journal et sont refusées
+    (PatternsConflict) si un chauffeur concerné a changé depuis `expected_revision`."""
+
+    def __init__(self, path=PATTERNS_FILE, compact_every=COMPACT_EVERY, zone_tolerance=ZONE_TOLERANCE_METERS):
+        self.path = path
+        self.compact_every = compact_every
+        self.zone_tolerance = zone_tolerance
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._compiled = None
+        self._log_entries = 0
+
+    def _file_stamp(self):
+        stamps = []
+        for path in (self.path, log_path(self.path)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stamps.append(None)
+            else:
+                stamps.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(stamps)
+
+    def _reload(self):
+        """Relit l'instantané et rejoue le journal."""
+        # Empreinte prise avant la lecture : une écriture concurrente provoquera une relecture
+        self._stamp = self._file_stamp()
+        snapshot, log = read_files(self.path)
+        patterns, changes = replay(snapshot, log)
+        self._log_entries = len(changes)
+        self._compiled = compile_patterns(patterns, self.path, content_digest(snapshot, log))
+
+    def release(self):
+        """Libère la version compilée (recompilée, ou relue du cache, au prochain `get`)."""
+        with self._lock:
+            self._compiled = None
+            self._stamp = None
+
+    def get(self):
+        """Version compilée à jour du fichier."""
+        with self._lock:
+            if self._compiled is None or self._file_stamp() != self._stamp:
+                self._reload()
+            return self._compiled
+
+    def _commit(self, change, expected_revision=None):
+        with self._lock, file_lock(self.path):
+            # État le plus récent (un autre processus a pu écrire)
+            if self._compiled is None or self._file_stamp() != self._stamp:
+                self._reload()
+            current = self._compiled.patterns
+            if expected_revision is not None:
+                touched = change.get("drivers") if change["op"] == "drivers" else None
+                if (current.get("replaced_revision", 0) > expected_revision
+                        or (touched is None and self._compiled.revision > expected_revision)):
+                    raise PatternsConflict("configuration remplacée entre-temps")
+                revisions = current.get("driver_revisions", {})
+                changed = [name for name in touched or [] if revisions.get(name, 0) > expected_revision]
+                if changed:
+                    raise PatternsConflict(f"chauffeur(s) modifié(s) entre-temps : {', '.join(changed)}")
+
+            change = {**change, "revision": self._compiled.revision + 1, "at": datetime.now().isoformat()}
+            patterns = record_change(apply_change(current, change), change)
+
+            if self._log_entries + 1 >= self.compact_every or change["op"] == "replace":
+                # Fusion du journal dans un nouvel instantané
+                write_atomic(self.path, patterns)
+                if os.path.exists(log_path(self.path)):
+                    os.remove(log_path(self.path))
+                self._log_entries = 0
+            else:
+                append_log(self.path, change)
+                self._log_entries += 1
+
+            self._stamp = self._file_stamp()
+            self._compiled = compile_patterns(patterns, self.path, content_digest(*read_files(self.path)))
+            return self._compiled
+
+    def update_drivers(self, drivers, expected_revision=None):
+        """Enregistre des chauffeurs ({nom: données}, None pour supprimer) en une seule
+        modification, zones nettoyées ; retourne la nouvelle version compilée."""
+        drivers = clean_drivers(drivers, self.zone_tolerance)
+        return self._commit({"op": "drivers", "drivers": drivers}, expected_revision)
+
+    def save(self, patterns):
+        """Remplace toute la configuration (import) ; retourne la nouvelle version compilée."""
+        patterns = {key: value for key, value in patterns.items() if key not in REVISION_KEYS}
+        patterns["drivers"] = clean_drivers(patterns.get("drivers", {}), self.zone_tolerance)
+        return self._commit({"op": "replace", "patterns": patterns})
+
+
+_stores = {}
+_compiled_lru = OrderedDict()
+_stores_lock = threading.Lock()
+
+
+def get_patterns_store(path=PATTERNS_FILE):
+    """Store partagé par le processus pour ce fichier.
+
+    Au-delà de MAX_COMPILED_SITES fichiers utilisés, la version compilée du moins
+    récemment utilisé est libérée."""
+    key = os.path.abspath(path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = PatternsStore(path)
+        _compiled_lru[key] = _stores[key]
+        _compiled_lru.move_to_end(key)
+        while len(_compiled_lru) > MAX_COMPILED_SITES:
+            _, evicted = _compiled_lru.popitem(last=False)
+            evicted.release()
+        return _stores[key]
+
+
+def save_patterns(patterns, path=PATTERNS_FILE):
+    """Remplace toute la configuration du fichier (via son store partagé : zones nettoyées,
+    révisions tenues) ; retourne la nouvelle version compilée."""
+    return get_patterns_store(path).save(patterns)
+
+
+def site_path(site=None):
+    """Fichier de configuration d'un site (PATTERNS_FILE pour le site par défaut)."""
+    if not site or site == DEFAULT_SITE:
+        return PATTERNS_FILE
+    if not re.fullmatch(r"[\w][\w .-]*", site):
+        raise ValueError(f"Nom de site invalide : {site!r}")
+    return os.path.join(SITES_DIR, f"{site}.json")
+
+
+def list_sites():
+    """Sites configurés : le site par défaut puis ceux de SITES_DIR."""
+    sites = [DEFAULT_SITE]
+    if os.path.isdir(SITES_DIR):
+        sites += sorted(name[:-len(".json")] for name in os.listdir(SITES_DIR)
+                        if name.endswith(".json") and not name.startswith("."))
+    return sites
+
+
+def get_site_store(site=None):
+    """Store d'un site, compilé à la première utilisation."""
+    path = site_path(site)
+    if path != PATTERNS_FILE:
+        os.makedirs(SITES_DIR, exist_ok=True)
+    return get_patterns_store(path)
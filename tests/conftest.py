@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+import geocoding  # noqa: E402
+from ban_stub import BanStubServer  # noqa: E402
+
+
+@pytest.fixture
+def ban_server():
+    """Serveur local imitant l'API Adresse."""
+    with BanStubServer() as server:
+        yield server
+
+
+@pytest.fixture
+def geocoding_env(monkeypatch, ban_server):
+    """Client, cache et table des centroïdes isolés (en mémoire, serveur local)."""
+    client = geocoding.GeocodingClient(base_url=ban_server.url)
+    monkeypatch.setattr(geocoding, "_geocoding_client", client)
+    monkeypatch.setattr(geocoding, "_geocode_cache", geocoding.GeocodeCache(":memory:"))
+    monkeypatch.setattr(geocoding, "_centroid_table", geocoding.CentroidTable(":memory:"))
+    yield client
+    client.close()
@@ -0,0 +1,80 @@
+"""Implémentations d'origine (ligne par ligne, chauffeur par chauffeur), gardées comme
+référence des tests d'équivalence des index compilés de matching.py."""
+import pandas as pd
+
+from matching import normalize_text
+
+
+def levenshtein_distance(s1, s2):
+    """Calcule la distance de Levenshtein entre deux chaînes."""
+    if len(s1) < len(s2):
+        return levenshtein_distance(s2, s1)
+    if len(s2) == 0:
+        return len(s1)
+    
+    previous_row = range(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            insertions = previous_row[j + 1] + 1
+            deletions = current_row[j] + 1
+            substitutions = previous_row[j] + (c1 != c2)
+            current_row.append(min(insertions, deletions, substitutions))
+        previous_row = current_row
+    
+    return previous_row[-1]
+
+
+def fuzzy_match_city(city_input, city_list, max_distance=2):
+    """Vérifie si une ville correspond à la liste avec tolérance aux fautes."""
+    if not city_list:
+        return False
+    if city_input is None or pd.isna(city_input) or str(city_input).strip() == '':
+        return False
+    
+    normalized_input = normalize_text(city_input)
+    if not normalized_input:
+        return False
+    
+    for city in city_list:
+        normalized_city = normalize_text(city)
+        if not normalized_city:
+            continue
+        
+        if normalized_input == normalized_city:
+            return True
+        
+        if normalized_input in normalized_city or normalized_city in normalized_input:
+            return True
+        
+        tolerance = min(max_distance, max(1, len(normalized_city) // 4))
+        if levenshtein_distance(normalized_input, normalized_city) <= tolerance:
+            return True
+    
+    return False
+
+
+def match_postal_code(sort_code, postal_codes):
+    """Vérifie si un code postal correspond à la liste assignée."""
+    if not postal_codes:
+        return False
+    if sort_code is None or pd.isna(sort_code) or str(sort_code).strip() == '':
+        return False
+    
+    # Nettoyer le code postal (enlever apostrophes, espaces, leading zeros)
+    sort_code_str = str(sort_code).strip().lstrip("'").strip()
+    sort_code_clean = sort_code_str.lstrip('0') if sort_code_str.startswith('0') else sort_code_str
+    
+    for cp in postal_codes:
+        cp_str = str(cp).strip().lstrip("'").strip()
+        cp_clean = cp_str.lstrip('0') if cp_str.startswith('0') else cp_str
+        
+        # Match exact
+        if sort_code_str == cp_str or sort_code_clean == cp_clean:
+            return True
+        
+        # Match par préfixe (ex: "51" matche "51100", "51200", etc.)
+        if len(cp_str) < 5 and (sort_code_str.startswith(cp_str) or sort_code_clean.startswith(cp_clean)):
+            return True
+    
+    return False
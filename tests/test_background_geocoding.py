@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import geocoding
+from dispatch_engine import BackgroundGeocoding, geocode_dataframe
+
+pytestmark = pytest.mark.usefixtures("geocoding_env")
+
+
+def parcels():
+    return pd.DataFrame({
+        "Sort Code": ["51100", "51100", "51430", "51000"],
+        "Receiver's City": ["Reims", "Reims", "Tinqueux", "Reims"],
+        "lat": [np.nan, 49.26, np.nan, np.nan],
+        "lon": [np.nan, 4.03, np.nan, np.nan],
+    })
+
+
+def test_offline_pass_marks_rows_pending_without_coordinates():
+    # Centroïde connu pour le code postal 51430 : pas appliqué aux colis en attente
+    geocoding.get_centroid_table().learn(pd.Series(["51430"]), pd.Series([""]), pd.Series([49.25]), pd.Series([3.99]))
+    df = geocode_dataframe(parcels(), offline=True)
+    assert df["geocode_pending"].tolist() == [True, False, True, True]
+    assert df.loc[df["geocode_pending"], "lat"].isna().all()
+
+
+def test_background_job_fills_pending_rows():
+    job = BackgroundGeocoding(parcels(), batch_rows=2)
+    first, revision = job.snapshot()
+    assert revision == 0
+    assert first["geocode_pending"].sum() == 3
+
+    job._thread.join(10)
+    assert job.done and job.pending == 0
+    df, revision = job.snapshot()
+    assert revision == 2
+    assert df[["lat", "lon"]].notna().all().all()
+    assert df.loc[1, "lat"] == pytest.approx(49.26)
+    assert sorted(job.changed_rows(0)) == [0, 2, 3]
+    assert sorted(job.changed_rows(1)) == [3]
+    # Les copies déjà lues ne sont pas modifiées
+    assert first["lat"].isna().sum() == 3
+
+
+def test_nothing_pending_starts_no_thread():
+    df = parcels().assign(lat=49.26, lon=4.03)
+    job = BackgroundGeocoding(df)
+    assert job.done and job.pending == 0 and job.revision == 0
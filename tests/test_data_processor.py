@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from data_processor import masque_adresses_censurees, nettoyer_codes_postaux, normaliser_colonnes, separer_gps
+
+GPS_VALUES = ["49.25,4.03", '"49.26, 4.04"', " 49.27 ,4.05 ", "49.2", "abc,4.0", "49.2,", "1,2,3", "", None, np.nan]
+SORT_CODES = ["2160", "'51100", " 02000 ", "0800", "51", "abc", "12345", "'2160 "]
+ADDRESSES = ["1 rue de Vesle", "12 r*** ***", "****", "", None, np.nan]
+
+
+def legacy_split_gps(val):
+    """Découpage ligne par ligne d'origine."""
+    try:
+        if pd.isna(val) or ',' not in str(val):
+            return None, None
+        lat, lon = str(val).replace('"', '').split(',')
+        return float(lat), float(lon)
+    except Exception:
+        return None, None
+
+
+def test_separer_gps_matches_row_by_row_split():
+    lat, lon = separer_gps(pd.Series(GPS_VALUES, dtype=object))
+    for value, got_lat, got_lon in zip(GPS_VALUES, lat, lon):
+        expected = legacy_split_gps(value)
+        if expected[0] is None:
+            assert np.isnan(got_lat) and np.isnan(got_lon), value
+        else:
+            assert (got_lat, got_lon) == expected, value
+
+
+def test_nettoyer_codes_postaux_pads_four_digit_codes():
+    expected = []
+    for code in SORT_CODES:
+        code = code.strip().lstrip("'").strip()
+        expected.append('0' + code if code.isdigit() and len(code) == 4 else code)
+    assert nettoyer_codes_postaux(pd.Series(SORT_CODES)).tolist() == expected
+
+
+def test_missing_sort_codes_stay_missing():
+    codes = nettoyer_codes_postaux(pd.Series(["2160", np.nan, None], dtype=object))
+    assert codes[0] == "02160"
+    assert codes[1:].isna().all()
+
+
+def test_masque_adresses_censurees():
+    expected = [('*' in str(x)) if pd.notna(x) else True for x in ADDRESSES]
+    assert masque_adresses_censurees(pd.Series(ADDRESSES, dtype=object)).tolist() == expected
+
+
+def test_normaliser_colonnes():
+    df = pd.DataFrame({
+        "Receiver's Zip Code": ["2160", "51100"],
+        "Receiver to (Latitude,Longitude)": ["49.25,4.03", "n/a"],
+    })
+    df, gps_column = normaliser_colonnes(df)
+    assert gps_column == "Receiver to (Latitude,Longitude)"
+    assert df["Sort Code"].tolist() == ["02160", "51100"]
+    assert df["lat"].dtype == "float64" and df.loc[0, "lat"] == 49.25 and np.isnan(df.loc[1, "lon"])
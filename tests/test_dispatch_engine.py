@@ -0,0 +1,119 @@
+import io
+import time
+import zipfile
+
+import pandas as pd
+import pytest
+from openpyxl import load_workbook
+
+import dispatch_engine
+from dispatch_engine import create_zip_with_excels, dispatch_streaming, load_and_process_file
+from patterns_store import CompiledPatterns
+
+PATTERNS = {"drivers": {
+    "Alice": {"zones": [{"type": "Polygon", "coordinates": [[
+        [4.00, 49.20], [4.05, 49.20], [4.05, 49.30], [4.00, 49.30], [4.00, 49.20]]]}],
+        "postal_codes": [], "cities": []},
+    "Bob": {"zones": [], "postal_codes": ["51430"], "cities": ["Tinqueux"]},
+}}
+
+
+def cainiao_csv(rows=60):
+    lines = ["Tracking No.,Sort Code,Receiver's City,Receiver's Detail Address,Receiver to (Latitude,Longitude)"]
+    for i in range(rows):
+        if i % 5 == 0:
+            # Sans GPS : géocodage par code postal (codes absents des lignes avec GPS)
+            lines.append(f'T{i},5130{i % 3},Tinqueux,{i} rue Haute,')
+        else:
+            address = "**** ***" if i % 4 == 0 else f"{i} rue de Vesle"
+            lines.append(f'T{i},51100,Reims,{address},"{49.21 + i * 0.002:.4f},{4.01 + (i % 7) * 0.01:.4f}"')
+    return "\n".join(lines).encode("utf-8")
+
+
+def zip_sheets(data):
+    """{fichier: lignes de la feuille} d'un ZIP d'export."""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return {name: list(load_workbook(io.BytesIO(archive.read(name))).active.iter_rows(values_only=True))
+                for name in archive.namelist()}
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_streaming_output_matches_whole_file():
+    content = cainiao_csv()
+    compiled = CompiledPatterns(PATTERNS)
+    whole = create_zip_with_excels(compiled.dispatch(load_and_process_file(content, "colis.csv")), parallel=False)
+
+    output = io.BytesIO()
+    counts = dispatch_streaming(content, "colis.csv", compiled, output, chunk_size=7)
+    streamed = zip_sheets(output.getvalue())
+    assert streamed == zip_sheets(whole)
+    assert sum(counts.values()) == 60 and counts["Bob"] > 0 and counts["Alice"] > 0
+
+
+def test_streaming_geocoding_budget_covers_whole_file(monkeypatch):
+    calls = []
+
+    def slow_geocode(df, budget=None, offline=False):
+        calls.append((budget, offline))
+        time.sleep(0.1)
+        return df
+
+    monkeypatch.setattr(dispatch_engine, "geocode_dataframe", slow_geocode)
+    dispatch_streaming(cainiao_csv(40), "colis.csv", PATTERNS, io.BytesIO(), chunk_size=10, budget=0.25)
+    budgets = [budget for budget, offline in calls if not offline]
+    assert len(calls) == 4
+    assert budgets == sorted(budgets, reverse=True) and budgets[0] <= 0.25
+    assert calls[-1][1], "le dernier bloc arrive après l'échéance : caches seulement"
+
+
+@pytest.fixture
+def export_cache(monkeypatch):
+    cache = dispatch_engine.ExportCache()
+    monkeypatch.setattr(dispatch_engine, "export_cache", cache)
+    return cache
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_parallel_render_matches_sequential(export_cache):
+    results = CompiledPatterns(PATTERNS).dispatch(load_and_process_file(cainiao_csv(), "colis.csv", budget=None))
+    try:
+        parallel = dispatch_engine.render_excels(results, parallel=True)
+        pool = dispatch_engine._export_pool
+        assert pool is not None and pool._mp_context.get_start_method() == dispatch_engine.EXPORT_START_METHOD
+    finally:
+        dispatch_engine.shutdown_export_pool()
+    assert dispatch_engine._export_pool is None
+
+    export_cache.clear()
+    sequential = dispatch_engine.render_excels(results, parallel=False)
+    assert list(parallel) == list(sequential)
+    for name in parallel:
+        assert (list(load_workbook(io.BytesIO(parallel[name])).active.iter_rows(values_only=True))
+                == list(load_workbook(io.BytesIO(sequential[name])).active.iter_rows(values_only=True)))
+
+    names = zipfile.ZipFile(io.BytesIO(create_zip_with_excels(results, prefix="Tournee_"))).namelist()
+    assert sorted(names) == sorted(f"Tournee_{name}.xlsx" for name in results)
+
+
+def test_export_cache_hits_on_same_content(export_cache):
+    df = pd.DataFrame({"Tracking No.": ["T1", "T2"], "Sort Code": ["51100", "51430"],
+                       "lat": [49.25, 49.26], "lon": [4.03, 4.04]})
+    first = dispatch_engine.get_excel_bytes(df)
+    assert (export_cache.hits, export_cache.misses) == (0, 1)
+    assert dispatch_engine.get_excel_bytes(df.copy()) is first
+    assert (export_cache.hits, export_cache.misses) == (1, 1)
+
+    changed = df.copy()
+    changed.iloc[0, 0] = "AUTRE"
+    assert dispatch_engine.get_excel_bytes(changed) is not first
+    assert export_cache.misses == 2
+
+
+def test_export_cache_evicts_least_recently_used():
+    cache = dispatch_engine.ExportCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"
+    cache.put("c", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
@@ -0,0 +1,275 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import geocoding
+from ban_stub import BanStubServer
+from geocoding import (
+    GEOCODE_BULK_MIN_KEYS, STATUS_OK, STATUS_PENDING, CircuitBreaker, GeocodingClient, RateLimiter,
+)
+
+
+@pytest.fixture
+def make_client():
+    """Clients créés par le test, fermés à la fin (connexions et threads)."""
+    clients = []
+
+    def make(url, **kwargs):
+        clients.append(GeocodingClient(base_url=url, **kwargs))
+        return clients[-1]
+
+    yield make
+    for client in clients:
+        client.close()
+
+
+def count_calls(monkeypatch, client, method):
+    calls = []
+    original = getattr(client, method)
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(client, method, counted)
+    return calls
+
+
+def test_search_and_reverse(make_client, ban_server):
+    client = make_client(ban_server.url)
+    status, (lat, lon) = client.search_many({"k": ("51100", "Reims")}, bulk=False)["k"]
+    assert status == STATUS_OK and 49.2 <= lat <= 49.35
+    status, address = client.reverse_many({"r": (49.25, 4.03)}, bulk=False)["r"]
+    assert status == STATUS_OK and address["city"] == "Reims"
+
+
+def test_bulk_mode_uses_csv_endpoint(monkeypatch, make_client, ban_server):
+    client = make_client(ban_server.url)
+    requests = count_calls(monkeypatch, client, "request")
+    posts = count_calls(monkeypatch, client, "post_csv")
+    queries = {i: (f"51{i:03d}", "Reims") for i in range(GEOCODE_BULK_MIN_KEYS)}
+    results = client.search_many(queries, bulk=True)
+    assert {status for status, _ in results.values()} == {STATUS_OK}
+    assert len(posts) == 1 and not requests
+
+
+def test_in_flight_requests_are_shared(monkeypatch, make_client, ban_server):
+    client = make_client(ban_server.url, workers=1)
+    requests = count_calls(monkeypatch, client, "request")
+    # Le seul worker est occupé : les deux appels trouvent la même requête en file
+    blocker = threading.Event()
+    client._executor.submit(blocker.wait, 5)
+    first = client.search_async("k", "51100", "Reims")
+    second = client.search_async("k", "51100", "Reims")
+    blocker.set()
+    assert first is second
+    assert first.result(5)[0] == STATUS_OK
+    assert len(requests) == 1
+
+
+def test_deadline_does_not_cancel_shared_request(make_client):
+    with BanStubServer(latency_ms=300) as server:
+        client = make_client(server.url, workers=1)
+        client.search_async("busy", "51000", "Chalons")
+        patient = {}
+        thread = threading.Thread(target=lambda: patient.update(
+            client.search_many({"k": ("51100", "Reims")}, bulk=False)))
+        thread.start()
+        time.sleep(0.05)
+        hurried = client.search_many({"k": ("51100", "Reims")}, bulk=False, deadline=time.monotonic() + 0.05)
+        thread.join(5)
+        client.close()
+    assert hurried["k"][0] == STATUS_PENDING
+    assert patient["k"][0] == STATUS_OK
+
+
+def test_expired_deadline_returns_pending_without_calls(monkeypatch, make_client, ban_server):
+    client = make_client(ban_server.url)
+    requests = count_calls(monkeypatch, client, "request")
+    results = client.search_many({"k": ("51100", "Reims")}, deadline=time.monotonic())
+    assert results == {"k": (STATUS_PENDING, None)}
+    assert not requests
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.is_open and not breaker.allow()
+    breaker.success()
+    assert breaker.allow()
+
+
+def test_rate_limiter_burst_is_small():
+    limiter = RateLimiter(rate=40)
+    assert limiter.capacity == geocoding.GEOCODE_RATE_BURST
+    start = time.monotonic()
+    for _ in range(limiter.capacity + 4):
+        limiter.acquire()
+    assert time.monotonic() - start >= 3 / 40
+
+
+def test_missing_postcodes_and_cities_are_empty_keys():
+    df = pd.DataFrame({"Sort Code": ["51100", np.nan], "Receiver's City": [np.nan, "Reims"]})
+    postcodes, cities, city_keys = geocoding.postal_keys(df, "Receiver's City")
+    assert list(postcodes) == ["51100", ""]
+    assert list(cities) == ["", "Reims"]
+    assert list(city_keys) == ["", "reims"]
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_geocode_by_postal_code_never_queries_nan(monkeypatch):
+    requests = count_calls(monkeypatch, geocoding.get_geocoding_client(), "request")
+    df = pd.DataFrame({"Sort Code": ["51100", np.nan], "Receiver's City": [np.nan, "Reims"],
+                       "lat": [np.nan, np.nan], "lon": [np.nan, np.nan]})
+    df = geocoding.geocode_by_postal_code(df)
+    assert [params["q"] for _, params, _ in requests] == ["51100"]
+    assert df["lat"].notna().tolist() == [True, False]
+
+
+class Clock:
+    """Remplace le module `time` vu par geocoding : time() réglable, le reste inchangé."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(geocoding, "time", clock)
+    return clock
+
+
+def test_cache_ttl_depends_on_status(clock):
+    cache = geocoding.GeocodeCache(":memory:", ttl={STATUS_OK: 100, geocoding.STATUS_EMPTY: 50,
+                                                    geocoding.STATUS_ERROR: 10})
+    cache.set_many("search", [("ok", STATUS_OK, [49.2, 4.0]), ("empty", geocoding.STATUS_EMPTY, None),
+                              ("error", geocoding.STATUS_ERROR, None), ("pending", STATUS_PENDING, None)])
+    assert cache.get_many("search", ["ok", "empty", "error", "pending"]) == {
+        "ok": [49.2, 4.0], "empty": None, "error": None}
+    clock.now += 20
+    assert set(cache.get_many("search", ["ok", "empty", "error"])) == {"ok", "empty"}
+    clock.now += 60
+    assert set(cache.get_many("search", ["ok", "empty", "error"])) == {"ok"}
+    clock.now += 30
+    assert cache.get_many("search", ["ok"]) == {}
+    assert cache.get_many("reverse", ["ok"]) == {}
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = geocoding.GeocodeCache(":memory:", max_entries=2)
+    cache.set_many("search", [("a", STATUS_OK, 1)])
+    clock.now += 1
+    cache.set_many("search", [("b", STATUS_OK, 2)])
+    clock.now += 1
+    cache.get_many("search", ["a"])
+    clock.now += 1
+    cache.set_many("search", [("c", STATUS_OK, 3)])
+    assert len(cache) == 2
+    assert set(cache.get_many("search", ["a", "b", "c"])) == {"a", "c"}
+
+
+def test_cache_persists_on_disk(tmp_path):
+    path = str(tmp_path / "geocode.sqlite")
+    geocoding.GeocodeCache(path).set_many("search", [("51100|reims", STATUS_OK, [49.25, 4.03])])
+    assert geocoding.GeocodeCache(path).get_many("search", ["51100|reims"]) == {"51100|reims": [49.25, 4.03]}
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_second_run_is_served_from_cache(monkeypatch):
+    requests = count_calls(monkeypatch, geocoding.get_geocoding_client(), "request")
+    df = pd.DataFrame({"Sort Code": ["51100", "51430"], "Receiver's City": ["Reims", "Tinqueux"],
+                       "lat": [np.nan, np.nan], "lon": [np.nan, np.nan]})
+    first = geocoding.geocode_by_postal_code(df.copy())
+    assert len(requests) == 2
+    second = geocoding.geocode_by_postal_code(df.copy())
+    assert len(requests) == 2
+    assert second[["lat", "lon"]].equals(first[["lat", "lon"]])
+
+
+def censored_parcels(points):
+    return pd.DataFrame({"Receiver's Detail Address": "**** ***", "Receiver's City": "R***",
+                         "lat": [lat for lat, _ in points], "lon": [lon for _, lon in points]})
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_reverse_geocoding_snaps_to_grid(monkeypatch):
+    requests = count_calls(monkeypatch, geocoding.get_geocoding_client(), "request")
+    step = geocoding.REVERSE_GRID_METERS / geocoding.METERS_PER_DEGREE
+    lat0 = (np.floor(49.25 / step) + 0.5) * step
+    lon0 = 4.03
+
+    # Dix colis à moins d'un mètre : une seule cellule, une seule requête
+    df = censored_parcels([(lat0 + k * 1e-6, lon0) for k in range(10)])
+    mask = pd.Series(True, index=df.index)
+    df = geocoding.reverse_geocode_addresses(df, "Receiver's Detail Address", mask)
+    assert len(requests) == 1
+    assert df["Receiver's Detail Address"].nunique() == 1 and "*" not in df.loc[0, "Receiver's Detail Address"]
+    assert (df["Receiver's City"] == "Reims").all()
+
+    # Cellule voisine, à ~12 m de l'adresse résolue : réutilisée sans requête
+    near = censored_parcels([(lat0 + 0.8 * step, lon0)])
+    assert geocoding.grid_cells(near["lat"], near["lon"])[0][0] != geocoding.grid_cells([lat0], [lon0])[0][0]
+    near = geocoding.reverse_geocode_addresses(near, "Receiver's Detail Address", pd.Series(True, index=near.index))
+    assert len(requests) == 1
+    assert near.loc[0, "Receiver's Detail Address"] == df.loc[0, "Receiver's Detail Address"]
+
+    # Plus loin que REVERSE_SNAP_METERS : nouvelle requête
+    far = censored_parcels([(lat0 + 3 * step, lon0)])
+    geocoding.reverse_geocode_addresses(far, "Receiver's Detail Address", pd.Series(True, index=far.index))
+    assert len(requests) == 2
+
+
+def test_nearest_resolved_respects_distance():
+    cell = geocoding.reverse_cell(49.25, 4.03)
+    resolved = {geocoding.reverse_cache_key(cell): {"address": "1 rue", "lat": 49.25, "lon": 4.03}}
+    assert geocoding.nearest_resolved(49.25005, 4.03, cell, resolved)["address"] == "1 rue"
+    assert geocoding.nearest_resolved(49.2503, 4.03, cell, resolved) is None
+
+
+def test_close_releases_connections(make_client, ban_server):
+    client = make_client(ban_server.url)
+    client.search_many({i: ("51100", f"Ville {i}") for i in range(4)}, bulk=False)
+    connections = [c for thread in client._thread_connections for c in thread.values()]
+    assert connections and all(c.sock is not None for c in connections)
+    client.close()
+    assert all(c.sock is None for c in connections)
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_learned_centroids_skip_the_api(monkeypatch):
+    requests = count_calls(monkeypatch, geocoding.get_geocoding_client(), "request")
+    geocoding.learn_centroids(pd.DataFrame({
+        "Sort Code": ["51100", "51100", "51100"], "Receiver's City": ["Reims", "REIMS", "Bezannes"],
+        "lat": [49.20, 49.30, 49.22], "lon": [4.00, 4.10, 3.99]}))
+    df = geocoding.geocode_by_postal_code(pd.DataFrame({
+        "Sort Code": ["51100"], "Receiver's City": ["Reims"], "lat": [np.nan], "lon": [np.nan]}))
+    assert not requests
+    assert df.loc[0, "lat"] == pytest.approx(49.25) and df.loc[0, "lon"] == pytest.approx(4.05)
+
+
+@pytest.mark.usefixtures("geocoding_env")
+def test_postcode_centroid_then_file_mean_when_api_finds_nothing(monkeypatch):
+    client = geocoding.get_geocoding_client()
+    monkeypatch.setattr(client, "search_many", lambda queries, **kwargs: {
+        key: (geocoding.STATUS_EMPTY, None) for key in queries})
+    geocoding.get_centroid_table().learn(pd.Series(["51100"]), pd.Series(["reims"]), pd.Series([49.26]),
+                                         pd.Series([4.03]))
+    df = geocoding.geocode_by_postal_code(pd.DataFrame({
+        "Sort Code": ["51100", "51430", "51430", ""], "Receiver's City": ["Cormontreuil", "Tinqueux", "Tinqueux", "X"],
+        "lat": [np.nan, np.nan, 49.24, np.nan], "lon": [np.nan, np.nan, 3.98, np.nan]}))
+    # Centroïde du code postal entier, puis moyenne du fichier pour le même code postal
+    assert df.loc[0, ["lat", "lon"]].tolist() == pytest.approx([49.26, 4.03])
+    assert df.loc[1, ["lat", "lon"]].tolist() == pytest.approx([49.24, 3.98])
+    assert pd.isna(df.loc[3, "lat"])
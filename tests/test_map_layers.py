@@ -0,0 +1,19 @@
+import folium
+import numpy as np
+
+from map_layers import PointLayer
+
+
+def test_points_and_labels_are_flattened():
+    layer = PointLayer([49.2, np.nan, 49.3], [4.0, 4.1, 4.2], labels=["Reims", "Épernay", "Reims"])
+    assert layer.count == 2
+    assert layer.coords == [49.2, 4.0, 49.3, 4.2]
+    assert layer.labels == ["Reims"] and layer.codes == [0, 0]
+
+
+def test_labels_are_escaped():
+    m = folium.Map(location=[49.25, 4.03])
+    layer = PointLayer([49.2], [4.0], labels=['<img src=x onerror="alert(1)">'])
+    layer.add_to(m)
+    assert layer.labels == ["&lt;img src=x onerror=&quot;alert(1)&quot;&gt;"]
+    assert "<img" not in m.get_root().render()
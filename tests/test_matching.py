@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from legacy_matching import fuzzy_match_city, levenshtein_distance, match_postal_code
+from matching import (
+    MATCHED_BY_CITY, MATCHED_BY_POSTAL_CODE, MATCHED_BY_ZONE, UNASSIGNED, CityIndex, PostalCodeIndex, ZoneIndex,
+    auto_dispatch, auto_dispatch_zones, bounded_levenshtein, redispatch, resolve_dispatch, resolve_zone_dispatch,
+)
+
+
+def square(lon, lat, size=0.01):
+    return {"type": "Polygon", "coordinates": [[
+        [lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]]}
+
+
+PATTERNS = {"drivers": {
+    "Alice": {"zones": [square(4.00, 49.20)], "postal_codes": ["51100"], "cities": []},
+    "Bob": {"zones": [square(4.00, 49.20), square(4.02, 49.20)], "postal_codes": [], "cities": ["Tinqueux"]},
+}}
+
+
+def parcels():
+    return pd.DataFrame({
+        "Sort Code": ["51430", "51100", "51430", "51430", "51430"],
+        "Receiver's City": ["Reims", "Reims", "Tinqueux", "Reims", "Reims"],
+        "lat": [49.205, 49.30, 49.30, 49.205, np.nan],
+        "lon": [4.005, 4.10, 4.10, 4.025, np.nan],
+    })
+
+
+def test_resolve_dispatch_first_matching_driver_wins():
+    assignment = resolve_dispatch(parcels(), PATTERNS)
+    assert list(assignment["driver"]) == ["Alice", "Alice", "Bob", "Bob", UNASSIGNED]
+    assert list(assignment["matched_by"][:4]) == [
+        MATCHED_BY_ZONE, MATCHED_BY_POSTAL_CODE, MATCHED_BY_CITY, MATCHED_BY_ZONE]
+    assert pd.isna(assignment["matched_by"][4])
+
+
+def test_resolve_zone_dispatch_ignores_postal_codes_and_cities():
+    assignment = resolve_zone_dispatch(parcels(), PATTERNS)
+    assert list(assignment["driver"]) == ["Alice", UNASSIGNED, UNASSIGNED, "Bob", UNASSIGNED]
+    assert list(assignment["matched_by"].isna()) == [False, True, True, False, True]
+    assert set(assignment["matched_by"].dropna()) == {MATCHED_BY_ZONE}
+
+
+def test_zone_dispatch_matches_per_driver_loop():
+    # Référence : boucle chauffeur par chauffeur, le premier qui contient le colis l'emporte
+    df = parcels()
+    index = ZoneIndex(PATTERNS["drivers"])
+    contains = index.contains_matrix(df["lat"], df["lon"])
+    expected = []
+    for row in contains:
+        names = [name for name, hit in zip(PATTERNS["drivers"], row) if hit]
+        expected.append(names[0] if names else UNASSIGNED)
+    result = auto_dispatch_zones(df, PATTERNS, index)
+    assert list(result.assignment["driver"]) == expected
+    assert sum(result.counts().values()) == len(df)
+
+
+def test_no_drivers_leaves_everything_unassigned():
+    assert list(resolve_dispatch(parcels(), {"drivers": {}})["driver"]) == [UNASSIGNED] * 5
+    assert list(resolve_zone_dispatch(parcels(), {"drivers": {}})["driver"]) == [UNASSIGNED] * 5
+
+
+def test_redispatch_only_updates_given_rows():
+    df = parcels()
+    result = auto_dispatch(df, PATTERNS)
+    df.loc[4, ["lat", "lon"]] = [49.205, 4.025]
+    updated = redispatch(result, df, pd.Index([4]), PATTERNS)
+    assert list(updated.assignment["driver"]) == ["Alice", "Alice", "Bob", "Bob", "Bob"]
+    assert len(updated["Bob"]) == 3
+
+
+POSTAL_DRIVERS = {
+    "A": {"postal_codes": ["51100", "'02000"]},
+    "B": {"postal_codes": ["51", "0800"]},
+    "C": {"postal_codes": [" 2000 ", "511"]},
+    "D": {"postal_codes": []},
+}
+SORT_CODES = ["51100", "51430", "'51100", "02000", "2000", "0200", "08000", "8000", "800", "51", "5",
+              " 51100 ", "", None, np.nan, "abc", "020001"]
+
+
+def test_postal_code_index_matches_legacy_rule():
+    index = PostalCodeIndex(POSTAL_DRIVERS)
+    for sort_code in SORT_CODES:
+        expected = {rank for rank, data in enumerate(POSTAL_DRIVERS.values())
+                    if match_postal_code(sort_code, data["postal_codes"])}
+        assert index.lookup(sort_code) == expected, sort_code
+    matrix = index.match_matrix(pd.Series(SORT_CODES))
+    assert matrix.tolist() == [[rank in index.lookup(code) for rank in range(4)] for code in SORT_CODES]
+
+
+CITY_DRIVERS = {
+    "A": {"cities": ["Reims", "Saint-Brice-Courcelles"]},
+    "B": {"cities": ["Tinqueux", "Bétheny"]},
+    "C": {"cities": ["Épernay", "Ay"]},
+    "D": {"cities": []},
+}
+CITY_INPUTS = ["Reims", "REIMS ", "Riems", "Reimss", "Rems", "saint brice courcelles", "St Brice", "Tinquex",
+               "Betheny", "bethény", "Epernay", "Eprenay", "Aÿ", "Ay-Champagne", "Cormontreuil", "", None, np.nan,
+               "Reims Tinqueux", "Bezannes"]
+
+
+def test_city_index_matches_legacy_rule():
+    index = CityIndex(CITY_DRIVERS)
+    for city in CITY_INPUTS:
+        expected = {rank for rank, data in enumerate(CITY_DRIVERS.values())
+                    if fuzzy_match_city(city, data["cities"])}
+        assert index.lookup(city) == expected, city
+
+
+def test_bounded_levenshtein_matches_full_distance():
+    words = ["reims", "riems", "rems", "reimss", "tinqueux", "epernay", "ay", ""]
+    for a in words:
+        for b in words:
+            distance = levenshtein_distance(a, b)
+            for bound in range(3):
+                assert bounded_levenshtein(a, b, bound) == min(distance, bound + 1), (a, b, bound)
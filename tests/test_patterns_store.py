@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import pytest
+
+import patterns_store
+from patterns_store import (
+    CompiledPatterns, PatternsConflict, PatternsStore, cache_path, clean_drivers, content_digest, get_patterns_store,
+    get_site_store, list_sites, load_patterns, log_path, read_compiled_cache, read_files, save_patterns,
+)
+
+
+def square(lon, lat, size=0.01):
+    return {"type": "Polygon", "coordinates": [[
+        [lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]]}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "patterns.json")
+
+
+def test_update_drivers_appends_to_log(path):
+    store = PatternsStore(path, compact_every=10)
+    store.update_drivers({"A": {"zones": [square(4.0, 49.2)]}})
+    store.update_drivers({"B": {"postal_codes": ["51100"]}})
+    assert os.path.exists(log_path(path))
+    patterns = load_patterns(path)
+    assert patterns["revision"] == 2
+    assert sorted(patterns["drivers"]) == ["A", "B"]
+    assert PatternsStore(path).get().revision == 2
+
+
+def test_compaction_merges_log_into_snapshot(path):
+    store = PatternsStore(path, compact_every=3)
+    for i in range(3):
+        store.update_drivers({f"D{i}": {"zones": []}})
+    assert not os.path.exists(log_path(path))
+    assert sorted(load_patterns(path)["drivers"]) == ["D0", "D1", "D2"]
+    assert load_patterns(path)["driver_revisions"] == {"D0": 1, "D1": 2, "D2": 3}
+
+
+def test_conflict_on_same_driver_only(path):
+    first, second = PatternsStore(path), PatternsStore(path)
+    first.update_drivers({"A": {"zones": []}, "B": {"zones": []}})
+    seen = second.get().revision
+
+    first.update_drivers({"A": {"zones": [], "color": "#111"}})
+    second.update_drivers({"B": {"zones": [], "color": "#222"}}, expected_revision=seen)
+    with pytest.raises(PatternsConflict, match="A"):
+        second.update_drivers({"A": None}, expected_revision=seen)
+
+
+def test_no_false_conflict_after_compaction(path):
+    first, second = PatternsStore(path, compact_every=3), PatternsStore(path, compact_every=3)
+    first.save({"drivers": {"A": {"zones": []}, "B": {"zones": []}}})
+    seen = second.get().revision
+    for i in range(4):
+        first.update_drivers({"A": {"zones": [], "n": i}})
+
+    second.update_drivers({"B": {"zones": [], "n": 1}}, expected_revision=seen)
+    assert PatternsStore(path).get().drivers["B"]["n"] == 1
+    with pytest.raises(PatternsConflict):
+        second.update_drivers({"A": None}, expected_revision=seen)
+
+
+def test_replace_conflicts_after_compaction(path):
+    first, second = PatternsStore(path, compact_every=3), PatternsStore(path, compact_every=3)
+    first.update_drivers({"A": {"zones": []}})
+    seen = first.get().revision
+    second.save({"drivers": {"B": {"zones": []}}})
+    for i in range(4):
+        second.update_drivers({"C": {"zones": [], "n": i}})
+    with pytest.raises(PatternsConflict, match="remplacée"):
+        first.update_drivers({"D": {"zones": []}}, expected_revision=seen)
+
+
+def test_save_ignores_imported_revisions(path):
+    store = PatternsStore(path)
+    store.update_drivers({"A": {"zones": []}})
+    exported = dict(load_patterns(path))
+    compiled = store.save(exported)
+    assert compiled.revision == 2
+    assert compiled.patterns["replaced_revision"] == 2
+    assert compiled.patterns["driver_revisions"] == {}
+
+
+def test_degenerate_zones_are_dropped():
+    drivers = clean_drivers({"A": {"zones": [
+        {"type": "Polygon", "coordinates": [[]]},
+        {"type": "Polygon", "coordinates": [[[4.0, 49.2], [4.01, 49.2], [4.02, 49.2], [4.0, 49.2]]]},
+        square(4.0, 49.2),
+    ]}, "B": None})
+    assert len(drivers["A"]["zones"]) == 1
+    assert drivers["B"] is None
+
+
+def test_save_patterns_goes_through_store(path):
+    compiled = save_patterns({"drivers": {"A": {"zones": [{"type": "Polygon", "coordinates": [[]]}]}}}, path)
+    assert compiled is get_patterns_store(path).get()
+    assert load_patterns(path)["drivers"]["A"]["zones"] == []
+    assert compiled.patterns["replaced_revision"] == 1
+
+
+def test_torn_log_line_is_ignored(path):
+    store = PatternsStore(path, compact_every=100)
+    store.update_drivers({"A": {"zones": []}})
+    with open(log_path(path), "a") as f:
+        f.write('{"revision": 99, "op"')
+    store.update_drivers({"B": {"zones": []}})
+    assert sorted(load_patterns(path)["drivers"]) == ["A", "B"]
+
+
+def test_file_lock_serializes_writers(path):
+    # Un store par thread : chacun ouvre son propre verrou de fichier
+    def writer(i):
+        store = PatternsStore(path, compact_every=7)
+        for k in range(20):
+            store.update_drivers({f"d{i}_{k}": {"zones": []}})
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    patterns = load_patterns(path)
+    assert len(patterns["drivers"]) == 80
+    assert patterns["revision"] == 80
+
+
+CACHED_DRIVERS = {
+    "A": {"zones": [square(4.00, 49.20, 0.02)], "postal_codes": ["51100"], "cities": ["Reims"]},
+    "B": {"zones": [square(4.01, 49.21, 0.02)], "postal_codes": ["0214"], "cities": ["Tinqueux"]},
+}
+PARCELS = pd.DataFrame({
+    "Sort Code": ["51100", "02140", "99999", "99999", "99999", "99999"],
+    "Receiver's City": ["", "", "Reims", "Tinqeux", "", ""],
+    "lat": [None, None, None, None, 49.205, 49.225],
+    "lon": [None, None, None, None, 4.005, 4.025],
+})
+
+
+def test_compiled_cache_round_trip(path, monkeypatch):
+    PatternsStore(path).save({"drivers": CACHED_DRIVERS})
+    with open(cache_path(path)) as f:
+        assert json.load(f)["zones"]["owners"] == [0, 1]
+
+    expected = CompiledPatterns(load_patterns(path)).dispatch(PARCELS).counts()
+    def no_compile(self, drivers):
+        raise AssertionError("zones recompilées au lieu d'être relues du cache")
+
+    monkeypatch.setattr(patterns_store.ZoneIndex, "__init__", no_compile)
+    cached = read_compiled_cache(path, content_digest(*read_files(path)))
+    assert cached is not None
+    compiled = PatternsStore(path).get()
+    assert compiled.version == cached[0]
+    assert compiled.dispatch(PARCELS).counts() == expected
+    assert len(compiled.overlaps(min_m2=0)) == 1
+
+
+def test_compiled_cache_invalidated_on_change(path, monkeypatch):
+    store = PatternsStore(path)
+    store.save({"drivers": CACHED_DRIVERS})
+    digest = content_digest(*read_files(path))
+    assert read_compiled_cache(path, digest) is not None
+
+    monkeypatch.setattr(patterns_store, "CODE_VERSION", "autre version")
+    assert read_compiled_cache(path, digest) is None
+    monkeypatch.undo()
+
+    store.update_drivers({"B": {"zones": [], "postal_codes": [], "cities": []}})
+    assert read_compiled_cache(path, digest) is None
+    counts = PatternsStore(path).get().dispatch(PARCELS).counts()
+    assert counts["A"] == 3 and "B" not in counts
+
+
+def test_overlaps_report_is_computed_on_demand():
+    compiled = CompiledPatterns({"drivers": {
+        "A": {"zones": [square(4.00, 49.20, 0.02)]},
+        "B": {"zones": [square(4.005, 49.205, 0.02)]},
+        "C": {"zones": [square(4.0199999, 49.20, 0.02)]},  # recoupe A sur un liseré de quelques m²
+        "D": {"zones": [square(4.10, 49.30)]},
+    }})
+    compiled.dispatch(PARCELS)
+    assert compiled.zone_index._contested is None
+
+    overlaps = compiled.overlaps()
+    assert [(o["prioritaire"], o["chauffeur"]) for o in overlaps] == [("A", "B"), ("B", "C")]
+    assert overlaps[0]["surface_m2"] > overlaps[1]["surface_m2"] > 100
+    assert overlaps[0]["geometry"]["type"] == "Polygon"
+    assert ("A", "C") in {(o["prioritaire"], o["chauffeur"]) for o in compiled.overlaps(min_m2=0)}
+
+
+@pytest.fixture
+def sites(tmp_path, monkeypatch):
+    monkeypatch.setattr(patterns_store, "SITES_DIR", str(tmp_path / "sites"))
+    monkeypatch.setattr(patterns_store, "MAX_COMPILED_SITES", 2)
+    monkeypatch.setattr(patterns_store, "_compiled_lru", OrderedDict())
+    monkeypatch.setattr(patterns_store, "_stores", {})
+
+
+@pytest.mark.usefixtures("sites")
+def test_least_recently_used_site_is_released():
+    stores = {}
+    for site in ("Reims", "Epernay"):
+        stores[site] = get_site_store(site)
+        stores[site].save({"drivers": {site: {"postal_codes": ["51100"]}}})
+    assert list_sites()[1:] == ["Epernay", "Reims"]
+
+    assert get_site_store("Reims") is stores["Reims"]  # Reims redevient le plus récent
+    get_site_store("Chalons").get()
+    assert stores["Epernay"]._compiled is None
+    assert stores["Reims"]._compiled is not None
+
+    # Un site libéré est relu à la demande, sans perdre sa configuration
+    assert list(get_site_store("Epernay").get().drivers) == ["Epernay"]
+    assert stores["Reims"]._compiled is None
+
+
+def test_invalid_site_name_is_rejected():
+    with pytest.raises(ValueError):
+        get_site_store("../autre")
+
+
+def test_failed_snapshot_write_keeps_previous_file(path, monkeypatch):
+    store = PatternsStore(path)
+    store.save({"drivers": {"A": {"zones": []}}})
+    os.chmod(path, 0o640)
+
+    def crash(src, dst):
+        raise OSError("disque plein")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(patterns_store.os, "replace", crash)
+        with pytest.raises(OSError):
+            store.save({"drivers": {"B": {"zones": []}}})
+    assert list(load_patterns(path)["drivers"]) == ["A"]
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith(".tmp")]
+
+    store.save({"drivers": {"B": {"zones": []}}})
+    assert list(load_patterns(path)["drivers"]) == ["B"]
+    assert os.stat(path).st_mode & 0o777 == 0o640